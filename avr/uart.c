@@ -193,6 +193,13 @@ LICENSE:
  #error "no UART definition for MCU available"
 #endif
 
+/* transmit complete flag, see uart_set_baudrate() */
+#if defined( ATMEGA_USART0 )
+ #define UART0_TXC      TXC0
+#else
+ #define UART0_TXC      TXC
+#endif
+
 
 /*
  *  module global variables
@@ -200,6 +207,8 @@ LICENSE:
 static volatile unsigned char UART_TxBuf[UART_TX_BUFFER_SIZE];
 static volatile unsigned char UART_TxHead;
 static volatile unsigned char UART_TxTail;
+/* set once a byte was loaded into the data register since uart_init() */
+static volatile unsigned char UART_TxStarted;
 
 ISR(UART0_RECEIVE_INTERRUPT)
 {
@@ -242,6 +251,9 @@ Purpose:  called when the UART is ready to transmit the next byte
         /* calculate and store new buffer index */
         tmptail = (UART_TxTail + 1) & UART_TX_BUFFER_MASK;
         UART_TxTail = tmptail;
+        /* clear the transmit complete flag so it is only set once this byte was sent */
+        UART0_STATUS |= _BV(UART0_TXC);
+        UART_TxStarted = 1;
         /* get one byte from buffer and write it to UART */
         UART0_DATA = UART_TxBuf[tmptail];  /* start transmission */
     }else{
@@ -261,6 +273,7 @@ void uart_init(unsigned int baudrate)
 {
     UART_TxHead = 0;
     UART_TxTail = 0;
+    UART_TxStarted = 0;
     
 #if defined( AT90_UART )
     /* set baud rate */
@@ -326,6 +339,30 @@ void uart_init(unsigned int baudrate)
 
 }/* uart_init */
 
+/*************************************************************************
+Function: uart_set_baudrate()
+Purpose:  reinitialize UART at another baudrate once the transmit buffer
+          is empty and the last byte left the shift register
+Input:    baudrate in bps
+Returns:  0 if the baudrate is off by more than 2.5%, 1 otherwise
+**************************************************************************/
+uint8_t uart_set_baudrate(uint32_t baudrate)
+{
+    /* double speed divider, rounded */
+    uint32_t ubrr = (F_CPU/8 + baudrate/2)/baudrate;
+    if ( ubrr == 0 || ubrr > 0x1000 )
+        return 0;
+    uint32_t actual = F_CPU/8/ubrr;
+    if ( (actual > baudrate ? actual-baudrate : baudrate-actual) > baudrate/40 )
+        return 0;
+
+    while ( UART_TxHead != UART_TxTail );/* wait for pending output */
+    if ( UART_TxStarted )
+        while ( !(UART0_STATUS & _BV(UART0_TXC)) );/* wait until the last byte was sent */
+    uart_init((ubrr-1) | 0x8000);
+    return 1;
+}
+
 /*************************************************************************
 Function: uart_putc()
 Purpose:  write byte to ringbuffer for transmitting via UART
@@ -336,6 +373,9 @@ void uart_putc(unsigned char data)
 {
     unsigned char tmphead;
 
+    if(comm_discard())
+        return;
+
     tmphead = (UART_TxHead + 1) & UART_TX_BUFFER_MASK;
     
     while ( tmphead == UART_TxTail );/* wait for free space in buffer */
@@ -109,6 +109,13 @@ LICENSE:
 */
 extern void uart_init(unsigned int baudrate);
 
+/**
+   @brief   Reinitialize the UART at another baudrate at runtime
+   @param   baudrate baudrate in bps
+   @return  0 if the baudrate cannot be generated from F_CPU with at most 2.5% error
+*/
+extern uint8_t uart_set_baudrate(uint32_t baudrate);
+
 
 /**
  *  @brief   Get received byte from ringbuffer
@@ -92,7 +92,14 @@ void loop_usb(){
 	USB_USBTask();
 }
 
+//The virtual serial port's baud rate is set by the host and does not affect the transfer speed
+uint8_t uart_set_baudrate(uint32_t baudrate){
+	return 1;
+}
+
 void uart_putc(uint8_t c){
+	if(comm_discard())
+		return;
 	CDC_Device_SendByte(&VirtualSerial_CDC_Interface, c);
 }
 
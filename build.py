@@ -9,47 +9,160 @@
 import sys
 import os
 import json
-import imp
+import time
 import datetime
 import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 import generator
 """Generate firmware for Cerebrum devices according to a json-formatted device configuration passed on the command line."""
 
-# Parse arguments
-parser = argparse.ArgumentParser(description='Generate firmware for Cerebrum devices according to a json-formatted device configuration passed on the command line.', epilog='To program the device upon creating the firmware image, supply either -p or -s.')
-parser.add_argument('template', type=argparse.FileType('r'), default='-', help='The build template .json file')
-parser.add_argument('device', type=argparse.FileType('r'), help='The device type of this build. For available types, have a look at the "devices" directory.')
-parser.add_argument('-p', '--port', type=str, help='The tty where the device may be found to be programmed')
-parser.add_argument('-b', '--baudrate', type=int, help='The baud rate of the device')
-parser.add_argument('-s', '--usbserial', type=str, help='The USB serial number by which the device can be identified in order to be programmed')
-parser.add_argument('-n', '--buildname', type=str, help='An optional name for the build. This is used to name the build config files.')
-args = parser.parse_args()
-
-# Decode json device descriptor and device config and initialize build variables
-print("Parsing config")
-desc = json.JSONDecoder().decode(args.template.read())
-print("Parsing device description")
-device = json.JSONDecoder().decode(args.device.read())
-st = datetime.datetime.utcnow().timetuple()
-builddate = str(datetime.datetime(st[0], st[1], st[2], st[3], st[4], st[5]))
-buildsource = 'stdin' if args.template.name is '-' else args.template.name
-print(builddate)
-print('Generating firmware from ', buildsource, "for", desc['type'])
-
-# Generate code and write generated build config
-# FIXME there are two different but similar things called "build config" here.
-build_path = os.path.join(os.path.dirname(__file__), desc["type"])
-buildconfig = generator.generate(desc, device, build_path, builddate, args.buildname)
-with open(os.path.join(os.path.dirname(__file__), "builds", builddate + "-" + args.buildname if args.buildname else os.path.splitext(os.path.basename(buildsource))[0] + ".config.json"), "w") as f:
-	f.write(json.JSONEncoder(indent=4).encode(buildconfig))
-	print('Wrote build config to ', f.name)
-
-# Flash the device if requested
-if args.port or args.usbserial:
-	print('Programming device')
-	generator.commit(device, device['type'], args)
-
-# ???
-
-# PROFIT!!!
+HERE = os.path.dirname(os.path.abspath(__file__))
+#Default root of the out-of-tree build directories of batch builds
+OUT_PATH = os.path.join(HERE, 'out')
+#Device of build templates that name none, by build type
+DEFAULT_DEVICES = {'avr': 'arduino-mega', 'avrbt': 'arduino-mega', 'avrusb': 'atmega16u2', 'msp': 'ti-launchpad-msp430-g2553'}
 
+def write_buildconfig(buildconfig, builddate, buildsource, buildname):
+	os.makedirs(os.path.join(HERE, "builds"), exist_ok=True)
+	with open(os.path.join(HERE, "builds", builddate + "-" + buildname if buildname else os.path.splitext(os.path.basename(buildsource))[0] + ".config.json"), "w") as f:
+		f.write(json.JSONEncoder(indent=4).encode(buildconfig))
+		print('Wrote build config to ', f.name)
+
+def load_device(name):
+	"""Load a device description given either as path or as name of a file in the "devices" directory."""
+	if not os.path.exists(name):
+		name = os.path.join(HERE, 'devices', name + '.json')
+	with open(name) as f:
+		return json.load(f)
+
+def template_device(desc, default_device=None):
+	"""Remove the "device" field (a device name or path) from the given build template and load the device it names.
+
+	Templates without one get default_device, or the default device of their build type if that is None.
+
+	"""
+	device = desc.pop('device', None) or default_device or DEFAULT_DEVICES.get(desc['type'])
+	if device is None:
+		raise ValueError('The build template does not name a device and there is no default device for {}'.format(desc['type']))
+	return load_device(device)
+
+def template_node_id(desc):
+	"""Remove the "node_id" field (a number or a string like "0x2342") from the given build template and return it.
+
+	Returns None for templates without one, which get a random node id. Only builds with a node id are cached since
+	each device needs its own.
+
+	"""
+	node_id = desc.pop('node_id', None)
+	return int(node_id, 0) if isinstance(node_id, str) else node_id
+
+def build_one(template, default_device, out_path, builddate, cache=None):
+	"""Build the given build template out of tree below out_path and return the build's (type, duration in seconds).
+
+	The device is chosen by template_device, the node id by template_node_id. Unchanged builds are restored from
+	cache, a generator.BuildCache, if given.
+
+	"""
+	start = time.perf_counter()
+	with open(template) as f:
+		desc = json.load(f)
+	device = template_device(desc, default_device)
+	node_id = template_node_id(desc)
+	name = os.path.splitext(os.path.basename(template))[0]
+	build_path = generator.out_of_tree(desc['type'], os.path.join(out_path, name))
+	buildconfig = generator.generate(desc, device, build_path, builddate, node_id=node_id, cache=cache)
+	write_buildconfig(buildconfig, builddate, template, None)
+	return desc['type'], time.perf_counter() - start
+
+def build_all(templates, default_device, out_path, builddate, jobs, cache=None):
+	"""Build all given build templates in parallel on a pool of jobs processes and print a timing summary.
+
+	Returns the number of failed builds.
+
+	"""
+	start = time.perf_counter()
+	results = {}
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		futures = [(template, pool.submit(build_one, template, default_device, out_path, builddate, cache)) for template in templates]
+		for template, future in futures:
+			try:
+				results[template] = future.result()
+			except Exception as e:
+				print('-----[\x1b[91;1mBuilding {} failed\x1b[0m]-----'.format(template))
+				traceback.print_exception(type(e), e, e.__traceback__)
+				results[template] = None
+	elapsed = time.perf_counter() - start
+
+	print('\nBuild summary:')
+	for template in templates:
+		result = results[template]
+		if result is None:
+			print('    {:<40} {:<8} \x1b[91;1mfailed\x1b[0m'.format(template, ''))
+		else:
+			print('    {:<40} {:<8} {:>7.2f}s'.format(template, *result))
+	total = sum(r[1] for r in results.values() if r is not None)
+	print('{} builds in {:.2f}s ({:.2f}s build time on {} processes)'.format(len(templates), elapsed, total, jobs))
+	return sum(1 for r in results.values() if r is None)
+
+if __name__ == '__main__':
+	# Parse arguments
+	parser = argparse.ArgumentParser(description='Generate firmware for Cerebrum devices according to a json-formatted device configuration passed on the command line.', epilog='To program the device upon creating the firmware image, supply either -p or -s.')
+	parser.add_argument('template', type=argparse.FileType('r'), nargs='?', help='The build template .json file')
+	parser.add_argument('device', type=str, nargs='?', help='The device type of this build (a name or path). For available types, have a look at the "devices" directory. Defaults to the template\'s "device" field or the default device of its build type.')
+	parser.add_argument('-p', '--port', type=str, help='The tty where the device may be found to be programmed')
+	parser.add_argument('-b', '--baudrate', type=int, help='The baud rate of the device')
+	parser.add_argument('-s', '--usbserial', type=str, help='The USB serial number by which the device can be identified in order to be programmed')
+	parser.add_argument('-n', '--buildname', type=str, help='An optional name for the build. This is used to name the build config files.')
+	parser.add_argument('-o', '--outdir', type=str, help='Build out of tree in this directory instead of the platform directory (e.g. "avr")')
+	parser.add_argument('-a', '--all', type=str, nargs='+', metavar='TEMPLATE', help='Build all given build templates in parallel, each in its own directory below the --outdir (default: "out")')
+	parser.add_argument('-d', '--default-device', type=str, help='With --all, the device (name or path) of templates without a "device" field instead of the default device of their build type')
+	parser.add_argument('--node-id', type=lambda x: int(x, 0), help='The node id (MAC) of the device instead of the template\'s "node_id" field. Without either, the device gets a random one.')
+	parser.add_argument('--no-cache', action='store_true', help='Always build from scratch instead of restoring unchanged builds from the build cache in ~/.cache/cerebrum/builds. Builds with a random node id are never restored from the cache.')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='With --all, the number of builds to run at the same time (default: number of CPUs)')
+	args = parser.parse_args()
+
+	st = datetime.datetime.utcnow().timetuple()
+	builddate = str(datetime.datetime(st[0], st[1], st[2], st[3], st[4], st[5]))
+	cache = None if args.no_cache else generator.BuildCache()
+
+	if args.all:
+		if args.template or args.port or args.usbserial:
+			parser.error('--all builds only the given templates and cannot program devices')
+		sys.exit(1 if build_all(args.all, args.default_device, args.outdir or OUT_PATH, builddate, args.jobs, cache) else 0)
+
+	if not args.template:
+		parser.error('A build template is required')
+
+	# Decode json device descriptor and device config and initialize build variables
+	print("Parsing config")
+	desc = json.JSONDecoder().decode(args.template.read())
+	print("Parsing device description")
+	#A device given on the command line wins over the template's
+	if args.device:
+		desc['device'] = args.device
+	device = template_device(desc)
+	node_id = template_node_id(desc)
+	if args.node_id is not None:
+		node_id = args.node_id
+	buildsource = 'stdin' if args.template.name is '-' else args.template.name
+	print(builddate)
+	print('Generating firmware from ', buildsource, "for", desc['type'])
+
+	# Generate code and write generated build config
+	# FIXME there are two different but similar things called "build config" here.
+	if args.outdir:
+		build_path = generator.out_of_tree(desc["type"], args.outdir)
+	else:
+		build_path = os.path.join(os.path.dirname(__file__), desc["type"])
+	buildconfig = generator.generate(desc, device, build_path, builddate, args.buildname, node_id=node_id, cache=cache)
+	write_buildconfig(buildconfig, builddate, buildsource, args.buildname)
+
+	# Flash the device if requested
+	if args.port or args.usbserial:
+		print('Programming device')
+		generator.commit(device, build_path, args)
+
+	# ???
+
+	# PROFIT!!!
@@ -13,5 +13,7 @@
 void init_auto(void);
 void loop_auto(void);
 void callback_get_descriptor_auto(const comm_callback_descriptor* cb, void* argbuf_end);
+//Queue a change event to be drained by the host. Only available if any module uses event_source().
+void comm_push_event(uint8_t source, uint8_t index, uint8_t value);
 
 #endif//_AUTOCODE_H_
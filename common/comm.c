@@ -9,14 +9,86 @@
 #include <stdint.h>
 #include <stddef.h>
 #include "comm.h"
+#include "uart.h"
 
 const volatile uint8_t global_argbuf[ARGBUF_SIZE];
 volatile callback_stack_t next_callback;
+volatile uint8_t comm_silent;
+//Group addresses this node joined. 0 marks a free slot since it is no group address.
+static uint16_t comm_groups[COMM_GROUP_SLOTS];
+volatile uint32_t comm_baudrate_request;
+volatile uint16_t comm_baudrate_trial;
+volatile uint8_t comm_baudrate_expired;
+static uint32_t comm_baudrate = CEREBRUM_BAUDRATE;
+static uint32_t comm_baudrate_fallback;
 
 void comm_loop(){
+	if(comm_baudrate_request){
+		uint32_t rate = comm_baudrate_request;
+		comm_baudrate_request = 0;
+		//A node that cannot do the new rate stays at the old one. The host notices once it does not answer anymore.
+		if(uart_set_baudrate(rate)){
+			comm_baudrate_fallback = comm_baudrate;
+			comm_baudrate = rate;
+			comm_baudrate_trial = COMM_BAUDRATE_TRIAL;
+		}
+	}
+	if(comm_baudrate_expired){
+		comm_baudrate_expired = 0;
+		uart_set_baudrate(comm_baudrate_fallback);
+		comm_baudrate = comm_baudrate_fallback;
+	}
 	if(next_callback.descriptor){
+		comm_silent = next_callback.silent ? COMM_SILENT : 0;
 		(*next_callback.descriptor->callback)(next_callback.descriptor, next_callback.argbuf_end);
+		comm_silent = 0;
 		next_callback.descriptor = 0;
 	}
 }
 
+uint8_t comm_in_group(uint16_t addr){
+	if(addr == ADDRESS_BROADCAST)
+		return 1;
+	if(addr < ADDRESS_GROUP_FIRST || addr > ADDRESS_GROUP_LAST)
+		return 0;
+	for(uint8_t i=0; i<COMM_GROUP_SLOTS; i++){
+		if(comm_groups[i] == addr)
+			return 1;
+	}
+	return 0;
+}
+
+//Join or leave a group. The argument is the big-endian group address followed by one byte that is 1 for joining and 0
+//for leaving the group. Returns 1 on success and 0 if the address is no group address or all group slots are taken.
+void comm_callback_join_group(const comm_callback_descriptor* cb, void* argbuf_end){
+	uint8_t* args = (uint8_t*)cb->argbuf;
+	uint8_t rv = 0;
+	if((uint8_t*)argbuf_end - args >= 3){
+		uint16_t group = (args[0]<<8) | args[1];
+		if(group >= ADDRESS_GROUP_FIRST && group <= ADDRESS_GROUP_LAST){
+			uint16_t* slot = 0;
+			for(uint8_t i=0; i<COMM_GROUP_SLOTS; i++){
+				if(comm_groups[i] == group){
+					slot = comm_groups+i;
+					break;
+				}
+				if(!comm_groups[i] && !slot)
+					slot = comm_groups+i;
+			}
+			if(args[2]){
+				if(slot){
+					*slot = group;
+					rv = 1;
+				}
+			}else{
+				if(slot && *slot == group)
+					*slot = 0;
+				rv = 1;
+			}
+		}
+	}
+	uart_putc(0x00);
+	uart_putc(0x01);
+	uart_putc(rv);
+}
+
@@ -22,6 +22,8 @@ struct comm_callback_descriptor {
 typedef struct {
 	comm_callback_descriptor const * descriptor;
 	void* argbuf_end;
+	//Set for frames sent to a group address. The callback's response is suppressed.
+	uint8_t silent;
 } callback_stack_t;
 
 extern const comm_callback_descriptor comm_callbacks[];
@@ -41,8 +43,53 @@ extern const volatile uint8_t global_argbuf[];
 
 #define ADDRESS_DISCOVERY 0xFFFF
 #define ADDRESS_INVALID 0xFFFE
+//Frames sent to the broadcast address or to a group address of a group the node joined are processed without sending
+//any response.
+#define ADDRESS_BROADCAST 0xFFFD
+#define ADDRESS_GROUP_FIRST 0xFF00
+#define ADDRESS_GROUP_LAST 0xFFEF
+
+#ifndef COMM_GROUP_SLOTS
+//Number of groups a node can be a member of at the same time
+#define COMM_GROUP_SLOTS 4
+#endif
+
+//While set, uart_putc discards its output. COMM_SILENT discards all of it, any other value that many more bytes.
+extern volatile uint8_t comm_silent;
+#define COMM_SILENT 0xFF
+
+//Tell whether uart_putc has to discard the next byte (see comm_silent)
+static inline uint8_t comm_discard(void){
+	if(!comm_silent)
+		return 0;
+	if(comm_silent != COMM_SILENT)
+		comm_silent--;
+	return 1;
+}
+
+//Frames sent to this address make all nodes switch their UART to the baud rate given by the 4 byte big-endian argument
+//after the header. Nodes do not respond to these frames.
+#define ADDRESS_BAUDRATE 0xFFFC
+
+#ifndef COMM_BAUDRATE_TRIAL
+//Number of bytes a node receives at a new baud rate before switching back if none of them was a frame addressed to it
+#define COMM_BAUDRATE_TRIAL 512
+#endif
+
+#ifndef CEREBRUM_BAUDRATE
+#define CEREBRUM_BAUDRATE 115200
+#endif
+
+//Baud rate requested by the last frame to ADDRESS_BAUDRATE, applied by comm_loop
+extern volatile uint32_t comm_baudrate_request;
+//Bytes left until the current baud rate is given up. 0 while the baud rate is confirmed.
+extern volatile uint16_t comm_baudrate_trial;
+//Set once the trial ran out, making comm_loop switch back to the previous baud rate
+extern volatile uint8_t comm_baudrate_expired;
 
 void comm_loop(void);
+uint8_t comm_in_group(uint16_t addr);
+void comm_callback_join_group(const comm_callback_descriptor* cb, void* argbuf_end);
 
 #endif//__COMM_H__
 
@@ -31,6 +31,8 @@ static inline void comm_handle(uint8_t c){
 		uint8_t escaped:1;
 		uint8_t mac_received:1;
 		uint8_t receive_args:1;
+		uint8_t silent:1;
+		uint8_t rate_received:1;
 	} state_t;
 	typedef struct {
 		uint16_t node_id;
@@ -44,11 +46,16 @@ static inline void comm_handle(uint8_t c){
 	static comm_callback_descriptor const * current_callback;
 	args_t* args = (args_t*)global_argbuf;
 #define ARGS_END (((uint8_t*)(args))+sizeof(args_t))
+	if(comm_baudrate_trial && !--comm_baudrate_trial){
+		//Nothing addressed to this node arrived at the new baud rate
+		comm_baudrate_expired = 1;
+	}
 	if(state.escaped){
         state.escaped = 0;
 		if(c == '#'){
 			state.receiving = 1;
 			state.receive_args = 1;
+			state.rate_received = 0;
 			argbuf = args;
 			argbuf_end = ARGS_END;
             comm_debug_print("[DEBUG] starting message, argbuf @0x%x, argbuf_end @0x%x\n", argbuf, argbuf_end);
@@ -72,7 +79,9 @@ static inline void comm_handle(uint8_t c){
 			state.receive_args = 0;
 			comm_debug_print("[DEBUG] received the header\n");
 			uint16_t addr = be16toh(args->node_id);
-			if(addr != current_address){
+			//Frames to a group are processed like those to this node, but without sending any response
+			state.silent = addr != current_address;
+			if(addr != current_address && !comm_in_group(addr)){
 				if(addr == ADDRESS_DISCOVERY){
 					if(state.mac_received){
 						state.mac_received = 0;
@@ -91,10 +100,25 @@ static inline void comm_handle(uint8_t c){
 						argbuf_end += sizeof(uint64_t);
 						return;
 					}
+				}else if(addr == ADDRESS_BAUDRATE){
+					if(state.rate_received){
+						state.rate_received = 0;
+						uint8_t* rate = ARGS_END;
+						comm_baudrate_request = ((uint32_t)rate[0]<<24) | ((uint32_t)rate[1]<<16) | ((uint32_t)rate[2]<<8) | rate[3];
+					}else{
+						state.receive_args = 1;
+						state.rate_received = 1;
+						argbuf_end += sizeof(uint32_t);
+						return;
+					}
 				}
 				state.receiving = 0;
 				return;
 			}
+			if(!state.silent){
+				//The baud rate works since this frame came through
+				comm_baudrate_trial = 0;
+			}
 			if(be16toh(args->funcid) >= callback_count){ //only jump to valid callbacks.
                 comm_debug_print("[DEBUG] invalid callback: funcid=0x%x given, callback_count=0x%x\n", be16toh(args->funcid), callback_count);
                 state.receiving = 0; //return to idle state
@@ -116,8 +140,9 @@ static inline void comm_handle(uint8_t c){
         state.receiving = 0;
         if(current_callback->callback != 0){
 			next_callback.argbuf_end = argbuf_end;
+			next_callback.silent = state.silent;
 			next_callback.descriptor = current_callback;
-        }else{
+        }else if(!state.silent){
             //Send a minimal response.
             uart_putc_nonblocking(0);
             uart_putc_nonblocking(0);
@@ -7,5 +7,8 @@
 #define PROGMEM
 #endif//__AVR__
 
+#define AUTO_CONFIG_FINGERPRINT_LENGTH 9
+
 extern unsigned int auto_config_descriptor_length;
 extern const char auto_config_descriptor[];
+extern const char auto_config_fingerprint[];
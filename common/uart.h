@@ -6,6 +6,8 @@
 void uart_init(void);
 void uart_putc(uint8_t data);
 void uart_putc_nonblocking(uint8_t data);
+//Reconfigure the UART to the given baud rate, returning 0 if it cannot be generated accurately enough
+uint8_t uart_set_baudrate(uint32_t baudrate);
 
 #endif // UART_H 
 
@@ -5,7 +5,9 @@
 #version 3 as published by the Free Software Foundation.
 
 import subprocess
+import sys
 import os.path
+import shutil
 import time
 import random
 from threading import Thread
@@ -14,6 +16,7 @@ from inspect import isfunction
 from mako.template import Template
 from mako import exceptions
 import binascii
+import hashlib
 import json
 try:
 	import lzma
@@ -21,6 +24,8 @@ except:
 	import pylzma as lzma
 import codecs
 import unittest
+import tempfile
+from pylibcerebrum.compact_descriptor import encode_descriptor
 """Automatic Cerebrum C code generator"""
 
 # Code templates. Actually, this is the only device-dependent place in this whole
@@ -54,6 +59,135 @@ autocode_footer = """
 
 void generic_getter_callback(const comm_callback_descriptor* cb, void* argbuf_end);
 
+//Generic ranged setter used for writable array module variables. Its argument is a big-endian byte offset into the
+//variable followed by the data to be written there.
+static void ranged_setter(uint8_t* var, uint16_t size, void* argbuf, void* argbuf_end){
+	uint8_t* data = ((uint8_t*)argbuf)+2;
+	if((uint8_t*)argbuf_end > data){
+		uint16_t offset = (((uint8_t*)argbuf)[0]<<8) | ((uint8_t*)argbuf)[1];
+		uint16_t len = (uint8_t*)argbuf_end - data;
+		if(offset < size){
+			if(len > size-offset)
+				len = size-offset;
+			memcpy(var+offset, data, len);
+		}
+	}
+	uart_putc(0x00);
+	uart_putc(0x00);
+}
+
+% for varname in ranged_setters:
+void callback_setrange_${varname}(const comm_callback_descriptor* cb, void* argbuf_end){
+	ranged_setter((uint8_t*)${varname}, sizeof(${varname}), cb->argbuf, argbuf_end);
+}
+% endfor
+
+% if snapshot_vars:
+//Snapshot callback returning all readable properties packed back to back in one response. Module variables using the
+//generic getter are copied directly, the other properties are read by calling their getter without its length header.
+static const struct {
+	const void* var; //0 for properties with a custom getter
+	uint16_t size;
+	uint16_t getter; //callback id of the custom getter
+} snapshot_vars[] = {
+	% for var, size, getter in snapshot_vars:
+	{${var}, ${size}, ${getter}},
+	% endfor
+};
+
+void callback_snapshot_auto(const comm_callback_descriptor* cb, void* argbuf_end){
+	uint16_t len = 0;
+	for(uint8_t i=0; i<sizeof(snapshot_vars)/sizeof(snapshot_vars[0]); i++)
+		len += snapshot_vars[i].size;
+	uart_putc(len>>8);
+	uart_putc(len&0xFF);
+	for(uint8_t i=0; i<sizeof(snapshot_vars)/sizeof(snapshot_vars[0]); i++){
+		if(!snapshot_vars[i].var){
+			const comm_callback_descriptor* getter = comm_callbacks+snapshot_vars[i].getter;
+			//Discard the two byte length header of the getter's response unless the whole response is discarded
+			if(!comm_silent)
+				comm_silent = 2;
+			getter->callback(getter, getter->argbuf);
+			continue;
+		}
+		for(const char* j=snapshot_vars[i].var; j<(const char*)snapshot_vars[i].var+snapshot_vars[i].size; j++){
+			uart_putc(*j);
+		}
+	}
+}
+% endif
+
+% if event_sources:
+//Ring buffer of change events pushed by the module loop functions. When it is full, the oldest event is dropped.
+static struct {
+	uint8_t source;
+	uint8_t index;
+	uint8_t value;
+} event_queue[${event_queue_size}];
+static uint8_t event_queue_start;
+static uint8_t event_queue_len;
+static uint8_t event_queue_dropped;
+
+void comm_push_event(uint8_t source, uint8_t index, uint8_t value){
+	uint8_t i = (event_queue_start+event_queue_len)%${event_queue_size};
+	if(event_queue_len == ${event_queue_size}){
+		event_queue_start = (event_queue_start+1)%${event_queue_size};
+		if(event_queue_dropped < 0xFF)
+			event_queue_dropped++;
+	}else{
+		event_queue_len++;
+	}
+	event_queue[i].source = source;
+	event_queue[i].index = index;
+	event_queue[i].value = value;
+}
+
+//Returns the number of dropped events followed by the queued (source, index, value) records and empties the queue
+void callback_drain_events_auto(const comm_callback_descriptor* cb, void* argbuf_end){
+	uint16_t len = 1+3*event_queue_len;
+	uart_putc(len>>8);
+	uart_putc(len&0xFF);
+	uart_putc(event_queue_dropped);
+	for(; event_queue_len; event_queue_len--){
+		uart_putc(event_queue[event_queue_start].source);
+		uart_putc(event_queue[event_queue_start].index);
+		uart_putc(event_queue[event_queue_start].value);
+		event_queue_start = (event_queue_start+1)%${event_queue_size};
+	}
+	event_queue_dropped = 0;
+}
+% endif
+
+% if multiset_size:
+//Argument buffer of the multi-set callback. The global argument buffer is too small to hold more than a few records on
+//the µCs.
+static uint8_t multiset_argbuf[${multiset_size}];
+
+//Multi-set callback applying a list of [2 byte callback id][1 byte length][payload] records in order. Each callback
+//sends its own response, thus the host receives one response per record.
+void callback_multiset_auto(const comm_callback_descriptor* cb, void* argbuf_end){
+	uint8_t* rec = cb->argbuf;
+	while(rec+3 <= (uint8_t*)argbuf_end){
+		uint16_t fid = (rec[0]<<8) | rec[1];
+		uint8_t len = rec[2];
+		uint8_t* data = rec+3;
+		rec = data+len;
+		if(fid >= callback_count || comm_callbacks+fid == cb || rec > (uint8_t*)argbuf_end)
+			return;
+		const comm_callback_descriptor* target = comm_callbacks+fid;
+		if(len > target->argbuf_len)
+			len = target->argbuf_len;
+		memcpy(target->argbuf, data, len);
+		if(target->callback){
+			target->callback(target, ((uint8_t*)target->argbuf)+len);
+		}else{
+			uart_putc(0x00);
+			uart_putc(0x00);
+		}
+	}
+}
+% endif
+
 const comm_callback_descriptor comm_callbacks[] = {
 	% for (callback, argbuf, argbuf_len, id) in callbacks:
 	{${callback}, (void*)${argbuf}, ${argbuf_len}}, //${id}
@@ -76,6 +210,19 @@ void loop_auto(){
 }
 
 void callback_get_descriptor_auto(const comm_callback_descriptor* cb, void* argbuf_end){
+	if(argbuf_end != cb->argbuf){
+		//When called with any argument, only return the descriptor's fingerprint so hosts can check their cache.
+		uart_putc(0x00);
+		uart_putc(AUTO_CONFIG_FINGERPRINT_LENGTH);
+		for(const char* i=auto_config_fingerprint; i < auto_config_fingerprint+AUTO_CONFIG_FINGERPRINT_LENGTH; i++){
+#if defined(__AVR__)
+			uart_putc(pgm_read_byte(i));
+#else
+			uart_putc(*i);
+#endif
+		}
+		return;
+	}
 	//FIXME
 	uart_putc(auto_config_descriptor_length >> 8);
 	uart_putc(auto_config_descriptor_length & 0xFF);
@@ -106,7 +253,9 @@ void generic_getter_callback(const comm_callback_descriptor* cb, void* argbuf_en
 
 config_c_template = """\
 /* AUTOGENERATED CODE AHEAD!
- * This file contains the device configuration in lzma-ed json-format. It is
+ * This file contains the device configuration encoded as selected by the build
+ * config's "descriptor_format" (the smaller of the compact table and lzma-ed
+ * json by default). It is
  * autogenerated by "generate.py" (which should be found in this folder).
  */
 #include "config.h"
@@ -116,22 +265,220 @@ config_c_template = """\
 
 unsigned int auto_config_descriptor_length = ${desc_len};
 char const auto_config_descriptor[] PROGMEM = {${desc}};
+char const auto_config_fingerprint[AUTO_CONFIG_FINGERPRINT_LENGTH] PROGMEM = {${fingerprint}};
 """
 
+#Maximum number of data bytes in a ranged write: ARGBUF_SIZE (32 bytes on the µCs) minus the 2 byte offset
+RANGED_WRITE_MAX = 30
+
+#Default number of change events queued on the device, can be overridden by "event_queue_size" in the build config
+EVENT_QUEUE_SIZE = 16
+
+#Default size of the multi-set callback's argument buffer, can be overridden by "multiset_buffer_size" in the build config
+MULTISET_BUFFER_SIZE = 64
+
+#Encoding of the descriptor burned into the firmware, can be overridden by "descriptor_format" in the build config
+DESCRIPTOR_FORMAT = 'auto'
+
+def encode_config(desc, fmt):
+	"""Encode the device descriptor as "lzma" (LZMA-ed JSON), "json" or "binary" (see pylibcerebrum.compact_descriptor).
+	"auto" picks the binary encoding unless it does not fit or the LZMA-ed JSON is smaller."""
+	if fmt == 'auto':
+		lzmaed = encode_config(desc, 'lzma')
+		try:
+			binary = encode_descriptor(desc)
+		except ValueError:
+			return lzmaed
+		return binary if len(binary) <= len(lzmaed) else lzmaed
+	if fmt == 'binary':
+		return encode_descriptor(desc)
+	config = bytes(json.JSONEncoder(separators=(',',':')).encode(desc), 'utf-8')
+	if fmt == 'json':
+		return config
+	if fmt == 'lzma':
+		#The first byte is used as a magic here. The first byte of a JSON string will always be a '{'
+		return b'#' + lzma.compress(config)
+	raise ValueError('Unknown descriptor format {}'.format(fmt))
+
+#Standard baud rates a bus can be switched to at runtime (see SerialMux.upshift)
+BAUDRATES = [57600, 115200, 230400, 250000, 500000, 1000000]
+
+def supported_baudrates(device):
+	"""Return the standard baud rates the device's UART can switch to at runtime, i.e. those it can generate from its
+	clock with at most 2.5% error. This is what uart_set_baudrate of the respective platform accepts."""
+	dtype = device.get('type')
+	if dtype in ('avrusb', 'avrbt'):
+		#A virtual serial port is as fast as USB goes anyway, and the bluetooth module's UART runs at a fixed rate
+		return []
+	if dtype == 'msp':
+		#SMCLK at 16MHz, prescaler with fractional modulation
+		return [rate for rate in BAUDRATES if 16000000//rate >= 16]
+	if dtype == 'avr':
+		rates = []
+		for rate in BAUDRATES:
+			#Double speed mode divides the clock by 8
+			ubrr = round(device['clock']/8/rate)
+			if 0 < ubrr <= 0x1000 and abs(device['clock']/8/ubrr - rate) <= rate/40:
+				rates.append(rate)
+		return rates
+	#The host-side test build can do anything
+	return list(BAUDRATES)
+
+#Default location of the firmware build cache
+BUILD_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'cerebrum', 'builds')
+
+#Compiler of each build type. Its version is part of the build cache key.
+COMPILERS = {'avr': 'avr-gcc', 'avrbt': 'avr-gcc', 'avrusb': 'avr-gcc', 'msp': 'msp430-gcc', 'test': 'gcc'}
+_compiler_versions = {}
+
+def compiler_version(build_type):
+	"""Return the --version output of the compiler of the given build type, or None if it is not installed."""
+	if build_type not in _compiler_versions:
+		compiler = shutil.which(COMPILERS[build_type]) if build_type in COMPILERS else None
+		_compiler_versions[build_type] = compiler and subprocess.check_output([compiler, '--version'], universal_newlines=True)
+	return _compiler_versions[build_type]
+
+#Files written by generate() into the build directory
+GENERATED_FILES = ['autocode.c', 'config.c']
+
+def _is_source(d, name):
+	"""Tell whether the file or directory name in the platform directory d is part of the firmware sources."""
+	if name in GENERATED_FILES:
+		return False
+	return name == 'Makefile' or name.endswith(('.c', '.h', '.tp')) or os.path.isdir(os.path.join(d, name))
+
+def out_of_tree(build_type, path):
+	"""Set up an out-of-tree build directory for the given platform (e.g. "avr") below path and return it.
+
+	The platform's sources and common/ are copied there, directories (like avrusb's LUFA) are symlinked. Builds in
+	different directories can run at the same time. Pass the result to generate() as build_path.
+
+	"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	build_path = os.path.join(path, build_type)
+	for src, dst in ((os.path.join(here, build_type), build_path), (os.path.join(here, 'common'), os.path.join(path, 'common'))):
+		os.makedirs(dst, exist_ok=True)
+		for name in os.listdir(src):
+			if not _is_source(src, name):
+				continue
+			if os.path.isdir(os.path.join(src, name)):
+				if not os.path.lexists(os.path.join(dst, name)):
+					os.symlink(os.path.join(src, name), os.path.join(dst, name))
+			else:
+				shutil.copy2(os.path.join(src, name), os.path.join(dst, name))
+	return build_path
+
+class BuildCache(object):
+	"""On-disk cache of generated firmware keyed by a hash of everything going into a build
+
+	An entry holds the generated sources, the files make produced in the build directory and the resulting build
+	config. The key covers the build config, the device config, the node id, the make target, the sources and module
+	templates in the build directory and in common/, the code generator itself, the toolchain's PATH and the version of
+	the compiler. Any change to these results in a fresh build. The build date is not part of the key: an unchanged
+	build is restored with the build date it was first built with. The compiled mako module templates are kept in the
+	cache, too.
+
+	Only builds with a given node id are cached, see generate().
+
+	"""
+
+	def __init__(self, path=BUILD_CACHE_PATH):
+		self.path = path
+		self.module_directory = os.path.join(path, 'mako')
+		os.makedirs(self.module_directory, exist_ok=True)
+
+	def key(self, desc, device, build_path, target, node_id):
+		"""Return the hex key of a build."""
+		build_type = os.path.basename(os.path.normpath(build_path))
+		h = hashlib.sha1(json.dumps([desc, device, target, node_id, os.environ.get('PATH'), compiler_version(build_type)], sort_keys=True).encode())
+		here = os.path.dirname(os.path.abspath(__file__))
+		#(name, path) of all sources. The names do not depend on the build directory so out-of-tree builds share entries.
+		sources = [('generator.py', os.path.abspath(__file__)), ('compact_descriptor.py', os.path.join(here, 'pylibcerebrum', 'compact_descriptor.py'))]
+		for prefix, d in (('build/', build_path), ('common/', os.path.join(build_path, '..', 'common'))):
+			sources += [(prefix+name, os.path.join(d, name)) for name in sorted(os.listdir(d)) if _is_source(d, name) and not os.path.isdir(os.path.join(d, name))]
+		for name, source in sources:
+			h.update(name.encode() + b'\0')
+			with open(source, 'rb') as f:
+				h.update(hashlib.sha1(f.read()).digest())
+		return h.hexdigest()
+
+	def get(self, key, build_path):
+		"""Restore the files of a cached build into build_path and return its build config, or None on a miss."""
+		entry = os.path.join(self.path, key)
+		try:
+			with open(os.path.join(entry, 'config.json')) as f:
+				desc = json.load(f)
+			with open(os.path.join(entry, 'files.json')) as f:
+				files = json.load(f)
+			#Copy the generated sources first so make considers the outputs up to date
+			for name in files:
+				shutil.copy(os.path.join(entry, name), os.path.join(build_path, name))
+		except (OSError, ValueError):
+			return None
+		return desc
+
+	def put(self, key, build_path, outputs, desc):
+		"""Store the generated sources and the given make outputs from build_path along with the build config."""
+		entry = os.path.join(self.path, key)
+		#Assemble the entry in a temporary directory first so concurrent builds never see a partial entry
+		tmp = entry + '.tmp{}'.format(os.getpid())
+		os.makedirs(tmp, exist_ok=True)
+		files = GENERATED_FILES + sorted(outputs)
+		for name in files:
+			shutil.copy(os.path.join(build_path, name), os.path.join(tmp, name))
+		with open(os.path.join(tmp, 'files.json'), 'w') as f:
+			json.dump(files, f)
+		with open(os.path.join(tmp, 'config.json'), 'w') as f:
+			json.dump(desc, f)
+		try:
+			os.rename(tmp, entry)
+		except OSError:
+			#Someone else stored the same build in the meantime
+			shutil.rmtree(tmp, ignore_errors=True)
+
+def _build_outputs(build_path, before):
+	"""Return the names of the files in build_path that are not generated sources and changed since before."""
+	return [name for name in os.listdir(build_path) if name not in GENERATED_FILES
+			and os.path.isfile(os.path.join(build_path, name))
+			and before.get(name) != os.stat(os.path.join(build_path, name)).st_mtime_ns]
+
 #FIXME possibly make a class out of this one
-#FIXME I think the target parameter is not used anywhere. Remove?
-def generate(desc, device, build_path, builddate, buildname=None, target = 'all', node_id=None):
+#target is the make target to build, or None to only generate the code
+#cache is an optional BuildCache that unchanged builds are restored from. Builds without a node_id get a random one
+#and are never cached, a restored build would give another device the same MAC.
+def generate(desc, device, build_path, builddate, buildname=None, target = 'all', node_id=None, cache=None):
 	members = desc["members"]
 	seqnum = 23 #module number (only used during build time to generate unique names)
 	current_id = 0
-	desc['builddate'] = str(builddate)
 	if buildname:
 		desc['name'] = buildname
+	#The device a build template is meant for (see build.py) is not part of the descriptor
+	desc.pop('device', None)
+	cached_build = cache is not None and node_id is not None
+	if cached_build:
+		#The key is taken before the build date is filled in, the firmware embeds it
+		key = cache.key(desc, device, build_path, target, node_id)
+		cached = cache.get(key, build_path)
+		if cached is not None:
+			desc.clear()
+			desc.update(cached)
+			print('\x1b[92;1mNode ID:\x1b[0m {:#016x} (cached)'.format(desc['node_id']))
+			return desc
+	desc['builddate'] = str(builddate)
 	node_id = node_id or random.randint(0, 2**64-2)
 	autocode = Template(autocode_header).render_unicode(version=desc["version"], builddate=builddate)
 	init_functions = []
 	loop_functions = []
 	callbacks = []
+	#(property, c variable name) of array module variables that get a ranged setter
+	ranged_setters = []
+	#(member name, property name, c expression of the variable's address or 0, size, custom getter id) of the properties
+	#returned by the snapshot callback
+	snapshot_vars = []
+	#(member name, property name) of the sources of change events, indexed by their source id
+	event_sources = []
+	#Whether there are any writable properties, which can be set using the multi-set callback
+	writable = False
 
 	def register_callback(name, argbuf="global_argbuf", argbuf_len="ARGBUF_SIZE"):
 		nonlocal current_id
@@ -163,7 +510,7 @@ def generate(desc, device, build_path, builddate, buildname=None, target = 'all'
 		functions = {}
 
 		#FIXME possibly swap the positions of ctype and fmt
-		def modulevar(name, ctype=None, fmt=None, array=False, callbacks=(0, 0)):
+		def modulevar(name, ctype=None, fmt=None, array=False, callbacks=(0, 0), ranged=True, snapshot=True):
 			"""Get the c name of a module variable and possibly register the variable with the code generator.
 
 				If only `name` is given, the autogenerated c name of the module variable will be returned.
@@ -185,7 +532,16 @@ def generate(desc, device, build_path, builddate, buildname=None, target = 'all'
 				argument buffer. You may also specify a tuple of the form `(cbname, buf, buflen)`
 				where `cbname` is the name of your callback and `buf` and `buflen` are the argument buffer and argument buffer length,
 				respectively.
+
+				Arrays using the default setter additionally get a ranged setter writing only part of the array unless
+				`ranged` is False. Its callback id and the maximum number of bytes per call are stored in the property's
+				"range" field.
+
+				Properties are also part of the node's snapshot (see the "snapshot" field of the build config) unless
+				`snapshot` is False. A custom getter must then always respond with exactly the property's size. Set
+				`snapshot` to False for getters that do not, e.g. stubs responding with no data.
 			"""
+			nonlocal writable
 			varname = "modvar_{}_{}_{}".format(mtype, seqnum, name)
 			if fmt is not None:
 				aval = 1
@@ -209,9 +565,16 @@ def generate(desc, device, build_path, builddate, buildname=None, target = 'all'
 						"size": struct.calcsize(fmt),
 						"id": accessor_callback(callbacks[0], 'get', 'generic_getter_callback'),
 						"fmt": fmt}
+				if snapshot and callbacks[0] == 0:
+					snapshot_vars.append((mname, name, ("" if array else "&")+varname, "sizeof("+varname+")", 0))
+				elif snapshot:
+					snapshot_vars.append((mname, name, "0", properties[name]["size"], properties[name]["id"]))
 
 				if callbacks[1] is not None:
+					writable = True
 					accessor_callback(callbacks[1], 'set', None)
+					if array and ranged and callbacks[1] == 0:
+						ranged_setters.append((properties[name], varname))
 				else:
 					#Save some space in the build config (that later gets burned into the µC's
 					#really small flash!) by only putting this here in case of read-only access
@@ -229,6 +592,16 @@ def generate(desc, device, build_path, builddate, buildname=None, target = 'all'
 
 			return varname
 
+		def event_source(name):
+			"""Get the source id to be passed to comm_push_event(source, index, value) for changes of property `name`.
+
+				Change events are queued on the device until the host drains them. index is the element index for array
+				properties and 0 otherwise.
+			"""
+			if (mname, name) not in event_sources:
+				event_sources.append((mname, name))
+			return event_sources.index((mname, name))
+
 		def module_callback(name, argformat="", retformat="", regname=None):
 			"""Register a regular module callback.
 
@@ -251,7 +624,7 @@ def generate(desc, device, build_path, builddate, buildname=None, target = 'all'
 
 		try:
 			#Flesh out the module template!
-			tp = Template(filename=typepath)
+			tp = Template(filename=typepath, module_directory=cache and cache.module_directory)
 			autocode += tp.render_unicode(
 					init_function=init_function,
 					loop_function=loop_function,
@@ -260,6 +633,7 @@ def generate(desc, device, build_path, builddate, buildname=None, target = 'all'
 					getter=lambda x: 'callback_get_'+modulevar(x),
 					module_callback=module_callback,
 					register_callback=register_callback,
+					event_source=event_source,
 					member=member,
 					device=device)
 		except:
@@ -279,27 +653,67 @@ def generate(desc, device, build_path, builddate, buildname=None, target = 'all'
 		#increment the module number
 		seqnum += 1
 
+	#Ranged setters are registered last so they do not shift the ids of the other callbacks
+	for prop, varname in ranged_setters:
+		prop['range'] = [register_callback('callback_setrange_'+varname), RANGED_WRITE_MAX]
+	#The snapshot callback's response contains the listed properties in this order. It is only built on request.
+	if not desc.pop('snapshot', False):
+		snapshot_vars = []
+	if snapshot_vars:
+		desc['snapshot'] = {'id': register_callback('callback_snapshot_auto'),
+				'properties': [[mname, name] for mname, name, *_ in snapshot_vars]}
+	#Build options only steer the code generator. They are popped so they do not take up flash in the descriptor.
+	event_queue_size = desc.pop('event_queue_size', EVENT_QUEUE_SIZE)
+	multiset_buffer_size = desc.pop('multiset_buffer_size', MULTISET_BUFFER_SIZE)
+	descriptor_format = desc.pop('descriptor_format', DESCRIPTOR_FORMAT)
+	if not 1 <= event_queue_size <= 255:
+		raise ValueError('event_queue_size must be between 1 and 255, not {}'.format(event_queue_size))
+	if event_sources:
+		desc['events'] = {'id': register_callback('callback_drain_events_auto'),
+				'sources': [[mname, name] for mname, name in event_sources]}
+	#The multi-set callback and its argument buffer are only built on request
+	multiset_size = multiset_buffer_size if desc.pop('multiset', False) and writable else 0
+	if multiset_size:
+		desc['multiset'] = {'id': register_callback('callback_multiset_auto', 'multiset_argbuf', 'sizeof(multiset_argbuf)'),
+				'size': multiset_size}
+	#Nodes can only join groups on request (see comm_callback_join_group in comm.c). Without a reference from the
+	#callback list, the linker drops the callback.
+	if desc.pop('groups', False):
+		desc['groups'] = {'id': register_callback('comm_callback_join_group')}
+	baudrates = supported_baudrates(device)
+	if baudrates:
+		desc['baudrates'] = baudrates
+
 	#finish the code generation and write the generated code to a file
-	autocode += Template(autocode_footer).render_unicode(init_functions=init_functions, loop_functions=loop_functions, callbacks=callbacks)
+	autocode += Template(autocode_footer).render_unicode(init_functions=init_functions, loop_functions=loop_functions, callbacks=callbacks,
+			ranged_setters=[varname for _, varname in ranged_setters], snapshot_vars=[var[2:] for var in snapshot_vars],
+			event_sources=event_sources, event_queue_size=event_queue_size, multiset_size=multiset_size)
 	with open(os.path.join(build_path, 'autocode.c'), 'w') as f:
 		f.write(autocode)
-	#compress the build config and write it out
-	#Depending on whether you want to store the device config as plain text or lzma'ed plain text comment out one of the following lines
-	#The first byte is used as a magic here. The first byte of a JSON string will always be a '{'
-	config = b'#' + lzma.compress(bytes(json.JSONEncoder(separators=(',',':')).encode(desc), 'utf-8'))
-	#config = bytes(json.JSONEncoder(separators=(',',':')).encode(desc), 'utf-8')
+	#encode the build config and write it out
+	config = encode_config(desc, descriptor_format)
+	#The fingerprint is returned by callback 0 when called with an argument. Its first byte is a magic, too.
+	fingerprint = b'=' + hashlib.sha1(config).digest()[:8]
 	with open(os.path.join(build_path, 'config.c'), 'w') as f:
-		f.write(Template(config_c_template).render_unicode(desc_len=len(config), desc=','.join(map(str, config))))
-	#compile the whole stuff
-	make_env = os.environ.copy()
-	make_env['MCU'] = device.get('mcu')
-	make_env['CLOCK'] = str(device.get('clock'))
-	make_env['CEREBRUM_BAUDRATE'] = str(device.get('cerebrum_baudrate'))
-	make_env['CONFIG_MAC'] = str(node_id) #0xFFFF,FFFF,FFFF,FFFF is reserved as discovery address
-	subprocess.check_call(['/usr/bin/env', 'make', '--no-print-directory', '-C', build_path, target], env=make_env)
+		f.write(Template(config_c_template).render_unicode(desc_len=len(config), desc=','.join(map(str, config)), fingerprint=','.join(map(str, fingerprint))))
+	#compile the whole stuff unless only the code is wanted
+	outputs = []
+	if target is not None:
+		before = {name: os.stat(os.path.join(build_path, name)).st_mtime_ns for name in os.listdir(build_path)}
+		make_env = os.environ.copy()
+		make_env['MCU'] = device.get('mcu')
+		make_env['CLOCK'] = str(device.get('clock'))
+		make_env['CEREBRUM_BAUDRATE'] = str(device.get('cerebrum_baudrate'))
+		make_env['CONFIG_MAC'] = str(node_id) #0xFFFF,FFFF,FFFF,FFFF is reserved as discovery address
+		subprocess.check_call(['/usr/bin/env', 'make', '--no-print-directory', '-C', build_path, target], env=make_env)
+		outputs = _build_outputs(build_path, before)
 
 	desc['node_id'] = node_id
+	#Used by hosts to seed their descriptor cache from the build config
+	desc['fingerprint'] = binascii.hexlify(fingerprint[1:]).decode()
 	print('\x1b[92;1mNode ID:\x1b[0m {:#016x}'.format(node_id))
+	if cached_build:
+		cache.put(key, build_path, outputs, desc)
 
 	return desc
 
@@ -320,14 +734,224 @@ class TestBuild(unittest.TestCase):
 	def test_basic_build(self):
 		generate({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-23 23:42:17', node_id=0x2342)
 
+	def test_cached_build(self):
+		with tempfile.TemporaryDirectory() as d:
+			cache = BuildCache(d)
+			desc = generate({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-23 23:42:17', node_id=0x2342, cache=cache)
+			os.remove(os.path.join('test', 'main'))
+			#An unchanged build is restored from the cache including the binary
+			self.assertEqual(generate({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-23 23:42:17', node_id=0x2342, cache=cache), desc)
+			self.assertTrue(os.path.isfile(os.path.join('test', 'main')), 'The cached build did not restore the binary')
+			#Later builds are restored with the first build's date
+			later = generate({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-24 00:00:00', node_id=0x2342, cache=cache)
+			self.assertEqual(later, desc, 'A later build was not restored from the cache')
+			#Builds with a random node id are never restored, each device needs its own MAC
+			first = generate({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-23 23:42:17', cache=cache)
+			later = generate({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-23 23:42:17', cache=cache)
+			self.assertNotEqual(later['node_id'], first['node_id'], 'Two builds with a random node id got the same one')
+			#So is the compiler
+			key = cache.key({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', 'all', 0x2342)
+			version = compiler_version('test')
+			try:
+				_compiler_versions['test'] = 'gcc (GCC) 2.95'
+				self.assertNotEqual(cache.key({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', 'all', 0x2342), key)
+			finally:
+				_compiler_versions['test'] = version
+			#Any change to the inputs results in a fresh build
+			self.assertNotEqual(cache.key({'members': {}, 'version': 0.17}, {'mcu': 'test'}, 'test', 'all', 0x2342),
+					cache.key({'members': {}, 'version': 0.18}, {'mcu': 'test'}, 'test', 'all', 0x2342))
+			self.assertEqual(len(os.listdir(d)), 2, 'A build was cached more than once')
+
+	def build_script(self, d, templates, *args):
+		"""Write the given build templates ({name: template}) and a test device into d and run build.py on them.
+
+		The build cache goes below d, too. Returns build.py's output and the build configs it wrote.
+
+		"""
+		here = os.path.dirname(os.path.abspath(__file__))
+		for name, template in dict(templates, device={'mcu': 'test'}).items():
+			with open(os.path.join(d, name+'.json'), 'w') as f:
+				json.dump(template, f)
+		#build.py keeps its cache below the home directory
+		out = subprocess.check_output([sys.executable, os.path.join(here, 'build.py')] + [arg.format(d) for arg in args],
+				env=dict(os.environ, HOME=d), universal_newlines=True)
+		buildconfigs = {}
+		for name in templates:
+			with open(os.path.join(here, 'builds', name+'.config.json')) as f:
+				buildconfigs[name] = json.load(f)
+			os.remove(f.name)
+		return out, buildconfigs
+
+	def test_build_script_cache(self):
+		with tempfile.TemporaryDirectory() as d:
+			templates = {'build_script_cache': {'type': 'test', 'node_id': '0x2342', 'members': {}, 'version': 0.17}}
+			out, _ = self.build_script(d, templates, '{}/build_script_cache.json', '{}/device.json', '-o', '{}/out')
+			self.assertNotIn('(cached)', out)
+			out, buildconfigs = self.build_script(d, templates, '{}/build_script_cache.json', '{}/device.json', '-o', '{}/out')
+			self.assertIn('(cached)', out, 'build.py did not restore an unchanged build from its cache')
+			self.assertEqual(buildconfigs['build_script_cache']['node_id'], 0x2342)
+			#Builds with a random node id always start from scratch
+			del templates['build_script_cache']['node_id']
+			for i in range(2):
+				out, _ = self.build_script(d, templates, '{}/build_script_cache.json', '{}/device.json', '-o', '{}/out')
+				self.assertNotIn('(cached)', out, 'build.py restored a build with a random node id from its cache')
+
+	def test_build_script_all(self):
+		with tempfile.TemporaryDirectory() as d:
+			templates = {'build_script_a': {'type': 'test', 'device': os.path.join(d, 'device.json'), 'node_id': 1, 'members': {}, 'version': 0.17},
+					'build_script_b': {'type': 'test', 'node_id': 2, 'members': {'test': {'type': 'test'}}, 'version': 0.17}}
+			out, buildconfigs = self.build_script(d, templates, '--all', '{}/build_script_a.json', '{}/build_script_b.json',
+					'-d', '{}/device.json', '-o', '{}/out', '-j', '2')
+			self.assertIn('2 builds in', out)
+			for name in templates:
+				self.assertTrue(os.path.isfile(os.path.join(d, 'out', name, 'test', 'main')), 'build.py --all did not build {}'.format(name))
+				self.assertNotIn('device', buildconfigs[name], 'The template\'s device ended up in the build config')
+			self.assertIn('test', buildconfigs['build_script_b']['members'])
+			#Batch builds go through the build cache, too
+			out, _ = self.build_script(d, templates, '--all', '{}/build_script_a.json', '{}/build_script_b.json', '-d', '{}/device.json', '-o', '{}/out')
+			self.assertEqual(out.count('(cached)'), 2, 'build.py --all did not restore unchanged builds from the cache')
+			#Templates of build types without a default device need one
+			with self.assertRaises(subprocess.CalledProcessError):
+				self.build_script(d, {'build_script_b': templates['build_script_b']}, '--all', '{}/build_script_b.json', '-o', '{}/out')
+
+	def test_out_of_tree_build(self):
+		with tempfile.TemporaryDirectory() as d:
+			build_paths = [out_of_tree('test', os.path.join(d, name)) for name in ('a', 'b')]
+			for build_path in build_paths:
+				generate({'members': {}, 'version': 0.17}, {'mcu': 'test'}, build_path, '2012-05-23 23:42:17', node_id=0x2342)
+				self.assertTrue(os.path.isfile(os.path.join(build_path, 'main')), 'The out-of-tree build did not produce a binary')
+
+	def check_build(self, config, device, toolchain, **overrides):
+		"""Generate the given config for the given device into a temporary directory and return the build config.
+
+		The firmware is also compiled if the given toolchain is installed. overrides are merged into the config's members.
+
+		"""
+		here = os.path.dirname(os.path.abspath(__file__))
+		with open(os.path.join(here, 'configs', config+'.json')) as f:
+			desc = json.load(f)
+		with open(os.path.join(here, 'devices', device+'.json')) as f:
+			device = json.load(f)
+		for mname, member in overrides.items():
+			desc['members'].setdefault(mname, {}).update(member)
+		with tempfile.TemporaryDirectory() as d:
+			build_path = out_of_tree(desc['type'], d)
+			return generate(desc, device, build_path, '2012-05-23 23:42:17', node_id=0x2342, target='all' if shutil.which(toolchain) else None)
+
+	def render(self, **options):
+		"""Generate the test firmware with the given top-level build config options and return the build config and code."""
+		with tempfile.TemporaryDirectory() as d:
+			build_path = out_of_tree('test', d)
+			desc = generate(dict({'members': {'test': {'type': 'test'}}, 'version': 0.17}, **options), {'mcu': 'test'}, build_path, '2012-05-23 23:42:17', target=None, node_id=0x2342)
+			with open(os.path.join(build_path, 'autocode.c')) as f:
+				return desc, f.read()
+
+	def test_snapshot_option(self):
+		desc, autocode = self.render()
+		self.assertNotIn('snapshot', desc)
+		self.assertNotIn('callback_snapshot_auto', autocode)
+		desc, autocode = self.render(snapshot=True)
+		self.assertEqual(desc['snapshot']['properties'], [['test', 'test_buffer']])
+		self.assertIn('callback_snapshot_auto', autocode)
+
+	def test_snapshot_custom_getter(self):
+		from pylibcerebrum.serial_mux import probe_request
+		with tempfile.TemporaryDirectory() as d:
+			build_path = out_of_tree('test', d)
+			#The custom getter answers with the variable plus two so the test can tell it was called
+			with open(os.path.join(build_path, 'snaptest.c.tp'), 'w') as f:
+				f.write('${modulevar("plain", "uint8_t", "B")} = 0x41;\n'
+						'${modulevar("custom", "uint8_t", "B", callbacks=(1, None))} = 0x41;\n'
+						'//${modulevar("stub", None, "B", callbacks=(2, None), snapshot=False)}\n'
+						'void callback_get_${modulevar("custom")}(const comm_callback_descriptor* cb, void* argbuf_end){\n'
+						'\tuart_putc(0);\n\tuart_putc(1);\n\tuart_putc(${modulevar("custom")}+2);\n}\n'
+						'void callback_get_${modulevar("stub")}(const comm_callback_descriptor* cb, void* argbuf_end){\n'
+						'\tuart_putc(0);\n\tuart_putc(0);\n}\n')
+			desc = generate({'members': {'snap': {'type': 'snaptest'}}, 'version': 0.17, 'snapshot': True}, {'mcu': 'test'}, build_path, '2012-05-23 23:42:17', node_id=0x2342)
+			self.assertEqual(desc['snapshot']['properties'], [['snap', 'plain'], ['snap', 'custom']])
+			frame = b'\\#\x00\x00' + struct.pack('>HH', desc['snapshot']['id'], 0)
+			out = subprocess.run([os.path.join(build_path, 'main')], input=probe_request(0x2342, 0, 0)+frame, stdout=subprocess.PIPE, check=True).stdout
+			#The probe response and the snapshot without the custom getter's own length header
+			self.assertEqual(out, b'\xFF\x00\x02\x41\x43')
+
+	def test_events_option(self):
+		#The event queue is only built if a member queues change events
+		desc, autocode = self.render()
+		self.assertNotIn('events', desc)
+		self.assertNotIn('event_queue', autocode)
+		desc = self.check_build('launchpad-test', 'ti-launchpad-msp430-g2553', 'msp430-gcc', button={'type': 'simple-io', 'port': 1, 'pin': 3})
+		self.assertNotIn('events', desc)
+
+	def test_multiset_option(self):
+		desc, autocode = self.render()
+		self.assertNotIn('multiset', desc)
+		self.assertNotIn('multiset_argbuf', autocode)
+		desc, autocode = self.render(multiset=True, multiset_buffer_size=32)
+		self.assertEqual(desc['multiset']['size'], 32)
+		self.assertIn('static uint8_t multiset_argbuf[32];', autocode)
+
+	def test_build_options(self):
+		#Options only steering the code generator are not burned into the descriptor
+		desc, autocode = self.render(event_queue_size=8, multiset=True, multiset_buffer_size=32, descriptor_format='json')
+		for option in ('event_queue_size', 'multiset_buffer_size', 'descriptor_format'):
+			self.assertNotIn(option, desc)
+		self.assertIn('static uint8_t multiset_argbuf[32];', autocode)
+
+	def test_descriptor_format(self):
+		from pylibcerebrum.ganglion import decode_config
+		desc = {'type': 'avr', 'members': {'led{}'.format(i): {'type': 'simple-io', 'port': 'B', 'pin': i} for i in range(8)}}
+		config = encode_config(desc, DESCRIPTOR_FORMAT)
+		self.assertEqual(config[:1], b'!')
+		self.assertEqual(decode_config(config), desc)
+		#Repetitive free-form values compress better with LZMA
+		desc['mapping'] = [[i % 3, [i % 5]] for i in range(200)]
+		self.assertEqual(encode_config(desc, 'auto')[:1], b'#')
+		#Strings containing NUL cannot be stored in the compact encoding
+		self.assertEqual(encode_config({'name': 'a\0b'}, 'auto')[:1], b'#')
+		self.assertRaises(ValueError, encode_config, desc, 'yaml')
+
+	def test_groups_option(self):
+		desc, autocode = self.render()
+		self.assertNotIn('groups', desc)
+		self.assertNotIn('comm_callback_join_group', autocode)
+		desc, autocode = self.render(groups=True)
+		self.assertIn('{{&comm_callback_join_group, (void*)global_argbuf, ARGBUF_SIZE}}, //{}'.format(desc['groups']['id']), autocode)
+
+	def test_oversample_avr(self):
+		desc = self.check_build('mainhall', 'arduino-uno', 'avr-gcc')
+		self.assertEqual(sorted(p for p in desc['members']['analog5']['properties'] if p.startswith('analog_')), ['analog_mean', 'analog_sum'])
+
+	def test_oversample_msp(self):
+		desc = self.check_build('launchpad-test', 'ti-launchpad-msp430-g2553', 'msp430-gcc', analog={'type': 'simple-io', 'port': 1, 'pin': 4, 'oversample': 64})
+		self.assertEqual(desc['members']['analog']['properties']['analog_mean']['fmt'], '<H')
+		self.assertRaises(ValueError, self.check_build, 'launchpad-test', 'ti-launchpad-msp430-g2553', 'msp430-gcc', analog={'type': 'simple-io', 'port': 1, 'pin': 4, 'oversample': 65})
+
+	def test_events_msp(self):
+		desc = self.check_build('launchpad-test', 'ti-launchpad-msp430-g2553', 'msp430-gcc', button={'type': 'simple-io', 'port': 1, 'pin': 3, 'events': True})
+		self.assertEqual(desc['events']['sources'], [['button', 'state']])
+		#Outputs do not change by themselves
+		desc = self.check_build('launchpad-test', 'ti-launchpad-msp430-g2553', 'msp430-gcc', button={'type': 'simple-io', 'port': 1, 'pin': 3, 'events': True, 'mode': 'output'})
+		self.assertNotIn('events', desc)
+
 class TestCommStuff(unittest.TestCase):
+	#Shared by all test cases so the test build is only compiled once
+	build_cache = None
+
+	@classmethod
+	def setUpClass(cls):
+		if TestCommStuff.build_cache is None:
+			TestCommStuff._build_cache_dir = tempfile.TemporaryDirectory()
+			TestCommStuff.build_cache = BuildCache(TestCommStuff._build_cache_dir.name)
 
 	def setUp(self):
-		generate({'members': {'test': {'type': 'test'}}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-23 23:42:17', node_id=0x2342)
+		generate({'members': {'test': {'type': 'test'}}, 'version': 0.17}, {'mcu': 'test'}, 'test', '2012-05-23 23:42:17', node_id=0x2342, cache=self.build_cache)
 
 	def new_test_process(self):
+		from pylibcerebrum.serial_mux import probe_request
 		#spawn a new communication test process
 		p = subprocess.Popen([os.path.join(os.path.dirname(__file__), 'test', 'main')], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		#The test build ignores all frames until a discovery probe assigned it a node address, 0 here. It answers with 0xFF.
+		p.stdin.write(probe_request(0x2342, 0, 0))
 
 		#start a thread killing that process after a few seconds
 		def kill_subprocess():
@@ -342,16 +966,20 @@ class TestCommStuff(unittest.TestCase):
 		return (p, p.stdin, p.stdout, t)
 
 	def test_config_descriptor(self):
+		from pylibcerebrum.ganglion import decode_config
 		(p, stdin, stdout, t) = self.new_test_process();
 
-		stdin.write(b'\\#\x23\x42\x00\x00\x00\x00')
+		stdin.write(b'\\#\x00\x00\x00\x00\x00\x00')
 		stdin.flush()
 		stdin.close()
 
+		self.assertEqual(stdout.read(1), b'\xFF', 'The test process did not answer the discovery probe')
 		(length,) = struct.unpack('>H', stdout.read(2))
 		#FIXME this fixed size comparision is *not* helpful.
 		#self.assertEqual(length, 227, 'Incorrect config descriptor length')
 		data = stdout.read(length)
+		self.assertEqual(len(data), length, 'The test process sent a truncated config descriptor')
+		self.assertEqual(sorted(decode_config(data)['members']['test']['functions']), ['check_test_buffer', 'test_callback', 'test_callback_long_args'])
 		#self.assertEqual(data, b']\x00\x00\x80\x00\x00=\x88\x8a\xc6\x94S\x90\x86\xa6c}%:\xbbAj\x14L\xd9\x1a\xae\x93n\r\x10\x83E1\xba]j\xdeG\xb1\xba\xa6[:\xa2\xb9\x8eR~#\xb9\x84%\xa0#q\x87\x17[\xd6\xcdA)J{\xab*\xf7\x96%\xff\xfa\x12g\x00', 'wrong config descriptor returned')
 		#Somehow, each time this is compiled, the json encode shuffles the fields of the object in another way. Thus it does not suffice to compare the plain strings.
 		#self.assert_(compareJSON(data, b'{"version":0.17,"builddate":"2012-05-23 23:42:17","members":{"test":{"functions":{"test_multipart":{"args":"65B","id":1},"check_test_buffer":{"id":4}},"type":"test","properties":{"test_buffer":{"size":65,"id":2,"fmt":"65B"}}}}}'), "The generated test program returns a wrong config descriptor: {}.".format(data))
@@ -360,19 +988,20 @@ class TestCommStuff(unittest.TestCase):
 	def test_multipart_call(self):
 		(p, stdin, stdout, t) = self.new_test_process();
 
-		stdin.write(b'\\#\x23\x42\x00\x01\x00\x41AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+		stdin.write(b'\\#\x00\x00\x00\x01\x00\x41AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
 		stdin.flush()
 		stdin.close()
 		
 		#wait for test process to terminate. If everything else fails, the timeout thread will kill it.
 		p.wait()
 		self.assertEqual(p.returncode, 0, "The test process caught an error from the c code. Please watch stderr for details.")
+		self.assertEqual(stdout.read(), b'\xFF', 'The test process sent a wrong response')
 
 	def test_meta_multipart_call(self):
 		"""Test whether the test function actually fails when given invalid data."""
 		(p, stdin, stdout, t) = self.new_test_process();
 
-		stdin.write(b'\\#\x23\x42\x00\x01\x00\x41AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAA')
+		stdin.write(b'\\#\x00\x00\x00\x01\x00\x41AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAA')
 		stdin.flush()
 		stdin.close()
 		
@@ -383,21 +1012,21 @@ class TestCommStuff(unittest.TestCase):
 	def test_multipart_call_long_args(self):
 		(p, stdin, stdout, t) = self.new_test_process();
 
-		stdin.write(b'\\#\x23\x42\x00\x05\x01\x01'+b'A'*257)
-		stdin.write(b'\\#\x23\x42\x00\x06\x00\x00')
+		stdin.write(b'\\#\x00\x00\x00\x05\x01\x01'+b'A'*257)
+		stdin.write(b'\\#\x00\x00\x00\x06\x00\x00')
 		stdin.flush()
 		stdin.close()
 		
 		#wait for test process to terminate. If everything else fails, the timeout thread will kill it.
 		p.wait()
 		self.assertEqual(p.returncode, 0, "The test process caught an error from the c code. Please watch stderr for details.")
-		self.assertEqual(p.returncode, 0, "The test process caught an error from the c code. Please watch stderr for details.")
+		self.assertEqual(stdout.read(), b'\xFF\x00\x00', 'The test process sent a wrong response')
 		
 	def test_meta_multipart_call_long_args(self):
 		"""Test whether the test function actually fails when given invalid data."""
 		(p, stdin, stdout, t) = self.new_test_process();
 
-		stdin.write(b'\\#\x23\x42\x00\x05\x01\x01'+b'A'*128+b'B'+b'A'*128)
+		stdin.write(b'\\#\x00\x00\x00\x05\x01\x01'+b'A'*128+b'B'+b'A'*128)
 		stdin.flush()
 		stdin.close()
 		
@@ -408,20 +1037,49 @@ class TestCommStuff(unittest.TestCase):
 	def test_attribute_accessors_multipart(self):
 		(p, stdin, stdout, t) = self.new_test_process();
 
-		stdin.write(b'\\#\x23\x42\x00\x03\x01\x01'+b'A'*32+b'B'*32+b'C'*32+b'D'*32+b'E'*32+b'F'*32+b'G'*32+b'H'*32+b'I') # write some characters to test_buffer
-		stdin.write(b'\\#\x23\x42\x00\x04\x00\x00') # call check_test_buffer
+		stdin.write(b'\\#\x00\x00\x00\x03\x01\x01'+b'A'*32+b'B'*32+b'C'*32+b'D'*32+b'E'*32+b'F'*32+b'G'*32+b'H'*32+b'I') # write some characters to test_buffer
+		stdin.write(b'\\#\x00\x00\x00\x04\x00\x00') # call check_test_buffer
 		stdin.flush()
 		stdin.close()
 		
 		#wait for test process to terminate. If everything else fails, the timeout thread will kill it.
 		p.wait()
 		self.assertEqual(p.returncode, 0, "The test process caught an error from the c code. Please watch stderr for details.")
+		self.assertEqual(stdout.read(), b'\xFF\x00\x00', 'The test process sent a wrong response')
+
+	def test_attribute_ranged_write(self):
+		(p, stdin, stdout, t) = self.new_test_process();
+
+		stdin.write(b'\\#\x00\x00\x00\x03\x01\x01'+b'A'*32+b'B'*8+b'XY'+b'B'*22+b'C'*32+b'D'*32+b'E'*32+b'F'*32+b'G'*32+b'H'*32+b'I') # write some characters to test_buffer
+		stdin.write(b'\\#\x00\x00\x00\x06\x00\x04\x00\x28BB') # fix the two wrong ones using the ranged setter
+		stdin.write(b'\\#\x00\x00\x00\x04\x00\x00') # call check_test_buffer
+		stdin.flush()
+		stdin.close()
+		
+		#wait for test process to terminate. If everything else fails, the timeout thread will kill it.
+		p.wait()
+		self.assertEqual(p.returncode, 0, "The test process caught an error from the c code. Please watch stderr for details.")
+		self.assertEqual(stdout.read(), b'\xFF\x00\x00\x00\x00', 'The test process sent a wrong response')
+
+	def test_meta_attribute_ranged_write(self):
+		"""Test whether the test function actually fails when the ranged setter writes to the wrong offset."""
+		(p, stdin, stdout, t) = self.new_test_process();
+
+		stdin.write(b'\\#\x00\x00\x00\x03\x01\x01'+b'A'*32+b'B'*8+b'XY'+b'B'*22+b'C'*32+b'D'*32+b'E'*32+b'F'*32+b'G'*32+b'H'*32+b'I') # write some characters to test_buffer
+		stdin.write(b'\\#\x00\x00\x00\x06\x00\x04\x00\x29BB') # fix the wrong ones off by one
+		stdin.write(b'\\#\x00\x00\x00\x04\x00\x00') # call check_test_buffer
+		stdin.flush()
+		stdin.close()
+
+		#wait for test process to terminate. If everything else fails, the timeout thread will kill it.
+		p.wait()
+		self.assertEqual(p.returncode, 1, "The test process did not catch an error it was supposed to catch from the c code. Please watch stderr for details.")
 
 	def test_meta_attribute_accessors_multipart(self):
 		(p, stdin, stdout, t) = self.new_test_process();
 
-		stdin.write(b'\\#\x23\x42\x00\x03\x01\x01'+b'A'*33+b'B'*31+b'C'*32+b'D'*32+b'E'*32+b'F'*32+b'G'*32+b'H'*32+b'I') # write some characters to test_buffer
-		stdin.write(b'\\#\x23\x42\x00\x04\x00\x00') # call check_test_buffer
+		stdin.write(b'\\#\x00\x00\x00\x03\x01\x01'+b'A'*33+b'B'*31+b'C'*32+b'D'*32+b'E'*32+b'F'*32+b'G'*32+b'H'*32+b'I') # write some characters to test_buffer
+		stdin.write(b'\\#\x00\x00\x00\x04\x00\x00') # call check_test_buffer
 		stdin.flush()
 		stdin.close()
 		
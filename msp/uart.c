@@ -47,6 +47,26 @@ void uart_init(void)
   	IE2 |= UCA0RXIE;                          // Enable USCI_A0 RX interrupt
 }
 
+uint8_t uart_set_baudrate(uint32_t baudrate)
+{
+	//Clock prescaler and modulation for SMCLK at 16MHz like above
+	uint16_t br = 16000000/baudrate;
+	if(br < 16)
+		return 0;
+	//Rounded fractional part of the prescaler in eighths
+	uint8_t brs = (256000000/baudrate + 1)/2 - 8*(uint32_t)br;
+	if(brs > 7)
+		brs = 7;
+	while(UCA0STAT & UCBUSY);
+	UCA0CTL1 |= UCSWRST;
+	UCA0BR0 = br & 0xFF;
+	UCA0BR1 = br >> 8;
+	UCA0MCTL = brs << 1;
+	UCA0CTL1 &= ~UCSWRST;
+	IE2 |= UCA0RXIE;                          // Resetting the USCI cleared this
+	return 1;
+}
+
 int uart_getc()
 {
     if(!(IFG2&UCA0RXIFG))
@@ -80,6 +100,8 @@ unsigned char uart_try_putc(unsigned char c){
 
 void uart_putc(unsigned char c)
 {
+	if(comm_discard())
+		return;
 	while (!(IFG2&UCA0TXIFG));              // USCI_A0 TX buffer ready?
   	UCA0TXBUF = c;                    		// TX
 }
@@ -1,23 +1,43 @@
-
 def callback_method(func):
 	def notify(self,*args,**kwargs):
 		rv = func(self,*args,**kwargs)
 		for callback in self.callbacks:
-			callback(self)
+			callback(self, 0, len(self))
 		return rv
 	return notify
 
 #XXX due to lack of proper slice handling, this will *not* work with python < 3.0
 class NotifyList(list):
+	"""List calling its callbacks with (list, start, stop) after each modification, start:stop being the changed range.
+
+	Only item and slice assignments that do not change the list's length report a partial range. All other
+	modifications report the whole list.
+
+	"""
 	extend = callback_method(list.extend)
 	append = callback_method(list.append)
 	remove = callback_method(list.remove)
 	pop = callback_method(list.pop)
 	__delitem__ = callback_method(list.__delitem__)
-	__setitem__ = callback_method(list.__setitem__)
 	__iadd__ = callback_method(list.__iadd__)
 	__imul__ = callback_method(list.__imul__)
 
+	def __setitem__(self,item,value):
+		oldlen = len(self)
+		list.__setitem__(self,item,value)
+		if len(self) != oldlen:
+			start, stop = 0, len(self)
+		elif isinstance(item,slice):
+			indices = range(*item.indices(oldlen))
+			if not indices:
+				return
+			start, stop = min(indices), max(indices)+1
+		else:
+			start = item if item >= 0 else item+oldlen
+			stop = start+1
+		for callback in self.callbacks:
+			callback(self, start, stop)
+
 	def __getitem__(self,item):
 		if isinstance(item,slice):
 			return self.__class__(list.__getitem__(self,item))
@@ -27,4 +47,3 @@ class NotifyList(list):
 	def __init__(self,*args,callbacks=[]):
 		list.__init__(self,*args)
 		self.callbacks = callbacks
-
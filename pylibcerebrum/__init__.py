@@ -1,3 +1,3 @@
 
-__all__ = ["ganglion", "serial_mux"]
+__all__ = ["ganglion", "serial_mux", "async_mux", "descriptor_cache", "shadow", "adaptive_timeout", "bus_map", "bus_manager", "broker", "state_mirror", "poll_scheduler"]
 
@@ -0,0 +1,75 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+"""Per-request timeouts derived from the line speed and the observed latency of each node."""
+
+#Latency assumed for nodes and buses nothing has been observed on yet
+INITIAL_LATENCY = 0.05
+#Lower bound of any timeout, covering the scheduling jitter of the host
+MIN_TIMEOUT = 0.01
+#Time allowed for gaps between the bytes of a response on top of its transmission time
+PAYLOAD_SLACK = 0.05
+
+class AdaptiveTimeout(object):
+	"""Timeout estimator for the requests on one bus
+
+	The time until the length prefix of a response arrives is the time it takes to transmit the request and the prefix
+	at the bus' baud rate (10 bits per byte including start and stop bit) plus the node's latency, i.e. the time the
+	node takes to come up with an answer. The latency is tracked per node as an exponentially weighted moving average
+	along with its mean deviation, in the same way TCP estimates its retransmission timeout. The timeout is the
+	transmission time plus the average latency plus four times its deviation, clamped to [MIN_TIMEOUT, ceiling].
+
+	Nodes nothing has been observed on start out with the latency of the bus as a whole, so missing nodes fail fast
+	once the bus has answered a few requests. After a timeout, a node's deviation is doubled so retries wait longer.
+
+	The time allowed for the payload of a response is computed from its length once the length prefix arrived, so
+	large responses do not time out at slow baud rates.
+
+	"""
+
+	def __init__(self, baudrate, ceiling=1, alpha=1/8, beta=1/4, k=4):
+		self.bytetime = 10/baudrate
+		self.ceiling = ceiling
+		self.alpha = alpha
+		self.beta = beta
+		self.k = k
+		#[average latency, mean deviation] by node address, the entry for None covering the whole bus
+		self.latencies = {None: [INITIAL_LATENCY, INITIAL_LATENCY/2]}
+
+	def _estimate(self, node_id):
+		est = self.latencies.get(node_id)
+		if est is None:
+			est = self.latencies[node_id] = list(self.latencies[None])
+		return est
+
+	def timeout(self, node_id, nbytes, ceiling=None):
+		"""Return the time to wait for the length prefix of a response after sending a request.
+
+		nbytes is the number of bytes sent and received up to and including the length prefix. A node_id of None
+		refers to the bus as a whole, e.g. for discovery probes.
+
+		"""
+		avg, dev = self._estimate(node_id)
+		return min(max(nbytes*self.bytetime + avg + self.k*dev, MIN_TIMEOUT), ceiling or self.ceiling)
+
+	def payload(self, clen):
+		"""Return the time to wait for a response payload of clen bytes after its length prefix arrived."""
+		return PAYLOAD_SLACK + clen*self.bytetime
+
+	def observe(self, node_id, elapsed, nbytes):
+		"""Feed the time a successful request took into the node's and the bus' latency estimates."""
+		latency = max(elapsed - nbytes*self.bytetime, 0)
+		ests = [self.latencies[None]]
+		if node_id is not None:
+			ests.append(self._estimate(node_id))
+		for est in ests:
+			est[1] += self.beta*(abs(latency - est[0]) - est[1])
+			est[0] += self.alpha*(latency - est[0])
+
+	def backoff(self, node_id):
+		"""Wait longer for the next response of a node that just timed out."""
+		est = self._estimate(node_id)
+		est[1] = min(est[1]*2, self.ceiling)
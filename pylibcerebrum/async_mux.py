@@ -0,0 +1,303 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import os
+import asyncio
+import serial
+from pylibcerebrum.ganglion import Ganglion, CallPlan, FramingError, LENGTH, decode_config, decode_fingerprint
+from pylibcerebrum.adaptive_timeout import AdaptiveTimeout
+from pylibcerebrum.serial_mux import MAC_LEN, PROBE_TIMEOUT, RETRIES, RESYNC_QUIET, RESYNC_LIMIT, probe_request, discovery
+from pylibcerebrum.timeout_exception import TimeoutException
+
+"""asyncio flavour of the serial bus multiplexer and the Ganglion proxy."""
+
+class AsyncSerialMux(object):
+	"""Bus multiplexer reading and writing the tty through the asyncio event loop
+
+	Requests are sent one at a time in the order they were issued. Since asyncio.Lock wakes up its waiters in FIFO
+	order, concurrent tasks talking to the same bus are served in the order of their calls.
+
+	The mux must be created from within a running event loop.
+
+	"""
+
+	def __init__(self, device=None, baudrate=115200, ser=None, timeout=1, cache=None, retries=RETRIES, adaptive=True):
+		s = ser or serial.Serial(port=device, baudrate=baudrate, timeout=0)
+		#See SerialMux
+		s.setXonXoff(True)
+		s.setXonXoff(False)
+		#Reset Arduinos
+		s.setDTR(True)
+		s.setDTR(False)
+		self.ser = s
+		self.timeout = timeout
+		self.cache = cache
+		self.retries = retries
+		self.resyncs = 0
+		self.timeouts = AdaptiveTimeout(baudrate, ceiling=timeout) if adaptive else None
+		#See LockableSerial.resync
+		self.quiet = max(RESYNC_QUIET, 100/baudrate)
+		self.loop = asyncio.get_running_loop()
+		self.lock = asyncio.Lock()
+		self.buf = bytearray()
+		self.waiter = None
+		self.fd = s.fileno()
+		os.set_blocking(self.fd, False)
+		self.loop.add_reader(self.fd, self._data_received)
+
+	def _data_received(self):
+		try:
+			data = os.read(self.fd, 4096)
+		except BlockingIOError:
+			return
+		self.buf += data
+		if self.waiter is not None and not self.waiter.done():
+			self.waiter.set_result(None)
+
+	async def _read(self, n, timeout=None):
+		"""Read n bytes from the bus and raise a TimeoutException in case of a timeout."""
+		deadline = self.loop.time() + (timeout or self.timeout)
+		while len(self.buf) < n:
+			self.waiter = self.loop.create_future()
+			try:
+				await asyncio.wait_for(self.waiter, max(deadline - self.loop.time(), 0))
+			except asyncio.TimeoutError:
+				raise TimeoutException('Read {} bytes trying to read {}'.format(len(self.buf), n))
+			finally:
+				self.waiter = None
+		data = bytes(self.buf[:n])
+		del self.buf[:n]
+		return data
+
+	async def _read_response(self, node_id, reqlen):
+		"""Read a response and return its payload (see ganglion.read_response)."""
+		if self.timeouts is None:
+			(clen,) = LENGTH.unpack(await self._read(2))
+			return await self._read(clen)
+		nbytes = reqlen + LENGTH.size
+		start = self.loop.time()
+		try:
+			(clen,) = LENGTH.unpack(await self._read(2, self.timeouts.timeout(node_id, nbytes)))
+		except TimeoutException:
+			self.timeouts.backoff(node_id)
+			raise
+		self.timeouts.observe(node_id, self.loop.time()-start, nbytes)
+		return await self._read(clen, self.timeouts.payload(clen))
+
+	async def _write(self, data):
+		data = memoryview(data)
+		while data:
+			try:
+				data = data[os.write(self.fd, data):]
+			except BlockingIOError:
+				pass
+			if data:
+				writable = self.loop.create_future()
+				self.loop.add_writer(self.fd, writable.set_result, None)
+				try:
+					await writable
+				finally:
+					self.loop.remove_writer(self.fd)
+
+	async def _resync(self):
+		"""Discard everything received until the line is quiet (see LockableSerial.resync)."""
+		self.resyncs += 1
+		deadline = self.loop.time() + RESYNC_LIMIT
+		while True:
+			self.buf.clear()
+			await asyncio.sleep(self.quiet)
+			if not self.buf or self.loop.time() > deadline:
+				break
+
+	async def call(self, request, plan):
+		"""Send an encoded request and read back the responses according to the given CallPlan.
+
+		The plan's responses attribute tells how many responses to read. The return value is the last one's decoded
+		payload, or None if the request gets no response. Like Ganglion._sendrequest, this resynchronizes after a
+		timeout or framing error and resends idempotent calls.
+
+		"""
+		async with self.lock:
+			retries = self.retries if plan.idempotent else 0
+			while True:
+				await self._write(request)
+				try:
+					rv = None
+					for i in range(plan.responses):
+						rv = plan.response(await self._read_response(plan.node_id, len(request) if i == 0 else 0))
+					return rv
+				except (TimeoutException, FramingError):
+					await self._resync()
+					if retries <= 0:
+						raise
+					retries -= 1
+
+	async def open(self, node_id, shadow=None):
+		""" Open an AsyncGanglion by node ID, optionally using a ShadowCache """
+		return AsyncGanglion(node_id, jsonconfig=await self._read_config(node_id), ser=self, shadow=shadow)
+
+	async def _read_config(self, node_id):
+		"""Fetch the device configuration descriptor from the device."""
+		i=0
+		while True:
+			try:
+				async with self.lock:
+					if self.cache is not None:
+						#See Ganglion._read_config
+						request = CallPlan(node_id, 0, 'B').request((1,))
+						await self._write(request)
+						cbytes = await self._read_response(node_id, len(request))
+						fingerprint = decode_fingerprint(cbytes)
+						if fingerprint is None:
+							return decode_config(cbytes)
+						jsonconfig = self.cache.get(fingerprint)
+						if jsonconfig is not None:
+							return jsonconfig
+					request = CallPlan(node_id, 0).header
+					await self._write(request)
+					jsonconfig = decode_config(await self._read_response(node_id, len(request)))
+					if self.cache is not None:
+						self.cache.put(fingerprint, jsonconfig)
+					return jsonconfig
+			except TimeoutException as e:
+				print('Timeout', e)
+			except ValueError as e:
+				print('That device threw some nasty ValueError\'ing JSON!', e)
+			i += 1
+			if i > 20:
+				raise serial.serialutil.SerialException('Could not connect, giving up after 20 tries')
+			async with self.lock:
+				await self._resync()
+
+	async def discover(self, known=(), search=True):
+		""" Discover all nodes connected to the bus (see SerialMux.discover) """
+		start = self.loop.time()
+		stats = {}
+		probes = discovery(known, search, stats)
+		try:
+			probe = next(probes)
+			while True:
+				probe = probes.send(await self._send_probe(*probe))
+		except StopIteration as e:
+			found = e.value
+		stats['time'] = self.loop.time() - start
+		self.discovery_stats = stats
+		return found
+
+	async def _send_probe(self, mac, mask, next_address):
+		async with self.lock:
+			request = probe_request(mac, mask, next_address)
+			await self._write(request)
+			if self.timeouts is None:
+				timeout = PROBE_TIMEOUT
+			else:
+				#See SerialMux._send_probe
+				timeout = self.timeouts.timeout(None, len(request)+1, PROBE_TIMEOUT)
+			start = self.loop.time()
+			try:
+				await self._read(1, timeout)
+			except TimeoutException:
+				return False
+			if self.timeouts is not None:
+				self.timeouts.observe(None, self.loop.time()-start, len(request)+1)
+			return True
+
+	def close(self):
+		self.loop.remove_reader(self.fd)
+		self.ser.close()
+
+class AsyncGanglion(Ganglion):
+	"""Ganglion talking to its device through an AsyncSerialMux
+
+	Functions and property reads return awaitables, e.g. ``await g.foo.callback(1)`` or ``await g.foo.prop``. Since
+	an assignment cannot be awaited, properties are written using ``await g.foo.set('prop', value)``. The other methods
+	talking to the device, e.g. snapshot, are awaited as well. Use AsyncSerialMux.open to create one.
+
+	"""
+
+	def _sendrequest(self, plan, request):
+		"""Return an awaitable sending an encoded request through the mux and reading back its response."""
+		return self._ser.call(request, plan)
+
+	async def get(self, name):
+		"""Read a property, possibly from the shadow copy if there is a ShadowCache."""
+		getplan, setplan = self._callplans[name]
+		if self._shadow is None:
+			return await self._callplan(getplan, ())
+		key = (self.node_id, getplan.fid)
+		payload = self._shadow.lookup(key, name, '{}.{}'.format(self.name, name))
+		if payload is not None:
+			return getplan.response(payload)
+		rv = await self._callplan(getplan, ())
+		self._shadow.update(key, getplan.retstruct.pack(*(rv if isinstance(rv, list) else [rv])), False)
+		return rv
+
+	async def set(self, name, value):
+		"""Write a property, checking the shadow copy if there is a ShadowCache."""
+		getplan, setplan = self._callplans[name]
+		if setplan is None:
+			raise TypeError("{} is a read-only property".format(name))
+		if self._shadow is None:
+			return await self._callplan(setplan, value)
+		if not (isinstance(value, tuple) or isinstance(value, list)):
+			value = [value]
+		payload = setplan.argstruct.pack(*value)
+		key = (self.node_id, getplan.fid)
+		if self._shadow.suppress(key, payload):
+			return None
+		rv = await self._sendrequest(setplan, setplan.frame(payload))
+		self._shadow.update(key, payload, True)
+		return rv
+
+	async def set_many(self, items):
+		"""Write several properties given as (path, value) pairs (see Ganglion.set_many).
+
+		Firmware without multi-set support gets one call per property.
+
+		"""
+		if self._multisetplan is None:
+			for path, value in items:
+				node, name = self._resolve(path)
+				await node.set(name, value)
+			return
+		records, shadowed = self._multisetrecords(items)
+		for request, retplan in self._multisetplan.requests(records):
+			await self._sendrequest(retplan, request)
+		for shadow, key, payload in shadowed:
+			shadow.update(key, payload, True)
+
+	async def update(self, values):
+		"""Write the properties given as a dict mapping paths to values (see set_many)."""
+		await self.set_many(values.items())
+
+	async def join_group(self, address):
+		"""Make the node process frames sent to the given group address (see Ganglion.join_group)."""
+		if self._groupplan is None:
+			raise AttributeError('This node does not support groups')
+		return bool(await self._callplan(self._groupplan, (address, 1)))
+
+	async def leave_group(self, address):
+		"""Make the node ignore frames sent to the given group address again."""
+		if self._groupplan is None:
+			raise AttributeError('This node does not support groups')
+		return bool(await self._callplan(self._groupplan, (address, 0)))
+
+	@property
+	def batch(self):
+		#Batches pipeline the calls of one thread on a LockableSerial. AsyncSerialMux queues those of concurrent tasks instead.
+		raise AttributeError('AsyncGanglion has no batch, issue calls concurrently using asyncio.gather instead')
+
+	def __setattr__(self, name, value):
+		if name in self.properties:
+			raise TypeError("Properties of an AsyncGanglion are written using \"await ganglion.set({!r}, value)\"".format(name))
+		self.__dict__[name] = value
+
+	def __getattr__(self, name):
+		if name in self.members:
+			return self.members[name]
+		if name in self.properties:
+			return self.get(name)
+		return super(AsyncGanglion, self).__getattr__(name)
@@ -0,0 +1,475 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import os
+import json
+import struct
+import socket
+import argparse
+import threading
+import itertools
+from collections import OrderedDict, deque
+from serial.serialutil import SerialException
+from pylibcerebrum.ganglion import Ganglion, read_config, read_response
+from pylibcerebrum.serial_mux import RETRIES, GROUP_ADDRESS_FIRST, GROUP_ADDRESS_LAST, BROADCAST_ADDRESS, BAUDRATE_ADDRESS
+from pylibcerebrum.bus_manager import BusManager
+from pylibcerebrum.descriptor_cache import DescriptorCache
+from pylibcerebrum.timeout_exception import TimeoutException
+
+"""Broker daemon owning the serial ports, and its client.
+
+Clients talk to the broker over a Unix stream socket. Each request carries a header of a message type byte, a request
+id and a payload length (big-endian, see REQUEST) followed by the payload. The broker answers with the request id, a
+status byte and a payload length (see RESPONSE) followed by the payload. Responses to the requests of one client may
+arrive out of order.
+
+MSG_CALL       -- payload: bus index byte, one escaped Cerebrum request frame. Answered with the raw Cerebrum response
+                  including its length prefix. Malformed frames and frames to the discovery or baud rate addresses
+                  are answered with STATUS_ERROR. Calls of a node's multi-set callback are answered with the concatenation
+                  of the responses to all of their records. Calls sent to group or broadcast addresses get no
+                  response on the bus and are answered with an empty payload as soon as they were sent.
+MSG_LIST       -- no payload. Answered with a JSON object {"buses": [bus names], "nodes": {bus name: [[MAC, node
+                  address, name]]}}.
+MSG_DESCRIPTOR -- payload: bus index byte, big-endian node address. Answered with the node's JSON descriptor.
+"""
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'cerebrum.sock')
+
+REQUEST = struct.Struct('>BHH')
+RESPONSE = struct.Struct('>HBH')
+
+MSG_CALL = 1
+MSG_LIST = 2
+MSG_DESCRIPTOR = 3
+
+STATUS_OK = 0
+STATUS_TIMEOUT = 1
+STATUS_ERROR = 2
+
+def recv_exactly(sock, n):
+	"""Receive exactly n bytes from a stream socket, raising EOFError if it is closed before."""
+	buf = bytearray(n)
+	view = memoryview(buf)
+	while view:
+		received = sock.recv_into(view)
+		if not received:
+			raise EOFError()
+		view = view[received:]
+	return bytes(buf)
+
+def silent(node_id):
+	"""Tell whether the nodes do not respond to frames sent to the given address, i.e. a group or broadcast address."""
+	return node_id == BROADCAST_ADDRESS or GROUP_ADDRESS_FIRST <= node_id <= GROUP_ADDRESS_LAST
+
+def frame_address(frame):
+	"""Return the node address of an escaped request frame."""
+	#The node address is the first header field. Unescaping four bytes yields at least its two bytes.
+	return struct.unpack_from('>H', frame[2:6].replace(b'\\\\', b'\\'))[0]
+
+def multiset_records(payload):
+	"""Return the number of records in the (unescaped) argument of a multi-set call (see MultiSetPlan)."""
+	count, i = 0, 0
+	while i+3 <= len(payload):
+		i += 3 + payload[i+2]
+		count += 1
+	return count
+
+def split_frames(data):
+	"""Split a concatenation of escaped request frames, e.g. a batch, into single frames."""
+	frames = []
+	i = 0
+	while i < len(data):
+		if data[i:i+2] != b'\\#':
+			raise ValueError('Garbage between request frames')
+		j = i+2
+		header = bytearray()
+		while len(header) < 6:
+			header.append(data[j])
+			#An escaped backslash takes two bytes
+			j += 2 if data[j] == 0x5C else 1
+		node_id, fid, arglen = struct.unpack('>HHH', header)
+		if node_id == 0xFFFF:
+			raise ValueError('Discovery is up to the broker')
+		for k in range(arglen):
+			j += 2 if data[j] == 0x5C else 1
+		frames.append(data[i:j])
+		i = j
+	return frames
+
+def check_frame(frame):
+	"""Raise a ValueError unless frame is exactly one well-formed request frame a client may send.
+
+	Discovery and baud rate switches concern the whole bus and are up to the broker.
+
+	"""
+	try:
+		frames = split_frames(frame)
+	except IndexError:
+		raise ValueError('Truncated request frame')
+	if len(frames) != 1:
+		raise ValueError('Expected exactly one request frame')
+	if frame_address(frame) == BAUDRATE_ADDRESS:
+		raise ValueError('Baud rate switches are up to the broker')
+
+class ClientConnection(object):
+	"""Broker side of a client connection"""
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.lock = threading.Lock()
+
+	def send(self, rid, status, payload):
+		with self.lock:
+			try:
+				self.sock.sendall(RESPONSE.pack(rid, status, len(payload)) + payload)
+			except OSError:
+				#The client went away, its reader thread cleans up
+				pass
+
+class BusScheduler(threading.Thread):
+	"""Worker thread executing the calls of all clients on one bus
+
+	Each client has its own queue. The scheduler takes one call from each client with calls pending in turn, so a
+	client sending large batches cannot starve the others.
+
+	"""
+
+	def __init__(self, mux, multiset=None):
+		"""multiset maps node addresses to the function ids of the nodes' multi-set callbacks."""
+		super(BusScheduler, self).__init__(daemon=True)
+		self.mux = mux
+		self.multiset = multiset or {}
+		self.queues = OrderedDict()
+		self.cond = threading.Condition()
+		self.stopped = False
+
+	def put(self, client, rid, frame):
+		with self.cond:
+			self.queues.setdefault(client, deque()).append((rid, frame))
+			self.cond.notify()
+
+	def drop(self, client):
+		"""Forget the pending calls of a client that disconnected."""
+		with self.cond:
+			self.queues.pop(client, None)
+
+	def stop(self):
+		with self.cond:
+			self.stopped = True
+			self.cond.notify()
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.queues and not self.stopped:
+					self.cond.wait()
+				if self.stopped:
+					return
+				client, queue = self.queues.popitem(last=False)
+				rid, frame = queue.popleft()
+				if queue:
+					#Back to the end of the line
+					self.queues[client] = queue
+			try:
+				status, payload = self.call(frame)
+			except Exception as e:
+				#Whatever goes wrong only concerns the client of this call, the bus stays in service for the others
+				status, payload = STATUS_ERROR, 'Call failed: {!r}'.format(e).encode()
+			client.send(rid, status, payload)
+
+	def call(self, frame):
+		"""Send one request frame on the bus and return the status and payload of the response(s)."""
+		body = frame[2:].replace(b'\\\\', b'\\')
+		if len(body) < 6:
+			return STATUS_ERROR, b'Truncated request frame'
+		node_id, fid = struct.unpack_from('>HH', body)
+		#A multi-set call gets one response per record
+		count = multiset_records(body[6:]) if self.multiset.get(node_id) == fid else 1
+		with self.mux.ser as s:
+			s.write(frame)
+			if silent(node_id):
+				return STATUS_OK, b''
+			try:
+				timeouts = getattr(s, 'timeouts', None)
+				responses = []
+				for i in range(count):
+					cbytes = read_response(s, node_id, len(frame) if i == 0 else 0, timeouts)
+					responses.append(struct.pack('>H', len(cbytes)) + cbytes)
+				return STATUS_OK, b''.join(responses)
+			except TimeoutException as e:
+				if hasattr(s, 'resync'):
+					s.resync()
+				return STATUS_TIMEOUT, str(e).encode()
+			except SerialException as e:
+				return STATUS_ERROR, str(e).encode()
+
+class Broker(object):
+	"""Daemon owning the buses of a BusManager and serving calls to local clients over a Unix socket
+
+	The buses are discovered and the descriptors of all nodes are fetched once at startup, so attaching a client
+	neither resets the nodes nor transfers any descriptor over the bus.
+
+	"""
+
+	def __init__(self, manager, path=DEFAULT_SOCKET):
+		self.manager = manager
+		self.path = path
+		self.names = sorted(manager.buses)
+		self.schedulers = [BusScheduler(manager.buses[name]) for name in self.names]
+		#{(bus index, node address): JSON descriptor}
+		self.descriptors = {}
+		self.nodes = {}
+		self.sock = None
+
+	def start(self):
+		"""Discover the buses, fetch all descriptors and start serving in the background."""
+		self.manager.discover()
+		descs = self.manager.run(lambda name, mux: [(mac, address, read_config(mux.ser, address, mux.cache))
+				for mac, address in self.manager.discovered[name]])
+		for i, name in enumerate(self.names):
+			self.nodes[name] = [[mac, address, desc.get('name')] for mac, address, desc in descs[name]]
+			for mac, address, desc in descs[name]:
+				self.descriptors[(i, address)] = json.dumps(desc, separators=(',',':')).encode()
+				if 'multiset' in desc:
+					self.schedulers[i].multiset[address] = desc['multiset']['id']
+		for scheduler in self.schedulers:
+			scheduler.start()
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.bind(self.path)
+		self.sock.listen()
+		threading.Thread(target=self._accept, daemon=True).start()
+
+	def serve_forever(self):
+		self.start()
+		threading.Event().wait()
+
+	def _accept(self):
+		while True:
+			try:
+				conn, _ = self.sock.accept()
+			except OSError:
+				return
+			threading.Thread(target=self._serve, args=(ClientConnection(conn),), daemon=True).start()
+
+	def _serve(self, client):
+		try:
+			while True:
+				mtype, rid, length = REQUEST.unpack(recv_exactly(client.sock, REQUEST.size))
+				payload = recv_exactly(client.sock, length)
+				if mtype == MSG_CALL and payload and payload[0] < len(self.schedulers):
+					try:
+						check_frame(payload[1:])
+					except ValueError as e:
+						client.send(rid, STATUS_ERROR, str(e).encode())
+						continue
+					self.schedulers[payload[0]].put(client, rid, payload[1:])
+				elif mtype == MSG_LIST:
+					client.send(rid, STATUS_OK, json.dumps({'buses': self.names, 'nodes': self.nodes}).encode())
+				elif mtype == MSG_DESCRIPTOR and len(payload) == 3 and struct.unpack('>BH', payload) in self.descriptors:
+					client.send(rid, STATUS_OK, self.descriptors[struct.unpack('>BH', payload)])
+				else:
+					client.send(rid, STATUS_ERROR, b'Invalid request')
+		except (EOFError, OSError):
+			pass
+		finally:
+			for scheduler in self.schedulers:
+				scheduler.drop(client)
+			client.sock.close()
+
+	def close(self):
+		for scheduler in self.schedulers:
+			scheduler.stop()
+		if self.sock is not None:
+			self.sock.close()
+			os.unlink(self.path)
+
+class BrokerClient(object):
+	"""Connection to a Broker, multiplexing the requests of any number of threads and ganglions"""
+
+	def __init__(self, path=DEFAULT_SOCKET, timeout=5):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(path)
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.ids = itertools.count()
+		#{request id: [event, status, payload]}
+		self.pending = {}
+		#Ids of discarded requests the broker has not answered yet. These are not reused until it has.
+		self.orphans = set()
+		self.lost = False
+		self.buses = None
+		threading.Thread(target=self._receive, daemon=True).start()
+
+	def _receive(self):
+		try:
+			while True:
+				rid, status, length = RESPONSE.unpack(recv_exactly(self.sock, RESPONSE.size))
+				payload = recv_exactly(self.sock, length)
+				with self.lock:
+					entry = self.pending.get(rid)
+					#Responses to discarded requests are dropped
+					if entry is None:
+						self.orphans.discard(rid)
+					else:
+						entry[1:] = status, payload
+						entry[0].set()
+		except (EOFError, OSError):
+			#Wake up everybody still waiting. Their entries keep a status of None.
+			with self.lock:
+				self.lost = True
+				entries, self.pending = self.pending, {}
+			for entry in entries.values():
+				entry[0].set()
+
+	def request(self, mtype, payload=b''):
+		"""Send a request and return its id to wait for the response with.
+
+		Request ids wrap around at 0xFFFF. Ids of requests the broker has not answered yet are skipped.
+
+		"""
+		with self.lock:
+			if self.lost:
+				raise SerialException('Connection to the broker lost')
+			for _ in range(0x10000):
+				rid = next(self.ids) & 0xFFFF
+				if rid not in self.pending and rid not in self.orphans:
+					break
+			else:
+				raise SerialException('Too many requests to the broker in flight')
+			self.pending[rid] = [threading.Event(), None, None]
+			try:
+				self.sock.sendall(REQUEST.pack(mtype, rid, len(payload)) + payload)
+			except OSError:
+				del self.pending[rid]
+				raise SerialException('Connection to the broker lost')
+		return rid
+
+	def wait(self, rid):
+		"""Wait for the response to a request and return its status and payload.
+
+		Raises a SerialException if the connection to the broker is lost before the response arrives.
+
+		"""
+		with self.lock:
+			entry = self.pending.get(rid)
+		if entry is None:
+			raise SerialException('Connection to the broker lost')
+		answered = entry[0].wait(self.timeout)
+		self.discard(rid)
+		if not answered:
+			return STATUS_TIMEOUT, b'The broker did not answer'
+		if entry[1] is None:
+			raise SerialException('Connection to the broker lost')
+		return entry[1], entry[2]
+
+	def discard(self, rid):
+		"""Drop the response to a request nobody is going to wait for."""
+		with self.lock:
+			entry = self.pending.pop(rid, None)
+			if entry is not None and not entry[0].is_set() and not self.lost:
+				self.orphans.add(rid)
+
+	def _query(self, mtype, payload=b''):
+		status, payload = self.wait(self.request(mtype, payload))
+		if status != STATUS_OK:
+			raise SerialException(payload.decode())
+		return json.loads(payload.decode())
+
+	def nodes(self):
+		"""Return the {bus name: [[MAC, node address, name]]} dict of the nodes known to the broker."""
+		listing = self._query(MSG_LIST)
+		self.buses = listing['buses']
+		return listing['nodes']
+
+	def open(self, bus, node_id, shadow=None):
+		"""Open a Ganglion by bus name and node address, optionally using a ShadowCache."""
+		if self.buses is None:
+			self.nodes()
+		index = self.buses.index(bus)
+		jsonconfig = self._query(MSG_DESCRIPTOR, struct.pack('>BH', index, node_id))
+		return Ganglion(node_id, jsonconfig=jsonconfig, ser=BrokerSerial(self, index), shadow=shadow)
+
+	def close(self):
+		self.sock.close()
+
+class BrokerSerial(object):
+	"""Stand-in for a LockableSerial forwarding the requests written to it to a broker
+
+	Written data is split into request frames which are sent to the broker one by one. The responses are then read
+	back in order as if they came from the bus.
+
+	"""
+
+	def __init__(self, client, bus):
+		self.client = client
+		self.bus = bytes([bus])
+		self.lock = threading.RLock()
+		self.batch = None
+		self.retries = RETRIES
+		self.timeouts = None
+		self.timeout = client.timeout
+		#Ids of the requests whose responses have not been read yet
+		self.sent = deque()
+		self.rx = b''
+
+	def __enter__(self):
+		self.lock.__enter__()
+		return self
+
+	def __exit__(self, *args):
+		self.lock.__exit__(*args)
+
+	def write(self, data):
+		for frame in split_frames(data):
+			rid = self.client.request(MSG_CALL, self.bus + frame)
+			if silent(frame_address(frame)):
+				#Nobody is going to read a response to this one
+				self.client.discard(rid)
+			else:
+				self.sent.append(rid)
+
+	def read(self, n, timeout=None):
+		return bytes(self.readview(n, timeout))
+
+	def readview(self, n, timeout=None):
+		while len(self.rx) < n:
+			if not self.sent:
+				raise TimeoutException('Read {} bytes trying to read {}'.format(len(self.rx), n))
+			status, payload = self.client.wait(self.sent.popleft())
+			if status == STATUS_TIMEOUT:
+				self.rx = b''
+				raise TimeoutException(payload.decode())
+			if status != STATUS_OK:
+				raise SerialException(payload.decode())
+			self.rx += payload
+		view, self.rx = memoryview(self.rx)[:n], self.rx[n:]
+		return view
+
+	def resync(self):
+		#The broker resynchronizes the bus itself, only the responses still in flight are dropped here.
+		for rid in self.sent:
+			self.client.discard(rid)
+		self.sent.clear()
+		self.rx = b''
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve the Cerebrum buses on the given serial ports to local clients.')
+	parser.add_argument('buses', nargs='+', help='Buses to serve as name=device, e.g. mainhall=/dev/ttyUSB0')
+	parser.add_argument('-b', '--baudrate', type=int, default=115200, help='The baud rate of the buses')
+	parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET, help='The Unix socket to listen on (default: {})'.format(DEFAULT_SOCKET))
+	args = parser.parse_args()
+	manager = BusManager(dict(bus.split('=', 1) for bus in args.buses), baudrate=args.baudrate, cache=DescriptorCache())
+	broker = Broker(manager, args.socket)
+	print('Serving', ', '.join(manager.buses), 'on', args.socket)
+	try:
+		broker.serve_forever()
+	finally:
+		broker.close()
+
+if __name__ == '__main__':
+	main()
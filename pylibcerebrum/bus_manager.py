@@ -0,0 +1,92 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+from concurrent.futures import ThreadPoolExecutor
+from pylibcerebrum.serial_mux import SerialMux
+
+"""Several buses driven concurrently, with one namespace over all of their ganglions."""
+
+class BusManager(object):
+	"""Owner of several SerialMux instances, each driven by its own I/O worker thread
+
+	Buses are given as a {bus name: SerialMux or device path} dict. For device paths, a SerialMux is created with the
+	remaining keyword arguments. Work submitted for a bus runs on that bus' worker, so a slow bus never stalls the
+	others. Ganglions are addressed by "bus/ganglion" paths, optionally followed by member names, e.g.
+	"mainhall/ampel/rot". A ganglion is named after the name in its descriptor or, lacking one, its node address.
+
+	"""
+
+	def __init__(self, buses, **muxargs):
+		self.buses = {}
+		self.workers = {}
+		#{"bus/ganglion": Ganglion}
+		self.ganglions = {}
+		self.discovered = {}
+		for name, bus in buses.items():
+			self.add(name, bus if isinstance(bus, SerialMux) else SerialMux(bus, **muxargs))
+
+	def add(self, name, mux):
+		"""Add a bus and start its worker."""
+		if '/' in name:
+			raise ValueError('Bus names must not contain slashes: {}'.format(name))
+		self.buses[name] = mux
+		self.workers[name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cerebrum-'+name)
+
+	def submit(self, bus, func, *args, **kwargs):
+		"""Run func(*args, **kwargs) on the given bus' worker and return a Future of its result."""
+		return self.workers[bus].submit(func, *args, **kwargs)
+
+	def run(self, func):
+		"""Run func(bus name, SerialMux) on all buses concurrently and return a {bus name: result} dict."""
+		futures = {name: self.submit(name, func, name, mux) for name, mux in self.buses.items()}
+		return {name: f.result() for name, f in futures.items()}
+
+	def discover(self, known={}):
+		"""Discover all buses concurrently and return a {bus name: [(MAC, node address)]} dict.
+
+		known optionally maps bus names to the known argument of SerialMux.discover.
+
+		"""
+		self.discovered = self.run(lambda name, mux: mux.discover(known=known.get(name, ())))
+		return self.discovered
+
+	def open(self):
+		"""Open a Ganglion for each node discovered (discovering first if necessary) and return the ganglions dict."""
+		if not self.discovered:
+			self.discover()
+		def open_bus(name, mux):
+			ganglions = {}
+			for mac, address in self.discovered.get(name, []):
+				g = mux.open(address)
+				key = g.name or str(address)
+				if key in ganglions:
+					key = '{}@{}'.format(key, address)
+				ganglions[key] = g
+			return ganglions
+		for name, ganglions in self.run(open_bus).items():
+			for key, g in ganglions.items():
+				self.ganglions[name+'/'+key] = g
+		return self.ganglions
+
+	def __getitem__(self, path):
+		"""Look up a ganglion or one of its members by path, e.g. "mainhall/ampel/rot"."""
+		bus, gname, *members = path.split('/')
+		g = self.ganglions[bus+'/'+gname]
+		for member in members:
+			g = g.members[member]
+		return g
+
+	def __iter__(self):
+		return iter(self.ganglions)
+
+	def call(self, path, func):
+		"""Run func(ganglion) for the ganglion or member at path on its bus' worker and return a Future."""
+		return self.submit(path.split('/', 1)[0], func, self[path])
+
+	def close(self):
+		"""Stop the workers after the work submitted so far is done."""
+		for worker in self.workers.values():
+			worker.shutdown()
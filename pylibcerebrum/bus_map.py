@@ -0,0 +1,97 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import os
+import json
+import threading
+
+"""Persistent map of the nodes on a bus and a watcher keeping it up to date."""
+
+class BusMap(object):
+	"""Map of node MACs to their node addresses and descriptor fingerprints
+
+	Since the host assigns node addresses during discovery, SerialMux.sync uses the map to give each node the address
+	it had before, so node addresses survive bus changes and restarts. Nodes that vanished keep their entries (marked
+	as not present) and thus their addresses, in case they come back.
+
+	If a path is given, the map is loaded from and saved to that JSON file.
+
+	"""
+
+	def __init__(self, path=None):
+		self.path = path
+		#{MAC: {'address': node address, 'fingerprint': hex string or None, 'present': bool}}
+		self.nodes = {}
+		if path is not None:
+			try:
+				with open(path) as f:
+					self.nodes = {int(mac, 16): node for mac, node in json.load(f).items()}
+			except (OSError, ValueError):
+				pass
+
+	def addresses(self):
+		"""Return a {MAC: node address} dict of all nodes ever seen."""
+		return {mac: node['address'] for mac, node in self.nodes.items()}
+
+	def present(self):
+		"""Return a {MAC: node address} dict of the nodes present on the bus at the last sync."""
+		return {mac: node['address'] for mac, node in self.nodes.items() if node['present']}
+
+	def fingerprint(self, mac):
+		node = self.nodes.get(mac)
+		return node and node['fingerprint']
+
+	def update(self, mac, address, present=True, fingerprint=None):
+		"""Record a node's state, keeping its last known fingerprint if none is given."""
+		fingerprint = fingerprint or self.fingerprint(mac)
+		self.nodes[mac] = {'address': address, 'fingerprint': fingerprint, 'present': present}
+
+	def save(self):
+		if self.path is None:
+			return
+		#See DescriptorCache.put
+		tmp = self.path + '.tmp{}'.format(os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump({'{:016x}'.format(mac): node for mac, node in self.nodes.items()}, f, indent=4, sort_keys=True)
+		os.replace(tmp, self.path)
+
+class BusWatcher(threading.Thread):
+	"""Background thread syncing a BusMap with the bus every interval seconds (see SerialMux.watch)
+
+	The nodes in the map are probed at every sync, which takes one probe per node. Nodes not in the map are only
+	searched for every search_every syncs since that takes many more probes. Each probe holds the port's lock only
+	briefly, so ongoing traffic is interleaved with the probes.
+
+	"""
+
+	def __init__(self, mux, busmap, interval=5, search_every=12, on_attach=None, on_detach=None):
+		super(BusWatcher, self).__init__(daemon=True)
+		self.mux = mux
+		self.busmap = busmap
+		self.interval = interval
+		self.search_every = search_every
+		self.on_attach = on_attach
+		self.on_detach = on_detach
+		self.stopped = threading.Event()
+
+	def run(self):
+		i = 0
+		while not self.stopped.wait(self.interval):
+			i += 1
+			search = bool(self.search_every) and i % self.search_every == 0
+			attached, detached = self.mux.sync(self.busmap, search=search)
+			for mac in detached:
+				if self.on_detach:
+					self.on_detach(mac, self.busmap.nodes[mac]['address'])
+			for mac in attached:
+				if self.on_attach:
+					node = self.busmap.nodes[mac]
+					self.on_attach(mac, node['address'], node['fingerprint'])
+
+	def stop(self):
+		"""Stop watching and wait for the current sync to finish."""
+		self.stopped.set()
+		self.join()
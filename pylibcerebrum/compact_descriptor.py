@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+#
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import re
+import struct
+from itertools import chain, islice
+"""Compact binary encoding of device descriptors
+
+Next to plain JSON (starting with '{') and LZMA-ed JSON (marked by '#'), descriptors can be burned into the firmware
+in this encoding, marked by '!'. Nothing needs to be decompressed or parsed, so host ports do not need LZMA. For most
+configs it is smaller than the LZMA-ed JSON, the generator falls back to the latter for the others:
+
+	'!' [version] [string table length (2 bytes)] [wide count] [string table] [wide table] [body]
+
+The string table holds all names, formats and string values NUL-separated. The body is a sequence of numbers of one
+byte each. A 0xFF byte stands for the next entry of the wide table, which holds the larger numbers as big-endian 4
+byte values. Strings are referenced by their index into the string table.
+
+Most members of a descriptor look alike, e.g. all simple-io members have the same fields, properties and functions
+whose callback ids only differ by a constant. Such a "shape" is therefore encoded only once:
+
+	node:   [shape index] ([shape] if the index is new) [field values] [base id] [ranges] ([member count] [members])
+	member: [name] ([number]) [node]
+	shape:  [flags] ([type]) [field count] ([key] [tag])* [property count] ([name] [format] [flags] [id - base id])*
+	        [function count] ([name] [flags] ([args]) ([returns]) [id - base id])*
+
+A member name is stored as twice its string index, or as twice the string index plus one followed by a number to be
+appended, so "digital0" to "digital13" share the string "digital". Field values are stored according to their
+shape's tags. Lists are stored with the tag of their elements if they all have the same one, e.g. [57600, 115200] as
+[2] [TAG_INT] [0xFF] [0xFF]. The elements of other lists and the values of nested dicts are tagged individually. The base id is only present if the
+node has properties or functions, and the ranges (callback id, maximum length) only for properties flagged HAS_RANGE.
+A property's "size" is not stored since it is the size of its format.
+
+"""
+
+MAGIC = b'!'
+VERSION = 2
+HEADER = struct.Struct('>BHB')
+
+#Marks a number stored in the wide table
+WIDE = 0xFF
+WIDE_MAX = 0xFFFFFFFF
+MAX_WIDE_COUNT = 0xFF
+
+#Shape flags, set if the node has the respective field even if it is empty
+HAS_TYPE = 1
+HAS_MEMBERS = 2
+HAS_PROPERTIES = 4
+HAS_FUNCTIONS = 8
+
+#Property flags
+READ_ONLY = 1
+HAS_RANGE = 2
+
+#Function flags
+HAS_ARGS = 1
+HAS_RETURNS = 2
+
+#Value tags
+TAG_INT = 0
+TAG_STRING = 1
+TAG_TRUE = 2
+TAG_FALSE = 3
+TAG_NULL = 4
+TAG_LIST = 5
+TAG_DICT = 6
+#Stored as string, e.g. version numbers
+TAG_FLOAT = 7
+#Negative or larger than WIDE_MAX, stored as string
+TAG_BIGINT = 8
+#Element tag of lists whose elements are tagged individually
+TAG_MIXED = 9
+#Individually tagged values are stored as [TAGGED + tag] [value], or as themselves if they are ints below TAGGED
+TAGGED = 0xF0
+
+STRUCTURE = ('type', 'members', 'properties', 'functions')
+PROPERTY_FIELDS = {'size', 'id', 'fmt', 'access', 'range'}
+FUNCTION_FIELDS = {'id', 'args', 'returns'}
+#Member names ending in a number without leading zeros
+NUMBERED = re.compile(r'(.*\D)(0|[1-9]\d{0,8})$', re.DOTALL)
+
+def _tag(value):
+	if value is True:
+		return TAG_TRUE
+	if value is False:
+		return TAG_FALSE
+	if value is None:
+		return TAG_NULL
+	if isinstance(value, int):
+		return TAG_INT if 0 <= value <= WIDE_MAX else TAG_BIGINT
+	if isinstance(value, float):
+		return TAG_FLOAT
+	if isinstance(value, str):
+		return TAG_STRING
+	if isinstance(value, (list, tuple)):
+		return TAG_LIST
+	if isinstance(value, dict):
+		return TAG_DICT
+	raise ValueError('Cannot encode {!r} in a compact descriptor'.format(value))
+
+def encode_descriptor(desc):
+	"""Encode a device descriptor, raising a ValueError if it does not fit into this encoding."""
+	strings = {}
+	shapes = {}
+	wide = []
+	out = []
+
+	def num(n):
+		if n < WIDE:
+			out.append(n)
+		else:
+			out.append(WIDE)
+			wide.append(n)
+
+	def intern(s):
+		if '\0' in s:
+			raise ValueError('Strings in a compact descriptor cannot contain NUL')
+		return strings.setdefault(s, len(strings))
+
+	def string(s):
+		num(intern(s))
+
+	def value(tag, v):
+		if tag == TAG_INT:
+			num(v)
+		elif tag in (TAG_STRING, TAG_BIGINT):
+			string(str(v))
+		elif tag == TAG_FLOAT:
+			string(repr(v))
+		elif tag == TAG_LIST:
+			num(len(v))
+			tags = [_tag(item) for item in v]
+			if tags and tags.count(tags[0]) == len(tags):
+				num(tags[0])
+				for t, item in zip(tags, v):
+					value(t, item)
+			else:
+				num(TAG_MIXED)
+				for t, item in zip(tags, v):
+					tagged(t, item)
+		elif tag == TAG_DICT:
+			num(len(v))
+			for key, item in v.items():
+				string(key)
+				tagged(_tag(item), item)
+
+	def tagged(tag, v):
+		if tag == TAG_INT and v < TAGGED:
+			num(v)
+		else:
+			num(TAGGED + tag)
+			value(tag, v)
+
+	def shape_of(node):
+		"""Return the node's shape as a hashable tuple along with its base id."""
+		props = node.get('properties', {})
+		funcs = node.get('functions', {})
+		ids = [p['id'] for p in props.values()] + [f['id'] for f in funcs.values()]
+		base = min(ids) if ids else 0
+		pshape = []
+		for pname, prop in props.items():
+			if set(prop) - PROPERTY_FIELDS or prop.get('access', 'r') != 'r' or prop['size'] != struct.calcsize(prop['fmt']):
+				raise ValueError('Property {} cannot be encoded compactly'.format(pname))
+			pshape.append((pname, prop['fmt'], (READ_ONLY if 'access' in prop else 0) | (HAS_RANGE if 'range' in prop else 0), prop['id']-base))
+		fshape = []
+		for fname, func in funcs.items():
+			if set(func) - FUNCTION_FIELDS:
+				raise ValueError('Function {} cannot be encoded compactly'.format(fname))
+			fshape.append((fname, func.get('args'), func.get('returns'), func['id']-base))
+		flags = (HAS_TYPE if 'type' in node else 0) | (HAS_MEMBERS if 'members' in node else 0) \
+				| (HAS_PROPERTIES if 'properties' in node else 0) | (HAS_FUNCTIONS if 'functions' in node else 0)
+		fields = tuple((key, _tag(v)) for key, v in node.items() if key not in STRUCTURE)
+		return (flags, node.get('type'), fields, tuple(pshape), tuple(fshape)), base
+
+	def add_shape(shape):
+		flags, ntype, fields, pshape, fshape = shape
+		num(flags)
+		if flags & HAS_TYPE:
+			string(ntype)
+		num(len(fields))
+		for key, tag in fields:
+			string(key)
+			num(tag)
+		num(len(pshape))
+		for pname, fmt, pflags, offset in pshape:
+			string(pname)
+			string(fmt)
+			num(pflags)
+			num(offset)
+		num(len(fshape))
+		for fname, args, returns, offset in fshape:
+			string(fname)
+			num((HAS_ARGS if args is not None else 0) | (HAS_RETURNS if returns is not None else 0))
+			if args is not None:
+				string(args)
+			if returns is not None:
+				string(returns)
+			num(offset)
+
+	def add(node):
+		shape, base = shape_of(node)
+		index = shapes.get(shape)
+		if index is None:
+			index = shapes[shape] = len(shapes)
+			num(index)
+			add_shape(shape)
+		else:
+			num(index)
+		for key, tag in shape[2]:
+			value(tag, node[key])
+		if shape[3] or shape[4]:
+			num(base)
+		for pname, prop in node.get('properties', {}).items():
+			if 'range' in prop:
+				rid, rlen = prop['range']
+				num(rid)
+				num(rlen)
+		if 'members' in node:
+			num(len(node['members']))
+			for mname, member in node['members'].items():
+				m = NUMBERED.match(mname)
+				if m:
+					num(2*intern(m.group(1)) + 1)
+					num(int(m.group(2)))
+				else:
+					num(2*intern(mname))
+				add(member)
+
+	add(desc)
+	table = '\0'.join(strings).encode('utf-8')
+	if len(table) > 0xFFFF or len(wide) > MAX_WIDE_COUNT:
+		raise ValueError('Descriptor too large for a compact descriptor')
+	return MAGIC + HEADER.pack(VERSION, len(table), len(wide)) + table + struct.pack('>{}I'.format(len(wide)), *wide) + bytes(out)
+
+#Struct formats by their size and by the length of the wide table
+_SIZES = {}
+_WIDE_TABLES = {}
+#Tagged lists are by far the most common tagged value
+TAGGED_LIST = TAGGED + TAG_LIST
+
+def decode_descriptor(cbytes):
+	"""Decode a compact descriptor (including its magic byte) into the same dict its JSON encoding yields.
+
+	The body is read in place: the runs of bytes between its WIDE markers are chained with the wide table's numbers.
+
+	"""
+	version, tlen, nwide = HEADER.unpack_from(cbytes, 1)
+	if version != VERSION:
+		raise ValueError('Unknown compact descriptor version {}'.format(version))
+	view = memoryview(cbytes)
+	offset = 1 + HEADER.size
+	strings = str(view[offset:offset+tlen], 'utf-8').split('\0')
+	offset += tlen
+	wide = _WIDE_TABLES.get(nwide)
+	if wide is None:
+		wide = _WIDE_TABLES[nwide] = struct.Struct('>{}I'.format(nwide))
+	start = offset + wide.size
+	runs = []
+	for n in wide.unpack_from(cbytes, offset):
+		end = cbytes.index(WIDE, start)
+		runs += view[start:end], (n,)
+		start = end + 1
+	runs.append(view[start:])
+	it = chain.from_iterable(runs)
+	nxt = it.__next__
+	sizes = _SIZES
+	shapes = []
+
+	def value(tag):
+		if tag == TAG_LIST:
+			return array()
+		if tag == TAG_INT:
+			return nxt()
+		if tag == TAG_STRING:
+			return strings[nxt()]
+		if tag == TAG_TRUE:
+			return True
+		if tag == TAG_FALSE:
+			return False
+		if tag == TAG_NULL:
+			return None
+		if tag == TAG_DICT:
+			rv = {}
+			for i in range(nxt()):
+				key = strings[nxt()]
+				n = nxt()
+				rv[key] = n if n < TAGGED else value(n - TAGGED)
+			return rv
+		if tag == TAG_FLOAT:
+			return float(strings[nxt()])
+		if tag == TAG_BIGINT:
+			return int(strings[nxt()])
+		raise ValueError('Unknown compact descriptor value tag {}'.format(tag))
+
+	def array():
+		n, tag = nxt(), nxt()
+		if tag == TAG_INT:
+			return list(islice(it, n))
+		#islice only counts the elements themselves, nested lists are read from the same iterator
+		if tag == TAG_MIXED:
+			return [i if i < TAGGED else array() if i == TAGGED_LIST else value(i - TAGGED) for i in islice(it, n)]
+		if tag == TAG_STRING:
+			return [strings[i] for i in islice(it, n)]
+		return [array() if tag == TAG_LIST else value(tag) for i in range(n)]
+
+	def read_shape():
+		flags = nxt()
+		ntype = strings[nxt()] if flags & HAS_TYPE else None
+		fields = []
+		for i in range(nxt()):
+			fields.append((strings[nxt()], nxt()))
+		#Properties without flags are built in one go
+		plain = True
+		props = []
+		for i in range(nxt()):
+			pname, fmt, pflags, offset = strings[nxt()], strings[nxt()], nxt(), nxt()
+			size = sizes.get(fmt)
+			if size is None:
+				size = sizes[fmt] = struct.calcsize(fmt)
+			props.append((pname, fmt, size, offset, pflags))
+			if pflags:
+				plain = False
+		funcs = []
+		for i in range(nxt()):
+			fname, fflags = strings[nxt()], nxt()
+			func = {}
+			if fflags & HAS_ARGS:
+				func['args'] = strings[nxt()]
+			if fflags & HAS_RETURNS:
+				func['returns'] = strings[nxt()]
+			funcs.append((fname, func, nxt()))
+		return flags, ntype, fields, plain and flags & HAS_PROPERTIES, props, funcs
+
+	def node():
+		index = nxt()
+		if index == len(shapes):
+			shapes.append(read_shape())
+		flags, ntype, fields, plain, props, funcs = shapes[index]
+		rv = {} if ntype is None else {'type': ntype}
+		for key, tag in fields:
+			if tag == TAG_STRING:
+				rv[key] = strings[nxt()]
+			elif tag == TAG_INT:
+				rv[key] = nxt()
+			else:
+				rv[key] = value(tag)
+		if props or funcs:
+			base = nxt()
+		if plain:
+			properties = rv['properties'] = {}
+			for pname, fmt, size, offset, pflags in props:
+				properties[pname] = {'size': size, 'id': base+offset, 'fmt': fmt}
+		elif props:
+			properties = rv['properties'] = {}
+			for pname, fmt, size, offset, pflags in props:
+				prop = properties[pname] = {'size': size, 'id': base+offset, 'fmt': fmt}
+				if pflags & READ_ONLY:
+					prop['access'] = 'r'
+				if pflags & HAS_RANGE:
+					prop['range'] = [nxt(), nxt()]
+		if flags & HAS_FUNCTIONS:
+			functions = rv['functions'] = {}
+			for fname, func, offset in funcs:
+				functions[fname] = dict(func, id=base+offset)
+		if flags & HAS_MEMBERS:
+			members = rv['members'] = {}
+			for i in range(nxt()):
+				name = nxt()
+				name = strings[name >> 1] + str(nxt()) if name & 1 else strings[name >> 1]
+				members[name] = node()
+		return rv
+
+	rv = node()
+	#The closures refer to each other. Breaking the cycle frees them right away instead of leaving them to the GC.
+	del value, array, node
+	return rv
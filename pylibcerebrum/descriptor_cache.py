@@ -0,0 +1,64 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import os
+import glob
+import json
+
+"""Persistent cache of device configuration descriptors."""
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'cerebrum', 'descriptors')
+
+class DescriptorCache(object):
+	"""On-disk cache of device descriptors keyed by their fingerprint
+
+	The fingerprint is a hash of the descriptor burned into the firmware by the code generator. A device returns it
+	when function 0 is called with an argument, which takes a handful of bytes instead of the whole descriptor. The
+	code generator also puts it into the build config, so the cache can be seeded from the builds/ folder.
+
+	"""
+
+	def __init__(self, path=DEFAULT_PATH):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+
+	def _filename(self, fingerprint):
+		return os.path.join(self.path, fingerprint + '.json')
+
+	def get(self, fingerprint):
+		"""Return the cached descriptor for the given fingerprint (a hex string) or None."""
+		try:
+			with open(self._filename(fingerprint)) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def put(self, fingerprint, desc):
+		"""Store a descriptor under the given fingerprint."""
+		#Write to a temporary file first so concurrent readers never see a partial descriptor
+		tmp = self._filename(fingerprint) + '.tmp{}'.format(os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump(desc, f, separators=(',',':'))
+		os.replace(tmp, self._filename(fingerprint))
+
+	def seed(self, pattern):
+		"""Add all build configs matching the given glob pattern (e.g. "builds/*.config.json") to the cache.
+
+		Build configs from builds prior to the introduction of fingerprints are skipped. Returns the number of
+		descriptors added.
+
+		"""
+		count = 0
+		for filename in glob.glob(pattern):
+			try:
+				with open(filename) as f:
+					desc = json.load(f)
+			except (OSError, ValueError):
+				continue
+			if 'fingerprint' in desc:
+				self.put(desc['fingerprint'], desc)
+				count += 1
+		return count
@@ -6,44 +6,512 @@
 #modify it under the terms of the GNU General Public License
 #version 3 as published by the Free Software Foundation.
 
+import re
+import sys
 import json
 import struct
+import binascii
 try:
 	import lzma
 except:
 	import pylzma as lzma
 import time
 import serial
+from collections import namedtuple
+from collections.abc import Mapping
 from pylibcerebrum.NotifyList import NotifyList
 from pylibcerebrum.timeout_exception import TimeoutException
+from pylibcerebrum.compact_descriptor import MAGIC as COMPACT_MAGIC, decode_descriptor
 
 escape = lambda s: s.replace(b'\\', b'\\\\')
 
 """Call RPC functions on serially connected devices over the Cerebrum protocol."""
 
+#Length prefix of every device response
+LENGTH = struct.Struct('>H')
+
+#Explicit struct byte order equivalent to the native one
+NATIVE_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+class FramingError(AttributeError):
+	"""A device response did not have the expected length, most likely because the bus got out of step"""
+	pass
+
+def _retval(rv):
+	"""Try to interpret an unpacked return value in a useful manner"""
+	if len(rv) == 0:
+		return None
+	elif len(rv) == 1:
+		return rv[0]
+	else:
+		return list(rv)
+
+def decode_config(cbytes):
+	"""Decode a device configuration descriptor as returned by function 0."""
+	#decide whether cbytes contains lzma, a compact descriptor or json depending on the first byte (which is used as a magic here)
+	if cbytes[0] is ord('#'):
+		return json.JSONDecoder().decode(str(lzma.decompress(cbytes[1:]), "utf-8"))
+	elif cbytes[:1] == COMPACT_MAGIC:
+		return decode_descriptor(cbytes)
+	else:
+		return json.JSONDecoder().decode(str(cbytes, "utf-8"))
+
+def decode_fingerprint(cbytes):
+	"""Return the descriptor fingerprint as hex string if cbytes contains one, else None."""
+	#Fingerprints are marked by a '=' magic, just like the lzma'ed descriptor is marked by '#'
+	if cbytes[:1] != b'=':
+		return None
+	return binascii.hexlify(cbytes[1:]).decode()
+
+def read_response(s, node_id=None, reqlen=0, timeouts=None):
+	"""Read a response from the serial port s and return its payload as a memoryview valid until the next read.
+
+	If an AdaptiveTimeout is given, the read timeouts are taken from it and the node's latency observed is fed back
+	into it. reqlen is the length of the request sent just before.
+
+	"""
+	if timeouts is None:
+		(clen,) = LENGTH.unpack_from(s.readview(2))
+		return s.readview(clen)
+	nbytes = reqlen + LENGTH.size
+	start = time.monotonic()
+	try:
+		(clen,) = LENGTH.unpack_from(s.readview(2, timeouts.timeout(node_id, nbytes)))
+	except TimeoutException:
+		timeouts.backoff(node_id)
+		raise
+	timeouts.observe(node_id, time.monotonic()-start, nbytes)
+	return s.readview(clen, timeouts.payload(clen))
+
+def read_config(ser, node_id, cache=None):
+	"""Fetch a node's configuration descriptor from the node or, if its fingerprint is known, from the cache."""
+	with ser as s:
+		timeouts = getattr(s, 'timeouts', None)
+		if cache is not None:
+			request = b'\\#' + escape(struct.pack(">H", node_id)) + b'\x00\x00\x00\x01\x01'
+			s.write(request)
+			cbytes = bytes(read_response(s, node_id, len(request), timeouts))
+			fingerprint = decode_fingerprint(cbytes)
+			if fingerprint is None:
+				#Firmware predating fingerprints ignores the argument and sends the whole descriptor
+				return decode_config(cbytes)
+			jsonconfig = cache.get(fingerprint)
+			if jsonconfig is not None:
+				return jsonconfig
+		request = b'\\#' + escape(struct.pack(">H", node_id)) + b'\x00\x00\x00\x00'
+		s.write(request)
+		jsonconfig = decode_config(bytes(read_response(s, node_id, len(request), timeouts)))
+		if cache is not None:
+			cache.put(fingerprint, jsonconfig)
+		return jsonconfig
+
+class CallPlan(object):
+	"""Precompiled framing for calls of one device function
+
+	The argument and return value formats are compiled into struct.Struct objects once and the request header is
+	escaped in advance. Since escaping works bytewise, escaping the header and the payload separately yields the same
+	frame as escaping them together. Per call, only the payload is packed, escaped and unpacked.
+
+	Calls of idempotent functions such as property getters and setters are resent after a framing error.
+
+	"""
+
+	#Number of responses to a request, see AsyncSerialMux.call
+	responses = 1
+
+	def __init__(self, node_id, fid, argsfmt='', retfmt='', idempotent=False):
+		self.node_id = node_id
+		self.fid = fid
+		self.idempotent = idempotent
+		self.argstruct = struct.Struct(argsfmt)
+		self.retstruct = struct.Struct(retfmt)
+		self.retlen = self.retstruct.size
+		#Number of values in a response, see _retval
+		self.count = len(self.retstruct.unpack(bytes(self.retlen)))
+		#The length prefix of a well-formed response
+		self.prefix = LENGTH.pack(self.retlen)
+		self.header = b'\\#' + escape(struct.pack('>HHH', node_id, fid, self.argstruct.size))
+
+	def request(self, args):
+		"""Encode the request frame for the given argument sequence."""
+		return self.header + escape(self.argstruct.pack(*args))
+
+	def frame(self, payload):
+		"""Encode the request frame for an already packed argument payload."""
+		return self.header + escape(payload)
+
+	def response(self, cbytes):
+		"""Decode a response payload (without the length prefix)."""
+		if len(cbytes) != self.retlen:
+			# CAUTION! This error is thrown not because the user supplied a wrong value but because the device answered in an unexpected manner.
+			raise FramingError("Device response format problem: Length mismatch: {} != {}".format(len(cbytes), self.retlen))
+		return _retval(self.retstruct.unpack(cbytes))
+
+	def read(self, s, reqlen=0, timeouts=None):
+		"""Read and decode this function's response from the serial port s without copying it (see read_response).
+
+		Without adaptive timeouts, the length prefix is only compared to the expected one instead of being decoded.
+
+		"""
+		if timeouts is None:
+			prefix = s.readview(2)
+			if prefix == self.prefix:
+				if not self.count:
+					return None
+				rv = self.retstruct.unpack(s.readview(self.retlen))
+				return rv[0] if self.count == 1 else list(rv)
+			(clen,) = LENGTH.unpack(prefix)
+			#Raises the appropriate error
+			return self.response(s.readview(clen))
+		cbytes = read_response(s, self.node_id, reqlen, timeouts)
+		if len(cbytes) != self.retlen:
+			#Raises the appropriate error
+			return self.response(cbytes)
+		return _retval(self.retstruct.unpack_from(cbytes))
+
+class RangePlan(object):
+	"""Framing of ranged writes to an array property
+
+	A ranged write carries a big-endian byte offset followed by the data to be written there. The request is split
+	into several calls if the data does not fit into the device's argument buffer.
+
+	"""
+
+	def __init__(self, node_id, fid, fmt, maxlen):
+		m = re.match(r'^([@=<>!]?)\d*([a-zA-Z?])$', fmt)
+		if not m:
+			raise ValueError('Ranged writes are only supported for arrays of a single type, not "{}"'.format(fmt))
+		self.order, self.itemtype = m.groups()
+		self.itemsize = struct.calcsize(self.order+self.itemtype)
+		self.perchunk = max(maxlen//self.itemsize, 1)
+		self.node_id = node_id
+		self.fid = fid
+		#The ranged setter sends an empty response
+		self.retplan = CallPlan(node_id, fid, idempotent=True)
+
+	def requests(self, values, start):
+		"""Encode the request frames writing values to the array starting at element index start."""
+		for i in range(0, len(values), self.perchunk):
+			chunk = values[i:i+self.perchunk]
+			payload = struct.pack('>H', (start+i)*self.itemsize) + struct.pack('{}{}{}'.format(self.order, len(chunk), self.itemtype), *chunk)
+			yield b'\\#' + escape(struct.pack('>HHH', self.node_id, self.fid, len(payload)) + payload)
+
+	def worthwhile(self, count, total):
+		"""Check whether writing count of total elements in a ranged write is cheaper than writing them all."""
+		#Each chunk carries 10 bytes of overhead for the header and offset
+		return count*self.itemsize + 10*((count+self.perchunk-1)//self.perchunk) < total*self.itemsize
+
+class SnapshotPlan(CallPlan):
+	"""Decoding of a node's snapshot, i.e. all readable properties packed back to back
+
+	The response is unpacked with a single struct.Struct concatenating the properties' formats. This is only possible if
+	all formats use the same byte order and packing without padding. Otherwise each property is unpacked on its own.
+
+	"""
+
+	def __init__(self, node_id, fid, layout):
+		"""layout is a list of (member name, property name, format) tuples in response order."""
+		super(SnapshotPlan, self).__init__(node_id, fid, idempotent=True)
+		self.layout = []
+		orders = set()
+		offset = 0
+		for member, prop, fmt in layout:
+			st = struct.Struct(fmt)
+			self.layout.append((member, prop, offset, st, len(st.unpack(bytes(st.size)))))
+			offset += st.size
+			order, body = (fmt[0], fmt[1:]) if fmt[:1] in '@=<>!' else ('@', fmt)
+			#Formats without alignment padding are the same in native and standard mode
+			if order == '@' and struct.calcsize('='+body) == st.size:
+				order = '='
+			orders.add(NATIVE_ORDER if order == '=' else '>' if order == '!' else order)
+		self.retlen = offset
+		self.retstruct = None
+		if len(orders) == 1 and '@' not in orders:
+			retstruct = struct.Struct(orders.pop() + ''.join(fmt.lstrip('@=<>!') for _, _, fmt in layout))
+			if retstruct.size == offset:
+				self.retstruct = retstruct
+
+	def _decode(self, cbytes):
+		snapshot = {}
+		if self.retstruct is not None:
+			values = self.retstruct.unpack_from(cbytes)
+			i = 0
+			for member, prop, _, _, count in self.layout:
+				snapshot.setdefault(member, {})[prop] = _retval(values[i:i+count])
+				i += count
+		else:
+			for member, prop, offset, st, _ in self.layout:
+				snapshot.setdefault(member, {})[prop] = _retval(st.unpack_from(cbytes, offset))
+		return snapshot
+
+	def response(self, cbytes):
+		if len(cbytes) != self.retlen:
+			raise FramingError("Device response format problem: Length mismatch: {} != {}".format(len(cbytes), self.retlen))
+		return self._decode(cbytes)
+
+	def read(self, s, reqlen=0, timeouts=None):
+		return self.response(read_response(s, self.node_id, reqlen, timeouts))
+
+class MultiSetPlan(object):
+	"""Framing of calls of a node's multi-set callback
+
+	A multi-set call carries a list of [2 byte callback id][1 byte length][payload] records which the node applies in
+	order. The records are split over several calls if they do not fit into the callback's argument buffer. The node
+	sends back one response per record.
+
+	"""
+
+	RECORD = struct.Struct('>HB')
+
+	def __init__(self, node_id, fid, maxlen):
+		self.node_id = node_id
+		self.fid = fid
+		self.maxlen = maxlen
+
+	def requests(self, records):
+		"""Encode the request frames for the given (callback id, payload) records.
+
+		Yields (request, retplan) tuples. retplan reads the responses to the request.
+
+		"""
+		chunk, count = b'', 0
+		for fid, payload in records:
+			record = self.RECORD.pack(fid, len(payload)) + payload
+			if len(payload) > 255 or len(record) > self.maxlen:
+				raise ValueError('A payload of {} bytes does not fit into a multi-set record'.format(len(payload)))
+			if len(chunk) + len(record) > self.maxlen:
+				yield self._request(chunk), MultiSetResponse(self.node_id, count)
+				chunk, count = b'', 0
+			chunk += record
+			count += 1
+		if count:
+			yield self._request(chunk), MultiSetResponse(self.node_id, count)
+
+	def _request(self, chunk):
+		return b'\\#' + escape(struct.pack('>HHH', self.node_id, self.fid, len(chunk)) + chunk)
+
+class MultiSetResponse(object):
+	"""Reader for the responses to a multi-set call setting count properties
+
+	Setters do not return anything, so each response must be empty. Since setting properties is idempotent, the call
+	may be resent after errors.
+
+	"""
+
+	idempotent = True
+
+	def __init__(self, node_id, count):
+		self.node_id = node_id
+		self.count = count
+		self.responses = count
+
+	def response(self, cbytes):
+		"""Check one of the responses, each of which must be empty."""
+		if len(cbytes):
+			raise FramingError("Device response format problem: Length mismatch: {} != 0".format(len(cbytes)))
+
+	def read(self, s, reqlen=0, timeouts=None):
+		for i in range(self.count):
+			self.response(read_response(s, self.node_id, reqlen if i == 0 else 0, timeouts))
+
+class NoResponse(object):
+	"""Reader for calls sent to a group address. The nodes do not respond to these, so there is nothing to read."""
+
+	idempotent = False
+	responses = 0
+
+	def read(self, s, reqlen=0, timeouts=None):
+		return None
+
+NO_RESPONSE = NoResponse()
+
+def callback_layout(jsonconfig):
+	"""Return the callback ids and formats of a node's properties, functions and members in a comparable form.
+
+	Nodes with the same layout can be addressed as a group (see SerialMux.group) since a frame means the same to all of
+	them.
+
+	"""
+	return {'properties': {name: (prop['id'], prop['fmt'], prop.get('access', 'rw'), tuple(prop.get('range', ())))
+				for name, prop in jsonconfig.get('properties', {}).items()},
+			'functions': {name: (func['id'], func.get('args', ''), func.get('returns', ''))
+				for name, func in jsonconfig.get('functions', {}).items()},
+			'members': {name: callback_layout(member) for name, member in jsonconfig.get('members', {}).items()},
+			'multiset': jsonconfig.get('multiset')}
+
+Event = namedtuple('Event', 'member property index value')
+
+class EventList(list):
+	"""List of Events drained from a node. dropped is the number of events the node had to drop since the last drain."""
+
+	def __init__(self, events, dropped=0):
+		super(EventList, self).__init__(events)
+		self.dropped = dropped
+
+class EventPlan(CallPlan):
+	"""Decoding of the records returned by a node's drain events callback
+
+	The response consists of the number of dropped events followed by (source, index, value) records. Since draining
+	the queue is destructive, the call is not resent after errors.
+
+	"""
+
+	RECORD = struct.Struct('BBB')
+
+	def __init__(self, node_id, fid, sources):
+		"""sources is the list of (member name, property name) tuples indexed by the events' source ids."""
+		super(EventPlan, self).__init__(node_id, fid)
+		self.sources = sources
+
+	def response(self, cbytes):
+		if len(cbytes) < 1 or (len(cbytes)-1) % self.RECORD.size:
+			raise FramingError("Device response format problem: Invalid event data length: {}".format(len(cbytes)))
+		return EventList([Event(*self.sources[source], index, value) for source, index, value in self.RECORD.iter_unpack(cbytes[1:])],
+				cbytes[0])
+
+	def read(self, s, reqlen=0, timeouts=None):
+		return self.response(read_response(s, self.node_id, reqlen, timeouts))
+
+class CallResult(object):
+	"""Placeholder for the return value of a call queued in a Batch"""
+
+	def __init__(self):
+		self.done = False
+		self.value = None
+		self.error = None
+
+	def result(self):
+		"""Return the call's return value once the batch has been flushed, or raise the error that occurred."""
+		if self.error is not None:
+			raise self.error
+		if not self.done:
+			raise RuntimeError('The batch containing this call has not been flushed yet')
+		return self.value
+
+class Batch(object):
+	"""Pipeline for calls on one serial port
+
+	While a batch is active on a port, calls from the thread holding it are not sent immediately but queued and a
+	CallResult is returned in place of the return value. When the outermost batch context is left, the queued requests
+	are sent and the responses are read back in order, with at most window requests in flight at a time.
+
+	The window defaults to 1 since a node can only hold one request: the firmware parses requests in the receive
+	interrupt, keeps a single pending callback and reads its arguments from the global argument buffer, which the next
+	request's header already overwrites. A request arriving before the pending callback ran is lost or corrupts the
+	pending one. Only pass a larger window (or None for no limit) if the queued calls go to different nodes.
+
+	"""
+
+	def __init__(self, ser, window=1):
+		self.ser = ser
+		self.window = window
+		self.calls = []
+		self.outer = None
+
+	def __enter__(self):
+		self.ser.__enter__()
+		self.outer = getattr(self.ser, 'batch', None)
+		if self.outer is not None:
+			#Nested batches are merged into the outermost one
+			return self.outer
+		self.ser.batch = self
+		return self
+
+	def __exit__(self, exc_type, *args):
+		try:
+			if self.outer is None:
+				self.ser.batch = None
+				if exc_type is None:
+					self.flush()
+		finally:
+			self.ser.__exit__(exc_type, *args)
+
+	def queue(self, plan, request):
+		"""Queue an encoded request to be sent with the next flush and return its CallResult."""
+		result = CallResult()
+		self.calls.append((plan, request, result))
+		return result
+
+	def flush(self):
+		"""Send all queued requests and read back their responses."""
+		calls, self.calls = self.calls, []
+		if not calls:
+			return
+		with self.ser as s:
+			sent = min(self.window or len(calls), len(calls))
+			s.write(b''.join(request for _, request, _ in calls[:sent]))
+			for i, (plan, _, result) in enumerate(calls):
+				try:
+					result.value = plan.read(s)
+					result.done = True
+				except Exception as e:
+					#Once a response got lost, the following ones cannot be told apart anymore.
+					for _, _, r in calls[i:]:
+						r.error = e
+					#Get rid of the responses still coming in so later calls find the bus in step again
+					if hasattr(s, 'resync'):
+						s.resync()
+					raise
+				if sent < len(calls):
+					s.write(calls[sent][1])
+					sent += 1
+
+class MemberMap(Mapping):
+	"""Read-only mapping of member names to child nodes that constructs each child from its descriptor on first access"""
+
+	def __init__(self, factory, descs):
+		self._factory = factory
+		self._descs = descs
+		self._nodes = {}
+
+	def __getitem__(self, name):
+		try:
+			return self._nodes[name]
+		except KeyError:
+			pass
+		#If two threads race here, both get the node that was stored first
+		return self._nodes.setdefault(name, self._factory(name, self._descs[name]))
+
+	def __contains__(self, name):
+		return name in self._descs
+
+	def __iter__(self):
+		return iter(self._descs)
+
+	def __len__(self):
+		return len(self._descs)
+
 class Ganglion(object):
-	"""Proxy class for calling remote methods on hardware connected through a serial port using the Cerebrum protocol"""
+	"""Proxy class for calling remote methods on hardware connected through a serial port using the Cerebrum protocol
+
+	Members averaging on the device (e.g. simple-io with "oversample" set) have the number of samples in their config's
+	"oversample" field. Their analog_sum and analog_mean properties are averaged readings of that many samples.
+
+	"""
 
 	# NOTE: the device config is *not* the stuff from the config "dev" section but
 	#read from the device. It can also be found in that [devicename].config.json
 	#file created by the code generator
-	def __init__(self, node_id, jsonconfig=None, ser=None, name=''):
+	def __init__(self, node_id, jsonconfig=None, ser=None, name='', cache=None, shadow=None, multiset=None):
 		"""Ganglion constructor
 
 		Keyword arguments:
 		device -- the device file to connect to
 		baudrate -- the baudrate to use (default 115200)
+		cache -- a DescriptorCache to look up the device descriptor in before fetching it from the device
+		shadow -- a ShadowCache to suppress redundant property writes and serve property reads from
 		The other keyword arguments are for internal use only.
 
 		"""
 		object.__setattr__(self, '_ser', ser)
+		object.__setattr__(self, '_shadow', shadow)
 		object.__setattr__(self, 'node_id', node_id)
 		if not jsonconfig:
 			# get a config
 			i=0
 			while True:
 				try:
-					jsonconfig = self._read_config()
+					jsonconfig = self._read_config(cache)
 					time.sleep(0.1)
 					break
 				except TimeoutException as e:
@@ -53,39 +521,56 @@ class Ganglion(object):
 				i += 1
 				if i > 20:
 					raise serial.serialutil.SerialException('Could not connect, giving up after 20 tries')
+				if hasattr(ser, 'resync'):
+					ser.resync()
 		if not name:
 			name = jsonconfig.get('name')
 		object.__setattr__(self, 'name', name)
+		object.__setattr__(self, '_jsonconfig', jsonconfig)
 		# populate the object
-		object.__setattr__(self, 'members', {})
-		for name, member in jsonconfig.get('members', {}).items():
-			self.members[name] = Ganglion(node_id, jsonconfig=member, ser=self._ser, name=name)
+		#Child nodes are only constructed once they are accessed
+		#The multi-set callback is listed in the root node's descriptor but can set the properties of any node
+		if 'multiset' in jsonconfig:
+			multiset = MultiSetPlan(node_id, jsonconfig['multiset']['id'], jsonconfig['multiset']['size'])
+		object.__setattr__(self, '_multisetplan', multiset)
+		object.__setattr__(self, 'members', MemberMap(lambda name, member: type(self)(node_id, jsonconfig=member, ser=self._ser, name=name, shadow=shadow, multiset=multiset),
+				jsonconfig.get('members', {})))
 		object.__setattr__(self, 'properties', {})
+		#(getter, setter) call plans by property name. The setter plan is None for read-only properties.
+		object.__setattr__(self, '_callplans', {})
+		#Ranged setters of array properties by property name
+		object.__setattr__(self, '_rangeplans', {})
 		for name, prop in jsonconfig.get('properties', {}).items():
-			self.properties[name] = (prop['id'], prop['fmt'], prop.get('access', 'rw'))
+			access = prop.get('access', 'rw')
+			self.properties[name] = (prop['id'], prop['fmt'], access)
+			self._callplans[name] = (CallPlan(node_id, prop['id'], retfmt=prop['fmt'], idempotent=True),
+					CallPlan(node_id, prop['id']+1, argsfmt=prop['fmt'], idempotent=True) if 'w' in access else None)
+			if 'range' in prop:
+				self._rangeplans[name] = RangePlan(node_id, prop['range'][0], prop['fmt'], prop['range'][1])
 		object.__setattr__(self, 'functions', {})
 		for name, func in jsonconfig.get('functions', {}).items():
-			def proxy_method(*args):
-				return self._callfunc(func["id"], func.get("args", ""), args, func.get("returns", ""))
+			#The plan is bound as a default argument since a plain closure would see the loop's last plan
+			def proxy_method(*args, plan=CallPlan(node_id, func['id'], func.get('args', ''), func.get('returns', ''))):
+				return self._callplan(plan, args)
 			self.functions[name] = proxy_method
 		object.__setattr__(self, 'type', jsonconfig.get('type', None))
-		object.__setattr__(self, 'config', { k: v for k,v in jsonconfig.items() if not k in ['members', 'properties', 'functions'] })
+		object.__setattr__(self, 'config', { k: v for k,v in jsonconfig.items() if not k in ['members', 'properties', 'functions', 'snapshot', 'events', 'multiset', 'groups'] })
+		#Only the root node of firmware with a snapshot callback has this
+		snapshot = jsonconfig.get('snapshot')
+		object.__setattr__(self, '_snapshotplan', SnapshotPlan(node_id, snapshot['id'],
+				[(m, p, jsonconfig['members'][m]['properties'][p]['fmt']) for m, p in snapshot['properties']]) if snapshot else None)
+		events = jsonconfig.get('events')
+		object.__setattr__(self, '_eventplan', EventPlan(node_id, events['id'], [tuple(src) for src in events['sources']]) if events else None)
+		groups = jsonconfig.get('groups')
+		object.__setattr__(self, '_groupplan', CallPlan(node_id, groups['id'], '>HB', 'B', idempotent=True) if groups else None)
 	
 	def __iter__(self):
 		"""Construct an iterator to iterate over *all* (direct or not) child nodes of this node."""
 		return GanglionIter(self)
 
-	def _read_config(self):
-		"""Fetch the device configuration descriptor from the device."""
-		with self._ser as s:
-			s.write(b'\\#' + escape(struct.pack(">H", self.node_id)) + b'\x00\x00\x00\x00')
-			(clen,) = struct.unpack(">H", s.read(2))
-			cbytes = s.read(clen)
-			#decide whether cbytes contains lzma or json depending on the first byte (which is used as a magic here)
-			if cbytes[0] is ord('#'):
-				return json.JSONDecoder().decode(str(lzma.decompress(cbytes[1:]), "utf-8"))
-			else:
-				return json.JSONDecoder().decode(str(cbytes, "utf-8"))
+	def _read_config(self, cache=None):
+		"""Fetch the device configuration descriptor from the device or, if its fingerprint is known, from the cache."""
+		return read_config(self._ser, self.node_id, cache)
 	
 	def _callfunc(self, fid, argsfmt, args, retfmt):
 		"""Call a function on the device by id, directly passing argument/return format parameters."""
@@ -104,15 +589,202 @@ class Ganglion(object):
 			if clen != struct.calcsize(retfmt):
 				# CAUTION! This error is thrown not because the user supplied a wrong value but because the device answered in an unexpected manner.
 				# FIXME raise an error here or let the whole operation just fail in the following struct.unpack?
-				raise AttributeError("Device response format problem: Length mismatch: {} != {}".format(clen, struct.calcsize(retfmt)))
-			rv = struct.unpack(retfmt, cbytes)
-			# Try to interpret the return value in a useful manner
-			if len(rv) == 0:
-				return None
-			elif len(rv) == 1:
-				return rv[0]
-			else:
-				return list(rv)
+				raise FramingError("Device response format problem: Length mismatch: {} != {}".format(clen, struct.calcsize(retfmt)))
+			return _retval(struct.unpack(retfmt, cbytes))
+
+	def _callplan(self, plan, args):
+		"""Call a function on the device using a precompiled CallPlan."""
+		if not isinstance(args, (tuple, list)):
+			args = [args]
+		return self._sendrequest(plan, plan.header + escape(plan.argstruct.pack(*args)))
+
+	def _sendrequest(self, plan, request):
+		"""Send an encoded request and read back the response according to the given CallPlan.
+
+		The common case of a call outside of a batch costs a single write followed by the plan's read. Only after a
+		timeout or a framing error, the call is retried (see _resend). If the port has an AdaptiveTimeout, the read
+		timeouts are taken from it.
+
+		"""
+		with self._ser as s:
+			#Holding the lock, a batch found on the port can only be one of this thread
+			batch = getattr(s, 'batch', None)
+			if batch is not None:
+				return batch.queue(plan, request)
+			s.write(request)
+			try:
+				return plan.read(s, len(request), getattr(s, 'timeouts', None))
+			except (TimeoutException, FramingError) as e:
+				return self._resend(s, plan, request, e)
+
+	def _resend(self, s, plan, request, err):
+		"""Recover from the error err of a request just sent through the locked port s.
+
+		The port is resynchronized (see LockableSerial.resync) so the next call does not pick up a stale response.
+		Idempotent calls are then resent up to the port's retries times. Raises the last error if they all fail.
+
+		"""
+		retries = getattr(s, 'retries', 0) if plan.idempotent else 0
+		timeouts = getattr(s, 'timeouts', None)
+		while True:
+			if hasattr(s, 'resync'):
+				s.resync()
+			if retries <= 0:
+				raise err
+			retries -= 1
+			s.write(request)
+			try:
+				return plan.read(s, len(request), timeouts)
+			except (TimeoutException, FramingError) as e:
+				err = e
+
+	def _setproperty(self, name, value):
+		"""Write a property, checking the shadow copy if there is a ShadowCache."""
+		getplan, setplan = self._callplans[name]
+		if setplan is None:
+			raise TypeError("{} is a read-only property".format(name))
+		if self._shadow is None:
+			return self._callplan(setplan, value)
+		if not (isinstance(value, tuple) or isinstance(value, list)):
+			value = [value]
+		payload = setplan.argstruct.pack(*value)
+		key = (self.node_id, getplan.fid)
+		if self._shadow.suppress(key, payload):
+			return None
+		#Calls queued in a batch are assumed to succeed
+		rv = self._sendrequest(setplan, setplan.frame(payload))
+		self._shadow.update(key, payload, True)
+		return rv
+
+	def set_many(self, items):
+		"""Write several properties given as (path, value) pairs in as few calls as possible.
+
+		A path is a property name, optionally prefixed by the names of the members containing it separated by dots, e.g.
+		"ampelrot.state". The properties are written in the given order. Using the node's multi-set callback, all of
+		them are sent in one frame unless they do not fit into the node's argument buffer. Firmware without multi-set
+		support gets one call per property, sent in a batch.
+
+		"""
+		if self._multisetplan is None:
+			with self.batch():
+				for path, value in items:
+					node, name = self._resolve(path)
+					node._setproperty(name, value)
+			return
+		records, shadowed = self._multisetrecords(items)
+		for request, retplan in self._multisetplan.requests(records):
+			self._sendrequest(retplan, request)
+		#Calls queued in a batch are assumed to succeed
+		for shadow, key, payload in shadowed:
+			shadow.update(key, payload, True)
+
+	def _multisetrecords(self, items):
+		"""Pack the (path, value) pairs given to set_many into multi-set records, dropping those the shadow copies suppress.
+
+		Returns the records along with the (shadow cache, key, payload) triples to update once they were sent.
+
+		"""
+		records, shadowed = [], []
+		for path, value in items:
+			node, name = self._resolve(path)
+			getplan, setplan = node._callplans[name]
+			if setplan is None:
+				raise TypeError("{} is a read-only property".format(path))
+			if not (isinstance(value, tuple) or isinstance(value, list)):
+				value = [value]
+			payload = setplan.argstruct.pack(*value)
+			if node._shadow is not None:
+				key = (node.node_id, getplan.fid)
+				if node._shadow.suppress(key, payload):
+					continue
+				shadowed.append((node._shadow, key, payload))
+			records.append((setplan.fid, payload))
+		return records, shadowed
+
+	def update(self, values):
+		"""Write the properties given as a dict mapping paths to values (see set_many)."""
+		self.set_many(values.items())
+
+	def _resolve(self, path):
+		"""Find the node and property name a dotted property path relative to this node refers to."""
+		*members, name = path.split('.')
+		node = self
+		for member in members:
+			node = node.members[member]
+		if name not in node.properties:
+			raise AttributeError(path)
+		return node, name
+
+	def _setrange(self, name, values, start, stop):
+		"""Write the elements start:stop of an array property, using its ranged setter if that is cheaper."""
+		rangeplan = self._rangeplans.get(name)
+		if rangeplan is None or not rangeplan.worthwhile(stop-start, len(values)):
+			return self._setproperty(name, values)
+		if self._shadow is not None:
+			self._shadow.invalidate((self.node_id, self._callplans[name][0].fid))
+		for request in rangeplan.requests(values[start:stop], start):
+			self._sendrequest(rangeplan.retplan, request)
+
+	def _getproperty(self, name):
+		"""Read a property, possibly from the shadow copy if there is a ShadowCache."""
+		getplan, setplan = self._callplans[name]
+		if self._shadow is None:
+			return self._callplan(getplan, ())
+		key = (self.node_id, getplan.fid)
+		payload = self._shadow.lookup(key, name, '{}.{}'.format(self.name, name))
+		if payload is not None:
+			return getplan.response(payload)
+		rv = self._callplan(getplan, ())
+		if not isinstance(rv, CallResult):
+			self._shadow.update(key, getplan.retstruct.pack(*(rv if isinstance(rv, list) else [rv])), False)
+		return rv
+
+	def snapshot(self):
+		"""Read all readable properties in a single call.
+
+		Returns a dict mapping member names to dicts of the members' property values. Only available on the root node of
+		firmware built with snapshot support.
+
+		"""
+		if self._snapshotplan is None:
+			raise AttributeError('This node does not support snapshots')
+		return self._sendrequest(self._snapshotplan, self._snapshotplan.header)
+
+	def events(self):
+		"""Fetch the change events queued on the device since the last call.
+
+		Returns an EventList of Event(member, property, index, value) tuples in the order they occurred. Only available
+		on the root node of firmware with members queueing change events (e.g. simple-io with "events" set).
+
+		"""
+		if self._eventplan is None:
+			raise AttributeError('This node does not queue change events')
+		return self._sendrequest(self._eventplan, self._eventplan.header)
+
+	def join_group(self, address):
+		"""Make the node process frames sent to the given group address. Returns False if it cannot join any more groups.
+
+		Only available on the root node of firmware with group support. See SerialMux.group.
+
+		"""
+		if self._groupplan is None:
+			raise AttributeError('This node does not support groups')
+		return bool(self._callplan(self._groupplan, (address, 1)))
+
+	def leave_group(self, address):
+		"""Make the node ignore frames sent to the given group address again."""
+		if self._groupplan is None:
+			raise AttributeError('This node does not support groups')
+		return bool(self._callplan(self._groupplan, (address, 0)))
+
+	def batch(self, window=1):
+		"""Return a context manager pipelining all calls on this ganglion's serial port made within it.
+
+		Inside the context, function calls and property reads return a CallResult instead of the actual value. Its
+		result() method can be called after the context was left. See Batch for the window argument.
+
+		"""
+		return Batch(self._ser, window)
 
 	def __dir__(self):
 		"""Get a list of all attributes of this object. This includes virtual Cerebrum stuff like members, properties and functions."""
@@ -124,10 +796,7 @@ class Ganglion(object):
 		#check if the name is a known property
 		if name in self.properties:
 			#call the property's Cerebrum setter function
-			varid, varfmt, access = self.properties[name]
-			if not "w" in access:
-				raise TypeError("{} is a read-only property".format(name))
-			return self._callfunc(varid+1, varfmt, value, "")
+			return self._setproperty(name, value)
 		#if the above code falls through, do a normal __dict__ lookup.
 		self.__dict__[name] = value
 
@@ -144,10 +813,9 @@ class Ganglion(object):
 			return self.members[name]
 
 		if name in self.properties:
-			def cb(newx):
-				self.__setattr__(name, newx)
-			varid, varfmt, access = self.properties[name]
-			rv = self._callfunc(varid, "", (), varfmt)
+			def cb(newx, start, stop):
+				self._setrange(name, newx, start, stop)
+			rv = self._getproperty(name)
 			# If the return value is a list, construct an auto-updating thingy from it.
 			if isinstance(rv, list):
 				return NotifyList(rv, callbacks=[cb])
@@ -160,6 +828,47 @@ class Ganglion(object):
 		#If all of the above falls through...
 		raise AttributeError(name)
 
+class GroupGanglion(Ganglion):
+	"""Proxy sending each call as one frame to a group of nodes with the same callback layout (see SerialMux.group)
+
+	The nodes process frames sent to a group address without responding, so all calls return None right away and
+	properties cannot be read. Since nothing is read back, lost frames go unnoticed.
+
+	"""
+
+	def __init__(self, address, jsonconfig, ser=None, name='', shadow=None, multiset=None, nodes=()):
+		super(GroupGanglion, self).__init__(address, jsonconfig=jsonconfig, ser=ser, name=name, shadow=shadow, multiset=multiset)
+		#The member nodes of the group. These are left empty for the group's children.
+		object.__setattr__(self, 'nodes', list(nodes))
+
+	def _sendrequest(self, plan, request):
+		with self._ser as s:
+			batch = getattr(s, 'batch', None)
+			if batch is not None:
+				return batch.queue(NO_RESPONSE, request)
+			s.write(request)
+		return None
+
+	def _getproperty(self, name):
+		raise TypeError('Properties of a group cannot be read')
+
+	def snapshot(self):
+		raise TypeError('Groups cannot take snapshots')
+
+	def events(self):
+		raise TypeError('Groups cannot drain events')
+
+	def join_group(self, address):
+		raise TypeError('Groups cannot join groups')
+
+	def leave_group(self, address):
+		raise TypeError('Groups cannot leave groups')
+
+	def dissolve(self):
+		"""Make all nodes leave the group."""
+		for node in self.nodes:
+			node.leave_group(self.node_id)
+
 class GanglionIter:
 	"""Iterator class for ganglions that recursively iterates over all (direct or indirect) child nodes of a given Ganglion"""
 
@@ -0,0 +1,143 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import time
+import threading
+from pylibcerebrum.ganglion import Batch
+
+"""Periodic polling of device properties with change notifications."""
+
+#Factor by which the poll interval of a property that did not change grows, up to MAX_SLOWDOWN times its base interval
+SLOWDOWN = 1.25
+MAX_SLOWDOWN = 8
+#Fraction of the golden ratio used to spread the first polls of the registered properties over their intervals
+GOLDEN = 0.6180339887
+
+class Subscription(object):
+	"""A property polled by a PollScheduler"""
+
+	def __init__(self, g, name, rate, adaptive, due):
+		self.g = g
+		self.name = name
+		self.base = 1/rate
+		self.interval = self.base
+		self.adaptive = adaptive
+		self.due = due
+		self.callbacks = []
+		self.value = None
+		self.polls = 0
+		self.changes = 0
+
+	def reschedule(self, now, changed):
+		"""Compute the next time this property is due, given whether it just changed."""
+		if self.adaptive:
+			#Snap back to the full rate on a change so the next ones are caught quickly
+			self.interval = self.base if changed else min(self.interval*SLOWDOWN, self.base*MAX_SLOWDOWN)
+		self.due += self.interval
+		if self.due < now:
+			#Fell behind, do not try to catch up with a burst
+			self.due = now + self.interval
+
+class PollScheduler(object):
+	"""Scheduler reading registered properties at their rates and calling back on changes
+
+	Properties are registered with a rate in polls per second. The reads due at a time are sent in one Batch per serial
+	port, window is passed on to it. It defaults to 1 since a node only holds one request at a time. A larger window (or
+	None) is only safe if all polled properties on a port belong to different nodes. The first polls of the registered
+	properties are spread over their intervals so they do not all fall onto the same time. With adaptive set, the
+	interval of a property that does not change grows step by step up to MAX_SLOWDOWN times its base interval, and
+	snaps back on the next change.
+
+	Callbacks are called with the ganglion, the property name, the new and the old value, only if the value changed.
+	The first read of a property always counts as a change.
+
+	"""
+
+	def __init__(self, window=1):
+		self.window = window
+		self.subscriptions = []
+		self.lock = threading.Lock()
+		self.thread = None
+		self.stopped = threading.Event()
+		self.wakeup = threading.Event()
+
+	def register(self, g, name, rate, callback=None, adaptive=True):
+		"""Poll property name of ganglion g rate times per second. Returns the Subscription."""
+		if name not in g.properties:
+			raise AttributeError(name)
+		with self.lock:
+			sub = Subscription(g, name, rate, adaptive, time.monotonic() + (len(self.subscriptions)*GOLDEN % 1)/rate)
+			if callback is not None:
+				sub.callbacks.append(callback)
+			self.subscriptions.append(sub)
+		self.wakeup.set()
+		return sub
+
+	def subscribe(self, sub, callback):
+		"""Add a change callback to a Subscription."""
+		sub.callbacks.append(callback)
+
+	def unregister(self, sub):
+		with self.lock:
+			self.subscriptions.remove(sub)
+
+	def poll(self, now=None):
+		"""Read all properties due and dispatch the change callbacks. Returns the time the next property is due."""
+		now = time.monotonic() if now is None else now
+		with self.lock:
+			due = [sub for sub in self.subscriptions if sub.due <= now]
+		byport = {}
+		for sub in due:
+			byport.setdefault(id(sub.g._ser), []).append(sub)
+		changed = []
+		for subs in byport.values():
+			results = []
+			try:
+				with Batch(subs[0].g._ser, self.window):
+					for sub in subs:
+						results.append((sub, sub.g._callplan(sub.g._callplans[sub.name][0], ())))
+			except Exception:
+				#The calls that got an answer before the error still count
+				pass
+			for sub, result in results:
+				try:
+					value = result.result()
+				except Exception:
+					sub.reschedule(now, False)
+					continue
+				sub.polls += 1
+				if sub.polls == 1 or value != sub.value:
+					sub.changes += 1
+					changed.append((sub, value, sub.value))
+					sub.value = value
+					sub.reschedule(now, True)
+				else:
+					sub.reschedule(now, False)
+			#Properties of which no read was even queued
+			for sub in subs[len(results):]:
+				sub.reschedule(now, False)
+		for sub, value, old in changed:
+			for callback in sub.callbacks:
+				callback(sub.g, sub.name, value, old)
+		with self.lock:
+			return min((sub.due for sub in self.subscriptions), default=None)
+
+	def start(self):
+		"""Poll in a background thread."""
+		def run():
+			while not self.stopped.is_set():
+				#Cleared first so a registration during the poll is not missed
+				self.wakeup.clear()
+				nextdue = self.poll()
+				self.wakeup.wait(None if nextdue is None else max(nextdue - time.monotonic(), 0))
+		self.thread = threading.Thread(target=run, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		self.wakeup.set()
+		if self.thread is not None:
+			self.thread.join()
@@ -1,16 +1,128 @@
 
+import os
+import glob
+import json
+import time
+import select
 import serial
 import threading
 import struct
-from pylibcerebrum.ganglion import Ganglion, escape
+from pylibcerebrum.ganglion import Ganglion, GroupGanglion, Batch, CallPlan, escape, read_response, decode_fingerprint, callback_layout
+from pylibcerebrum.adaptive_timeout import AdaptiveTimeout
+from pylibcerebrum.bus_map import BusWatcher
 from pylibcerebrum.timeout_exception import TimeoutException
 
 MAC_LEN = 64
+#Initial size of the read-ahead receive buffer of a LockableSerial
+RXBUF_SIZE = 1024
+#Maximum time to wait for a node to answer a discovery probe
+PROBE_TIMEOUT = 0.05
+#Number of times an idempotent call is resent after a timeout or framing error
+RETRIES = 2
+#Minimum time the line has to be quiet after a framing error before the next request is sent
+RESYNC_QUIET = 0.002
+#Maximum time spent draining a babbling line
+RESYNC_LIMIT = 0.5
+#Frames sent to these addresses are processed by all nodes that joined the group resp. by all nodes, without responses
+GROUP_ADDRESS_FIRST = 0xFF00
+GROUP_ADDRESS_LAST = 0xFFEF
+BROADCAST_ADDRESS = 0xFFFD
+#Frames sent to this address make all nodes switch their baud rate
+BAUDRATE_ADDRESS = 0xFFFC
+#Number of bytes a node receives at a new baud rate before switching back unless one of them was addressed to it
+BAUDRATE_TRIAL = 512
+#Time the nodes get to reconfigure their UART after a baud rate switch
+BAUDRATE_SETTLE = 0.01
+
+def probe_request(mac, mask, next_address):
+	"""Encode a discovery probe for the given MAC pattern, MAC mask length and node address to be assigned."""
+	return b'\\#\xFF\xFF' + escape(struct.pack('>HHQ', next_address, mask, mac))
+
+def baudrate_request(rate):
+	"""Encode a frame making all nodes switch to the given baud rate."""
+	return b'\\#' + escape(struct.pack('>HHHL', BAUDRATE_ADDRESS, 0, 4, rate))
+
+def free_address(found, reserved):
+	"""Return the lowest node address neither used in found nor reserved for another node."""
+	used = set(reserved).union(address for _, address in found)
+	address = 0
+	while address in used:
+		address += 1
+	return address
+
+def discovery(known=(), search=True, stats=None):
+	"""Generator running a discovery of the nodes on a bus, independent of how probes are sent
+
+	Yields the (MAC pattern, MAC mask length, node address to be assigned) of each probe to be sent and expects to be
+	sent whether a node answered it. Returns the list of (MAC, node address) tuples of the nodes found.
+
+	Nodes with one of the MACs given in known (e.g. the MACs found by a previous discovery or those from the build
+	configs, see build_macs) are probed first, one probe each. Unless search is False, the rest of the MAC space is then
+	searched bit by bit. Branches only containing nodes that were found already are skipped.
+
+	known may also be a {MAC: node address} dict, in which case the known nodes get these addresses. Other nodes get the
+	lowest addresses not taken by any of them. The number of probes sent and of known and all nodes found are put into
+	the stats dict if one is given.
+
+	"""
+	stats = {} if stats is None else stats
+	stats.update(probes=0, known=0, found=0)
+	found = []
+	reserved = set(known.values()) if isinstance(known, dict) else set()
+	for mac in dict.fromkeys(known):
+		next_address = known[mac] if isinstance(known, dict) else free_address(found, reserved)
+		stats['probes'] += 1
+		#A mask length of 0 compares the whole MAC
+		if (yield mac, 0, next_address):
+			found.append((mac, next_address))
+	stats['known'] = len(found)
+	if search:
+		yield from _search(0, 0, found, [mac for mac, _ in found], stats, reserved)
+	stats['found'] = len(found)
+	return found
+
+def _search(mask, mac, found, skip, stats, reserved):
+	"""Search the MAC space below the branch matching the mask+1 lowest bits of mac, skipping the MACs in skip."""
+	for a in [mac, 1<<mask | mac]:
+		prefix = [m for m in skip if m & ((2<<mask)-1) == a]
+		if prefix:
+			#There is a node in this branch for sure, so only its sub-branches not containing it are probed.
+			if(mask < MAC_LEN-1):
+				yield from _search(mask+1, a, found, prefix, stats, reserved)
+			continue
+		next_address = free_address(found, reserved)
+		stats['probes'] += 1
+		if (yield a, MAC_LEN-1-mask, next_address):
+			if(mask < MAC_LEN-1):
+				yield from _search(mask+1, a, found, [], stats, reserved)
+			else:
+				found.append((a, next_address))
+
+def build_macs(pattern):
+	"""Return the MACs of the nodes in the build configs matching the given glob pattern (e.g. "builds/*.config.json")."""
+	macs = []
+	for filename in glob.glob(pattern):
+		try:
+			with open(filename) as f:
+				macs.append(json.load(f)['node_id'])
+		except (OSError, ValueError, KeyError):
+			continue
+	return macs
 
 class SerialMux(object):
 
-	def __init__(self, device=None, baudrate=115200, ser=None, timeout=1):
+	def __init__(self, device=None, baudrate=115200, ser=None, timeout=1, cache=None, retries=RETRIES, adaptive=True):
+		"""SerialMux constructor
+
+		Keyword arguments:
+		timeout -- the read timeout, or the upper bound of the read timeouts if adaptive is set
+		retries -- the number of times idempotent calls are resent after a timeout or framing error
+		adaptive -- whether to compute read timeouts from the baud rate and the nodes' latencies (see AdaptiveTimeout)
+
+		"""
 		s = ser or LockableSerial(port=device, baudrate=baudrate, timeout=timeout)
+		s.retries = retries
+		s.timeouts = AdaptiveTimeout(baudrate, ceiling=timeout) if adaptive else None
 		#Trust me, without the following two lines it *wont* *work*. Fuck serial ports.
 		s.setXonXoff(True)
 		s.setXonXoff(False)
@@ -18,48 +130,204 @@ class SerialMux(object):
 		s.setDTR(True)
 		s.setDTR(False)
 		self.ser = s
+		self.cache = cache
+		self.next_group = GROUP_ADDRESS_FIRST
 	
-	def open(self, node_id):
-		""" Open a Ganglion by node ID """
-		return Ganglion(node_id, ser=self.ser)
-
-	def discover(self, mask=0, mac=0, found=None):
-		""" Discover all node IDs connected to the bus
-		
-			Note: You do not need to set any of the arguments. These are used for the recursive discovery process.
+	def open(self, node_id, shadow=None):
+		""" Open a Ganglion by node ID, optionally using a ShadowCache """
+		return Ganglion(node_id, ser=self.ser, cache=self.cache, shadow=shadow)
+
+	def group(self, ganglions, address=None, name=''):
+		""" Return a GroupGanglion sending each call as one frame to all of the given ganglions
+
+			All ganglions must be root nodes with the same callback layout, i.e. run firmware built from the same
+			config. Unless an address is given, the next free group address is allocated. The ganglions join the group
+			right away. With BROADCAST_ADDRESS, no joining is necessary but every node on the bus processes the frames.
+		"""
+		ganglions = list(ganglions)
+		if not ganglions:
+			raise ValueError('A group needs at least one member')
+		jsonconfig = ganglions[0]._jsonconfig
+		layout = callback_layout(jsonconfig)
+		for g in ganglions[1:]:
+			if callback_layout(g._jsonconfig) != layout:
+				raise ValueError('Node {} has a different callback layout than node {}'.format(g.node_id, ganglions[0].node_id))
+		if address is None:
+			if self.next_group > GROUP_ADDRESS_LAST:
+				raise ValueError('Out of group addresses')
+			address = self.next_group
+			self.next_group += 1
+		elif address != BROADCAST_ADDRESS and not GROUP_ADDRESS_FIRST <= address <= GROUP_ADDRESS_LAST:
+			raise ValueError('{:#x} is no group address'.format(address))
+		if address != BROADCAST_ADDRESS:
+			for i, g in enumerate(ganglions):
+				if not g.join_group(address):
+					for joined in ganglions[:i]:
+						joined.leave_group(address)
+					raise ValueError('Node {} cannot join any more groups'.format(g.node_id))
+		return GroupGanglion(address, jsonconfig, ser=self.ser, name=name, nodes=ganglions if address != BROADCAST_ADDRESS else ())
+
+	def upshift(self, ganglions, rates=None):
+		""" Switch the bus to the highest baud rate all of the given ganglions support and return the new rate
+
+			ganglions must include every node on the bus since they all follow the switch. Only the rates listed in the
+			nodes' descriptors (and in rates, if given) that are faster than the current one are tried. After each switch
+			all nodes are asked for their descriptor fingerprint. If any of them does not answer, the bus falls back to
+			the previous rate and the next slower rate is tried. Returns the current rate if nothing faster works.
+		"""
+		if not ganglions:
+			raise ValueError('Nothing to switch')
+		current = self.ser.baudrate
+		supported = set(rates or ganglions[0].config.get('baudrates', ()))
+		for g in ganglions:
+			supported.intersection_update(g.config.get('baudrates', ()))
+		for rate in sorted((rate for rate in supported if rate > current), reverse=True):
+			if self._switch_baudrate(ganglions, rate):
+				return rate
+		return current
+
+	def _switch_baudrate(self, ganglions, rate):
+		"""Switch the bus to the given baud rate, switching back if any of the ganglions does not answer."""
+		with self.ser as s:
+			old = s.baudrate
+			request = baudrate_request(rate)
+			s.write(request)
+			#The nodes switch as soon as they received the whole frame, so wait until it left the port
+			time.sleep(BAUDRATE_SETTLE + len(request)*10/old)
+			self._set_baudrate(rate)
+			if all(self.fingerprint(g.node_id) is not None for g in ganglions):
+				return True
+			#Nodes that did not answer yet give up the new rate on their own after this many bytes. The others are told to.
+			fallback = b'\x00'*BAUDRATE_TRIAL + baudrate_request(old)
+			s.write(fallback)
+			time.sleep(BAUDRATE_SETTLE + len(fallback)*10/rate)
+			self._set_baudrate(old)
+			if hasattr(s, 'resync'):
+				s.resync()
+			for g in ganglions:
+				if self.fingerprint(g.node_id) is None:
+					raise TimeoutException('Node {} did not come back at {} baud'.format(g.node_id, old))
+			return False
+
+	def _set_baudrate(self, rate):
+		self.ser.baudrate = rate
+		if self.ser.timeouts is not None:
+			self.ser.timeouts.bytetime = 10/rate
+
+	def pipeline(self, window=1):
+		""" Return a context manager pipelining all calls on this bus made within it (see Batch)
+
+			Since each node only holds one request, a window larger than 1 is only safe if the calls go to different nodes.
+		"""
+		return Batch(self.ser, window)
+
+	def discover(self, known=(), search=True):
+		""" Discover all nodes connected to the bus and assign them node addresses (see discovery)
+
+			Returns a list of (MAC, node address) tuples. The number of probes sent, the number of known nodes found and
+			the time taken are left in self.discovery_stats.
 		"""
-		if found is None:
-			found = []
-		for a in [mac, 1<<mask | mac]:
-			next_address = len(found)
-			if self._send_probe(a, MAC_LEN-1-mask, next_address):
-				if(mask < MAC_LEN-1):
-					self.discover(mask+1, a, found)
-				else:
-					found.append((a, next_address))
+		start = time.monotonic()
+		stats = {}
+		probes = discovery(known, search, stats)
+		try:
+			probe = next(probes)
+			while True:
+				probe = probes.send(self._send_probe(*probe))
+		except StopIteration as e:
+			found = e.value
+		stats['time'] = time.monotonic() - start
+		self.discovery_stats = stats
 		return found
 
+	def sync(self, busmap, search=True):
+		""" Bring a BusMap up to date with the nodes on the bus
+
+			Nodes found on the bus keep the addresses they have in the map. The fingerprints of the descriptors of
+			newly attached nodes are read and recorded, too. The map is saved if anything changed. Returns the lists
+			of the MACs of the nodes attached and detached since the last sync.
+		"""
+		before = busmap.present()
+		found = dict(self.discover(known=busmap.addresses(), search=search))
+		attached = [mac for mac in found if mac not in before]
+		detached = [mac for mac in before if mac not in found]
+		for mac in attached:
+			busmap.update(mac, found[mac], fingerprint=self.fingerprint(found[mac]))
+		for mac in detached:
+			busmap.update(mac, before[mac], present=False)
+		if attached or detached:
+			busmap.save()
+		return attached, detached
+
+	def watch(self, busmap, interval=5, search_every=12, on_attach=None, on_detach=None):
+		""" Start a BusWatcher syncing busmap with the bus in the background
+
+			on_attach is called with the MAC, node address and descriptor fingerprint of each newly attached node,
+			on_detach with the MAC and node address of each vanished one. Both are called from the watcher thread.
+			Call stop() on the returned watcher to stop it.
+		"""
+		watcher = BusWatcher(self, busmap, interval, search_every, on_attach, on_detach)
+		watcher.start()
+		return watcher
+
+	def fingerprint(self, node_id):
+		""" Read the descriptor fingerprint of a node, returning None for firmware predating fingerprints """
+		request = CallPlan(node_id, 0, 'B').request((1,))
+		with self.ser as s:
+			s.write(request)
+			try:
+				cbytes = bytes(read_response(s, node_id, len(request), getattr(s, 'timeouts', None)))
+			except TimeoutException:
+				if hasattr(s, 'resync'):
+					s.resync()
+				return None
+		return decode_fingerprint(cbytes)
+
 	def _send_probe(self, mac, mask, next_address):
 		#print('Discovery: mac', mac, 'mask', mask)
 		with self.ser as s:
-			s.write(b'\\#\xFF\xFF' + escape(struct.pack('>HHQ', next_address, mask, mac)))
-			timeout_tmp = s.timeout
-			s.timeout = 0.05
+			request = probe_request(mac, mask, next_address)
+			timeouts = getattr(s, 'timeouts', None)
+			s.write(request)
+			if timeouts is None:
+				timeout = PROBE_TIMEOUT
+			else:
+				#Nodes answer probes right away, so the bus' latency applies
+				timeout = timeouts.timeout(None, len(request)+1, PROBE_TIMEOUT)
+				start = time.monotonic()
 			try:
-				s.read(1)
-				s.timeout = timeout_tmp
-				return True
+				s.read(1, timeout)
 			except TimeoutException:
-				s.timeout = timeout_tmp
 				return False
+			if timeouts is not None:
+				timeouts.observe(None, time.monotonic()-start, len(request)+1)
+			return True
 	
 	def __del__(self):
 		self.ser.close()
 
 class LockableSerial(serial.Serial):
+	"""Serial port with a lock for exclusive access and a read-ahead receive buffer
+
+	Reads fill the buffer with everything the OS has received so far, so the length prefix and the payload of a
+	response usually come in with one syscall. On POSIX systems, data is read right into the buffer with readv.
+
+	"""
+
 	def __init__(self, *args, **kwargs):
 		super(serial.Serial, self).__init__(*args, **kwargs)
 		self.lock = threading.RLock()
+		self.batch = None
+		#rxbuf[rxstart:rxend] contains data received but not yet consumed
+		self.rxbuf = bytearray(RXBUF_SIZE)
+		self.rxview = memoryview(self.rxbuf)
+		self.rxstart = self.rxend = 0
+		self.retries = RETRIES
+		self.resyncs = 0
+		#Fixed timeouts unless SerialMux sets an AdaptiveTimeout
+		self.timeouts = None
+		#pyserial opens the tty non-blocking on POSIX
+		self.readv = hasattr(os, 'readv') and hasattr(self, 'fd')
 
 	def __enter__(self):
 		self.lock.__enter__()
@@ -68,10 +336,84 @@ class LockableSerial(serial.Serial):
 	def __exit__(self, *args):
 		self.lock.__exit__(*args)
 	
-	def read(self, n):
-		"""Read n bytes from the serial device and raise a TimeoutException in case of a timeout."""
-		data = serial.Serial.read(self, n)
-		if len(data) != n:
-			raise TimeoutException('Read {} bytes trying to read {}'.format(len(data), n))
-		return data
+	def read(self, n, timeout=None):
+		"""Read n bytes from the serial device and raise a TimeoutException in case of a timeout.
+
+		timeout overrides the port's timeout for this read.
+
+		"""
+		return bytes(self.readview(n, timeout))
+
+	def readview(self, n, timeout=None):
+		"""Like read, but return a memoryview into the receive buffer that is only valid until the next read."""
+		if self.rxend - self.rxstart < n:
+			self._fill(n, self.timeout if timeout is None else timeout)
+		start = self.rxstart
+		self.rxstart += n
+		return self.rxview[start:self.rxstart]
+
+	def _fill(self, n, timeout):
+		"""Receive data until at least n bytes are buffered."""
+		avail = self.rxend - self.rxstart
+		if self.rxstart + n > len(self.rxbuf):
+			#Move the buffered data to the front, growing the buffer if it is too small. Views handed out earlier
+			#are invalid by now anyway.
+			if n > len(self.rxbuf):
+				rxbuf = bytearray(n)
+				rxbuf[:avail] = self.rxview[self.rxstart:self.rxend]
+				self.rxbuf, self.rxview = rxbuf, memoryview(rxbuf)
+			else:
+				self.rxbuf[:avail] = self.rxbuf[self.rxstart:self.rxend]
+			self.rxstart, self.rxend = 0, avail
+		if not self.readv:
+			default = self.timeout
+			if timeout != default:
+				#Reconfigures the port, but only platforms without readv get here
+				self.timeout = timeout
+			try:
+				data = serial.Serial.read(self, n-avail)
+			finally:
+				if timeout != default:
+					self.timeout = default
+			self.rxview[self.rxend:self.rxend+len(data)] = data
+			self.rxend += len(data)
+		else:
+			deadline = None if timeout is None else time.monotonic() + timeout
+			while self.rxend - self.rxstart < n:
+				try:
+					received = os.readv(self.fd, [self.rxview[self.rxend:]])
+				except BlockingIOError:
+					received = 0
+				if received:
+					self.rxend += received
+					continue
+				remaining = None if deadline is None else deadline - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					break
+				select.select([self.fd], [], [], remaining)
+		if self.rxend - self.rxstart < n:
+			#Like a plain read, a timed out read consumes what it got
+			got, self.rxstart = self.rxend - self.rxstart, self.rxend
+			raise TimeoutException('Read {} bytes trying to read {}'.format(got, n))
+
+	def resync(self, limit=RESYNC_LIMIT):
+		"""Get back in step with the bus after a timeout or framing error
+
+		Discards everything received until the line has been quiet for a few character times, e.g. the late response
+		to a timed out request. Since every request frame starts with an escaped preamble that resets the nodes'
+		receivers, the next request is then understood again. Gives up draining after limit seconds.
+
+		"""
+		self.resyncs += 1
+		#Ten bytes worth of line time, at least RESYNC_QUIET
+		quiet = max(RESYNC_QUIET, 100/self.baudrate)
+		deadline = time.monotonic() + limit
+		while True:
+			self.reset_input_buffer()
+			time.sleep(quiet)
+			if not self.in_waiting or time.monotonic() > deadline:
+				break
 
+	def reset_input_buffer(self):
+		self.rxstart = self.rxend = 0
+		serial.Serial.reset_input_buffer(self)
@@ -0,0 +1,69 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import time
+
+"""Shadow copies of device property values."""
+
+class ShadowCache(object):
+	"""Last known packed value of each property of the ganglions using it
+
+	Writes of a value whose packed bytes equal the last value written are suppressed. Since some getters do not read
+	back what the setter wrote (e.g. simple-io's state reads PIN but writes PORT), a value that was read never
+	suppresses a write.
+
+	Reads are served from the shadow copy if it is younger than ttl seconds, or at any age for properties listed in
+	write_only. write_only entries may either be plain property names ("pwm") or be qualified with the member name
+	("ampelrot.state"). Use it only for properties that do not change on the device by themselves, such as outputs.
+
+	Entries are keyed by node address and callback id, so one cache can be shared by all ganglions on a bus. Call
+	clear() after rediscovering the bus.
+
+	"""
+
+	def __init__(self, ttl=0, write_only=()):
+		self.ttl = ttl
+		self.write_only = set(write_only)
+		self.entries = {}
+		self.hits = 0
+		self.misses = 0
+		self.suppressed = 0
+		self.writes = 0
+
+	def lookup(self, key, name, qualname):
+		"""Return the shadowed value of a property that may be read from the shadow, else None."""
+		entry = self.entries.get(key)
+		if entry is not None:
+			payload, timestamp, written = entry
+			if name in self.write_only or qualname in self.write_only or time.time() - timestamp < self.ttl:
+				self.hits += 1
+				return payload
+		self.misses += 1
+		return None
+
+	def suppress(self, key, payload):
+		"""Check whether writing payload would not change the property. Counts the write either way."""
+		entry = self.entries.get(key)
+		if entry is not None and entry[2] and entry[0] == payload:
+			self.suppressed += 1
+			return True
+		self.writes += 1
+		return False
+
+	def update(self, key, payload, written):
+		"""Store a property's value after it was written or read."""
+		self.entries[key] = (payload, time.time(), written)
+
+	def invalidate(self, key):
+		"""Forget a property's value, e.g. after part of it was written."""
+		self.entries.pop(key, None)
+
+	def clear(self):
+		self.entries.clear()
+
+	def stats(self):
+		"""Return the hit/miss counts of reads and the suppressed/sent counts of writes."""
+		return {'hits': self.hits, 'misses': self.misses, 'suppressed': self.suppressed, 'writes': self.writes}
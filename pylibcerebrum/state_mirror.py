@@ -0,0 +1,184 @@
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+from pylibcerebrum.ganglion import FramingError, read_response, _retval
+from pylibcerebrum.timeout_exception import TimeoutException
+
+"""Shared-memory mirror of the property values of a ganglion tree.
+
+The mirror file starts with a header (see HEADER) of a magic, a format version, a sequence counter and the length of
+the layout that follows it. The layout is a JSON object mapping property paths ("member/property") to [offset, fmt]
+pairs. At each offset, the time of the last update (a little-endian double) is followed by the property's value as
+packed by the device, i.e. according to fmt.
+
+The sequence counter works like a seqlock: the writer makes it odd before and even again after each update. A reader
+copies the values it wants and retries if the counter was odd or changed meanwhile. Since a reader only ever reads
+from the mapped memory, reading a value takes no syscall and no bus traffic.
+
+"""
+
+MAGIC = b'CRBM'
+VERSION = 1
+HEADER = struct.Struct('<4sIQI')
+#Offset of the sequence counter in the header
+SEQ_OFFSET = 8
+SEQ = struct.Struct('<Q')
+TIMESTAMP = struct.Struct('<d')
+#Time a reader waits for an update in progress before giving up
+READ_TIMEOUT = 1
+
+def mirror_layout(g, prefix=''):
+	"""Yield (path, ganglion, property name) for each property of a ganglion and its members, recursively."""
+	for name in sorted(g.properties):
+		yield prefix+name, g, name
+	for name in sorted(g.members):
+		yield from mirror_layout(g.members[name], prefix+name+'/')
+
+class StateMirror(object):
+	"""Poller writing the latest values of the properties of a ganglion tree to a memory-mapped file
+
+	Put the file on a tmpfs (e.g. /dev/shm) so it never hits the disk. Readers in other processes open it using
+	MirrorReader. properties optionally restricts the mirror to the given property paths.
+
+	"""
+
+	def __init__(self, g, path, properties=None):
+		self.path = path
+		#[(ganglion, getter CallPlan, offset)]
+		self.slots = []
+		layout = {}
+		offset = 0
+		for propath, node, name in mirror_layout(g):
+			if properties is not None and propath not in properties:
+				continue
+			getplan = node._callplans[name][0]
+			fmt = node.properties[name][1]
+			layout[propath] = [offset, fmt]
+			self.slots.append((node, getplan, offset))
+			#Keep the timestamps aligned
+			offset += (TIMESTAMP.size + getplan.retlen + 7) & ~7
+		layoutbytes = json.dumps(layout, separators=(',',':')).encode()
+		self.base = (HEADER.size + len(layoutbytes) + 7) & ~7
+		with open(path, 'wb') as f:
+			f.write(HEADER.pack(MAGIC, VERSION, 0, len(layoutbytes)) + layoutbytes)
+			f.truncate(self.base + offset)
+		self.fd = os.open(path, os.O_RDWR)
+		self.mm = mmap.mmap(self.fd, self.base + offset)
+		self.seq = 0
+		self.thread = None
+		self.stopped = threading.Event()
+
+	def update(self, offset, payload):
+		"""Write a property value (as packed by the device) to the slot at offset."""
+		base = self.base + offset
+		self.seq += 1
+		SEQ.pack_into(self.mm, SEQ_OFFSET, self.seq)
+		TIMESTAMP.pack_into(self.mm, base, time.time())
+		self.mm[base+TIMESTAMP.size:base+TIMESTAMP.size+len(payload)] = payload
+		self.seq += 1
+		SEQ.pack_into(self.mm, SEQ_OFFSET, self.seq)
+
+	def poll(self):
+		"""Read all mirrored properties once and update the mirror. Returns the number of properties updated.
+
+		Properties whose read fails keep their last value and timestamp.
+
+		"""
+		updated = 0
+		for node, getplan, offset in self.slots:
+			with node._ser as s:
+				#Getters take no arguments, so the request is just the header
+				s.write(getplan.header)
+				try:
+					cbytes = read_response(s, getplan.node_id, len(getplan.header), getattr(s, 'timeouts', None))
+					if len(cbytes) != getplan.retlen:
+						raise FramingError()
+				except (TimeoutException, FramingError):
+					if hasattr(s, 'resync'):
+						s.resync()
+					continue
+				self.update(offset, cbytes)
+			updated += 1
+		return updated
+
+	def start(self, interval=0.1):
+		"""Poll in a background thread every interval seconds."""
+		def run():
+			while not self.stopped.wait(interval):
+				self.poll()
+		self.thread = threading.Thread(target=run, daemon=True)
+		self.thread.start()
+
+	def close(self):
+		if self.thread is not None:
+			self.stopped.set()
+			self.thread.join()
+		self.mm.close()
+		os.close(self.fd)
+
+class MirrorReader(object):
+	"""Read-only view of a StateMirror's file"""
+
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, seq, layoutlen = HEADER.unpack_from(self.mm)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError('{} is not a state mirror of version {}'.format(path, VERSION))
+		layout = json.loads(self.mm[HEADER.size:HEADER.size+layoutlen].decode())
+		base = (HEADER.size + layoutlen + 7) & ~7
+		#{path: (offset, value Struct)}
+		self.layout = {propath: (base+offset, struct.Struct(fmt)) for propath, (offset, fmt) in layout.items()}
+
+	@property
+	def seq(self):
+		"""The sequence counter, counting up by two with each update."""
+		return SEQ.unpack_from(self.mm, SEQ_OFFSET)[0]
+
+	def _consistent(self, read):
+		"""Call read() until it ran while no update was in progress and return its result."""
+		deadline = None
+		while True:
+			(before,) = SEQ.unpack_from(self.mm, SEQ_OFFSET)
+			if not before & 1:
+				rv = read()
+				if SEQ.unpack_from(self.mm, SEQ_OFFSET)[0] == before:
+					return rv
+			if deadline is None:
+				deadline = time.monotonic() + READ_TIMEOUT
+			elif time.monotonic() > deadline:
+				raise TimeoutException('The state mirror has been in the middle of an update for too long')
+
+	def _read(self, propath):
+		offset, value = self.layout[propath]
+		return self.mm[offset:offset+TIMESTAMP.size+value.size]
+
+	def _decode(self, propath, raw):
+		(timestamp,) = TIMESTAMP.unpack_from(raw)
+		return timestamp, _retval(self.layout[propath][1].unpack_from(raw, TIMESTAMP.size))
+
+	def get(self, propath):
+		"""Return the latest value of a property, or None if it has not been read yet."""
+		return self.get_timestamped(propath)[1]
+
+	def get_timestamped(self, propath):
+		"""Return the time of the last update of a property and its value, or (0, None) if it has not been read yet."""
+		timestamp, value = self._decode(propath, self._consistent(lambda: self._read(propath)))
+		return (timestamp, value) if timestamp else (0, None)
+
+	def snapshot(self):
+		"""Return a consistent {path: value} dict of all properties."""
+		raws = self._consistent(lambda: {propath: self._read(propath) for propath in self.layout})
+		return {propath: (self._decode(propath, raw)[1] if TIMESTAMP.unpack_from(raw)[0] else None) for propath, raw in raws.items()}
+
+	def close(self):
+		self.mm.close()
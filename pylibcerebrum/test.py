@@ -1,8 +1,28 @@
-from pylibcerebrum.ganglion import Ganglion
-from pylibcerebrum.serial_mux import SerialMux
+from pylibcerebrum.ganglion import Ganglion, GroupGanglion, FramingError
+from pylibcerebrum.serial_mux import SerialMux, LockableSerial, probe_request
+from pylibcerebrum.async_mux import AsyncSerialMux, AsyncGanglion
+from pylibcerebrum.descriptor_cache import DescriptorCache
+from pylibcerebrum.compact_descriptor import encode_descriptor, decode_descriptor
+from pylibcerebrum.shadow import ShadowCache
+from pylibcerebrum.bus_map import BusMap
+from pylibcerebrum.bus_manager import BusManager
+from pylibcerebrum.broker import Broker, BrokerClient, BusScheduler, MSG_CALL, MSG_LIST, STATUS_OK, STATUS_ERROR
+from pylibcerebrum.state_mirror import StateMirror, MirrorReader
+from pylibcerebrum.poll_scheduler import PollScheduler, MAX_SLOWDOWN
+from pylibcerebrum.adaptive_timeout import AdaptiveTimeout, MIN_TIMEOUT
 from pylibcerebrum.timeout_exception import TimeoutException
 import unittest
 import serial
+import socket
+import struct
+import json
+import threading
+import itertools
+import asyncio
+import tempfile
+import pty
+import time
+import os
 import generator
 
 class TestGanglion(generator.TestCommStuff):
@@ -20,6 +40,63 @@ class TestGanglion(generator.TestCommStuff):
 		self.assert_('version' in g.config, 'The ganglion has an invalid config without a version attribute')
 		self.assertEqual(g.config['version'], 0.17, 'The ganglion\'s config\'s version attribute is wrong')
 
+	def test_connect_cached(self):
+		fs = FakeSerial()
+		config = b'{"version":0.17,"builddate":"2012-05-23 23:42:17","members":{}}'
+		with tempfile.TemporaryDirectory() as d:
+			cache = DescriptorCache(d)
+			#Cache miss: the device is asked for the fingerprint, then for the whole descriptor
+			fs.inp += b'\x00\x09=\x01\x02\x03\x04\x05\x06\x07\x08\x00\x3F' + config
+			g = Ganglion(0x2342, ser=fs, cache=cache)
+			self.assertEqual(fs.out, b'\\#\x23\x42\x00\x00\x00\x01\x01\\#\x23\x42\x00\x00\x00\x00', 'The ganglion sent garbage trying to read the device config.')
+			self.assertEqual(cache.get('0102030405060708')['builddate'], '2012-05-23 23:42:17', 'The descriptor was not cached')
+			#Cache hit: only the fingerprint is transferred
+			fs.out = b''
+			fs.inp += b'\x00\x09=\x01\x02\x03\x04\x05\x06\x07\x08'
+			g = Ganglion(0x2342, ser=fs, cache=cache)
+			self.assertEqual(fs.out, b'\\#\x23\x42\x00\x00\x00\x01\x01', 'The ganglion sent garbage trying to read the device config.')
+			self.assertEqual(g.config['version'], 0.17, 'The ganglion\'s config\'s version attribute is wrong')
+
+	def test_connect_cached_old_firmware(self):
+		#Firmware without fingerprint support just returns the descriptor
+		fs = FakeSerial()
+		fs.inp += b'\x00\x3F{"version":0.17,"builddate":"2012-05-23 23:42:17","members":{}}'
+		with tempfile.TemporaryDirectory() as d:
+			g = Ganglion(0x2342, ser=fs, cache=DescriptorCache(d))
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x00\x00\x01\x01', 'The ganglion sent garbage trying to read the device config.')
+		self.assertEqual(g.config['version'], 0.17, 'The ganglion\'s config\'s version attribute is wrong')
+
+	def test_connect_compact(self):
+		config = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'snapshot': {'id': 7, 'properties': [['foo', 'bar']]}, 'members': {'foo': {'type': 'test', 'pin': 3,
+			'properties': {'bar': {'size': 2, 'id': 1, 'fmt': '>H', 'access': 'r'}, 'baz': {'size': 16, 'id': 3, 'fmt': '16B', 'range': [5, 12]}},
+			'functions': {'callback': {'id': 6, 'args': 'B'}}}}}
+		cbytes = encode_descriptor(config)
+		fs = FakeSerial()
+		fs.inp += struct.pack('>H', len(cbytes)) + cbytes
+		g = Ganglion(0x2342, ser=fs)
+		self.assertEqual(g._jsonconfig, config, 'The compact descriptor was not decoded into the original config')
+		self.assertEqual(g.foo.config['pin'], 3, 'The compact descriptor lost a member\'s config')
+		self.assertRaises(ValueError, encode_descriptor, {'members': {'foo': {'properties': {'bar': {'size': 2, 'id': 1, 'fmt': '>H', 'access': 'w'}}}}})
+
+	def test_compact_roundtrip(self):
+		#Shared shapes, numbered member names, wide ints and all kinds of config values
+		led = {'type': 'led', 'pin': 5, 'properties': {'state': {'size': 1, 'id': 40, 'fmt': 'B'}}}
+		config = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {
+			'led{}'.format(i): dict(led, pin=i, properties={'state': dict(led['properties']['state'], id=40+i)}) for i in range(12)}}
+		config['members']['led07'] = led
+		config['members']['matrix'] = {'type': 'matrix', 'keys': {'a': [1, 2], 'b': [[3, 4], [5, 0x12345678]]},
+				'mixed': [1, 'x', None, True, 2.5, -7, 1<<40], 'scale': 0.25, 'big': 1<<33, 'negative': -300,
+				'inverted': False, 'empty': [], 'names': ['x', 'y'], 'functions': {'reset': {'id': 70000}}}
+		self.assertEqual(decode_descriptor(encode_descriptor(config)), config, 'The compact descriptor did not survive a round trip')
+
+	def test_lazy_members(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "members": {"bar": {"type": "test"}}}, "baz": {"type": "test"}}})
+		self.assertEqual(g.members._nodes, {}, 'Member nodes were constructed before they were accessed.')
+		self.assertIs(g.foo, g.foo, 'Member nodes were constructed more than once.')
+		self.assertEqual(list(g.members._nodes), ['foo'], 'Member nodes were constructed before they were accessed.')
+		self.assertEqual(sorted(m.name for m in g), ['bar', 'baz', 'foo'], 'Iterating over the ganglion missed some members.')
+
 	def test_simple_callback_invocation(self):
 		fs = FakeSerial()
 		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "functions": {"callback": {"id": 1}}}}})
@@ -80,6 +157,56 @@ class TestGanglion(generator.TestCommStuff):
 		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x02\x01\x01'+b'A'*0x101, 'Somehow pylibcerebrum sent a wrong command to the device.')
 		pass
 
+	def test_shadow_write_suppression(self):
+		fs = FakeSerial()
+		shadow = ShadowCache()
+		g = Ganglion(0x2342, ser=fs, shadow=shadow, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}}}})
+		fs.inp += b'\x00\x00'*2
+		g.foo.prop = 0x41
+		g.foo.prop = 0x41
+		g.foo.prop = 0x42
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x02\x00\x01\x41\\#\x23\x42\x00\x02\x00\x01\x42', 'A redundant write was not suppressed.')
+		#The shadow copy is only used for reads of write-only properties or within the ttl
+		fs.inp += b'\x00\x01\x43'
+		self.assertEqual(g.foo.prop, 0x43, 'Somehow a device response was decoded wrong.')
+		self.assertEqual(shadow.stats(), {'hits': 0, 'misses': 1, 'suppressed': 1, 'writes': 2})
+		#A value that was only read does not suppress a write
+		fs.inp += b'\x00\x00'
+		g.foo.prop = 0x43
+		self.assertEqual(shadow.stats()['writes'], 3, 'A write was suppressed by a value that was read.')
+
+	def test_shadow_reads(self):
+		fs = FakeSerial()
+		shadow = ShadowCache(ttl=3600, write_only=['foo.out'])
+		g = Ganglion(0x2342, ser=fs, shadow=shadow, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "3B", "id": 1, "size": 3}, "out": {"fmt": "B", "id": 3, "size": 1}}}}})
+		fs.inp += b'\x00\x03ABC\x00\x00'
+		self.assertEqual(g.foo.prop, [0x41, 0x42, 0x43], 'Somehow a device response was decoded wrong.')
+		self.assertEqual(g.foo.prop, [0x41, 0x42, 0x43], 'Somehow a shadowed value was decoded wrong.')
+		g.foo.out = 0x44
+		shadow.ttl = 0
+		self.assertEqual(g.foo.out, 0x44, 'Somehow a shadowed value was decoded wrong.')
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x01\x00\x00\\#\x23\x42\x00\x04\x00\x01\x44', 'A read was not served from the shadow copy.')
+		self.assertEqual(shadow.stats(), {'hits': 2, 'misses': 1, 'suppressed': 0, 'writes': 1})
+
+	def test_notifylist_ranged_write(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "65B", "id": 1, "size": 65, "range": [3, 30]}}}}})
+		fs.inp += b'\x00\x41' + b'A'*65
+		foo = g.foo.prop
+		fs.out = b''
+		#Single elements and short slices only send the changed range
+		fs.inp += b'\x00\x00'*3
+		foo[64] = 0x42
+		foo[1:3] = [0x43, 0x44]
+		foo[-2] = 0x45
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x03\x00\x03\x00\x40\x42' + b'\\#\x23\x42\x00\x03\x00\x04\x00\x01\x43\x44' + b'\\#\x23\x42\x00\x03\x00\x03\x00\x3F\x45', 'Somehow pylibcerebrum sent a wrong command to the device.')
+		#Long ranges are split into chunks fitting the device's argument buffer, whole-list changes are written at once
+		fs.out = b''
+		fs.inp += b'\x00\x00'*3
+		foo[0:40] = [0x46]*40
+		foo[:] = [0x47]*65
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x03\x00\x20\x00\x00' + b'F'*30 + b'\\#\x23\x42\x00\x03\x00\x0C\x00\x1E' + b'F'*10 + b'\\#\x23\x42\x00\x02\x00\x41' + b'G'*65, 'Somehow pylibcerebrum sent a wrong command to the device.')
+
 	def test_attribute_forbidden_write(self):
 		fs = FakeSerial()
 		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1, "access": "r"}}}}})
@@ -87,43 +214,745 @@ class TestGanglion(generator.TestCommStuff):
 		with self.assertRaises(TypeError, msg="prop is a read-only property"):
 			g.foo.prop = 0x41
 
+	def test_multiple_functions(self):
+		#Each function proxy must call its own function id
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "functions": {"first": {"id": 1}, "second": {"id": 2, "args": "B"}}}}})
+		fs.inp += b'\x00\x00\x00\x00'
+		g.foo.first()
+		g.foo.second(0x41)
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x01\x00\x00\\#\x23\x42\x00\x02\x00\x01\x41', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_call_plan_escaping(self):
+		#Node id, setter function id and payload all contain backslashes that need to be escaped
+		fs = FakeSerial()
+		g = Ganglion(0x5C42, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "2B", "id": 0x5B, "size": 2}}}}})
+		fs.inp += b'\x00\x00'
+		g.foo.prop = (0x5C, 0x41)
+		self.assertEqual(fs.out, b'\\#\\\\\x42\x00\\\\\x00\x02\\\\\x41', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_snapshot(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'snapshot': {'id': 5, 'properties': [['foo', 'prop'], ['foo', 'arr'], ['bar', 'prop']]}, 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}, "arr": {"fmt": "3B", "id": 3, "size": 3}}}, "bar": {"type": "test", "properties": {"prop": {"fmt": "<H", "id": 7, "size": 2}}}}})
+		fs.inp += b'\x00\x06\x41\x01\x02\x03\x34\x12'
+		self.assertEqual(g.snapshot(), {'foo': {'prop': 0x41, 'arr': [1, 2, 3]}, 'bar': {'prop': 0x1234}}, 'Somehow a snapshot was decoded wrong.')
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x05\x00\x00', 'Somehow pylibcerebrum sent a wrong command to the device.')
+		self.assertNotIn('snapshot', g.config)
+		with self.assertRaises(AttributeError):
+			g.foo.snapshot()
+
+	def test_snapshot_mixed_byte_order(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'snapshot': {'id': 5, 'properties': [['foo', 'le'], ['foo', 'be']]}, 'members': {"foo": {"type": "test", "properties": {"le": {"fmt": "<H", "id": 1, "size": 2}, "be": {"fmt": ">H", "id": 3, "size": 2}}}}})
+		fs.inp += b'\x00\x04\x34\x12\x12\x34'
+		self.assertEqual(g.snapshot(), {'foo': {'le': 0x1234, 'be': 0x1234}}, 'Somehow a snapshot was decoded wrong.')
+
+	def test_events(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'events': {'id': 5, 'sources': [['foo', 'state'], ['bar', 'state']]}, 'members': {"foo": {"type": "simple-io"}, "bar": {"type": "matrix_input"}}})
+		fs.inp += b'\x00\x07\x02\x01\x04\x01\x00\x00\x01'
+		events = g.events()
+		self.assertEqual(events, [('bar', 'state', 4, 1), ('foo', 'state', 0, 1)], 'Somehow the events were decoded wrong.')
+		self.assertEqual(events.dropped, 2, 'Somehow the number of dropped events was decoded wrong.')
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x05\x00\x00', 'Somehow pylibcerebrum sent a wrong command to the device.')
+		fs.inp += b'\x00\x01\x00'
+		self.assertEqual(g.events(), [], 'Somehow the events were decoded wrong.')
+		with self.assertRaises(AttributeError):
+			g.foo.events()
+
+	def test_update(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'multiset': {'id': 9, 'size': 12}, 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}, "arr": {"fmt": "3B", "id": 3, "size": 3}}}, "bar": {"type": "test", "properties": {"prop": {"fmt": "<H", "id": 5, "size": 2}}}}})
+		fs.inp += b'\x00\x00'*3
+		g.update({'foo.prop': 0x41, 'foo.arr': [1, 2, 3], 'bar.prop': 0x1234})
+		#The third record does not fit into the 12 byte buffer anymore
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x09\x00\x0A\x00\x02\x01\x41\x00\x04\x03\x01\x02\x03'
+				+ b'\\#\x23\x42\x00\x09\x00\x05\x00\x06\x02\x34\x12', 'Somehow pylibcerebrum sent a wrong command to the device.')
+		self.assertEqual(fs.inp, b'', 'The responses to the multi-set calls were not read.')
+		#Member nodes use their root node's multi-set callback
+		fs.out = b''
+		fs.inp += b'\x00\x00'
+		g.bar.update({'prop': 0x1234})
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x09\x00\x05\x00\x06\x02\x34\x12', 'Somehow pylibcerebrum sent a wrong command to the device.')
+		with self.assertRaises(AttributeError):
+			g.update({'foo.nonexistent': 1})
+
+	def test_update_shadow(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, shadow=ShadowCache(), jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'multiset': {'id': 9, 'size': 32}, 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}, "other": {"fmt": "B", "id": 3, "size": 1}}}}})
+		fs.inp += b'\x00\x00'*3
+		g.set_many([('foo.prop', 1), ('foo.other', 2)])
+		fs.out = b''
+		g.set_many([('foo.prop', 1), ('foo.other', 3)])
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x09\x00\x04\x00\x04\x01\x03', 'An unchanged property was written again.')
+
+	def test_update_without_multiset(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}, "other": {"fmt": "B", "id": 3, "size": 1}}}}})
+		fs.inp += b'\x00\x00'*2
+		g.update({'foo.prop': 1, 'foo.other': 2})
+		self.assertEqual(fs.writes, 2, 'The property writes were not sent one at a time.')
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x02\x00\x01\x01\\#\x23\x42\x00\x04\x00\x01\x02', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_batch(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}, "functions": {"callback": {"id": 3, "args": "B", "returns": "2B"}}}}})
+		with g.batch():
+			g.foo.prop = 0x41
+			prop = g.foo.prop
+			rv = g.foo.callback(0x44)
+			#Nothing is sent before the batch is complete
+			self.assertEqual(fs.out, b'', 'Somehow pylibcerebrum sent a batched command too early.')
+			fs.inp += b'\x00\x00\x00\x01\x41\x00\x02\x42\x43'
+		#The node only holds one request, so each is sent once the previous one was answered
+		self.assertEqual(fs.writes, 3, 'The batched commands were not sent one at a time.')
+		self.assertEqual(fs.out, b'\\#\x23\x42\x00\x02\x00\x01\x41\\#\x23\x42\x00\x01\x00\x00\\#\x23\x42\x00\x03\x00\x01\x44', 'Somehow pylibcerebrum sent a wrong command to the device.')
+		self.assertEqual(prop.result(), 0x41, 'Somehow a device response was decoded wrong.')
+		self.assertEqual(rv.result(), [0x42, 0x43], 'Somehow a device response was decoded wrong.')
+
+	def test_batch_window(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}}}})
+		fs.inp += b'\x00\x00'*3
+		with g.batch(window=2):
+			for i in range(3):
+				g.foo.prop = i
+		self.assertEqual(fs.writes, 2, 'The batched commands were not sent according to the window size.')
+		self.assertEqual(fs.out, b''.join(b'\\#\x23\x42\x00\x02\x00\x01'+bytes([i]) for i in range(3)), 'Somehow pylibcerebrum sent a wrong command to the device.')
+		fs.inp += b'\x00\x00'*3
+		with g.batch(window=None):
+			for i in range(3):
+				g.foo.prop = i
+		self.assertEqual(fs.writes, 3, 'The batched commands were not sent in one write.')
+
+	def test_batch_response_error(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}}}})
+		#The first response is fine, the second one is missing its payload
+		fs.inp += b'\x00\x01\x41\x00\x00'
+		with self.assertRaises(AttributeError):
+			with g.batch():
+				first = g.foo.prop
+				second = g.foo.prop
+		self.assertEqual(first.result(), 0x41, 'Somehow a device response was decoded wrong.')
+		with self.assertRaises(AttributeError):
+			second.result()
+
+	def test_call_return_values(self):
+		#Calls decode their responses the same with and without adaptive timeouts
+		for timeouts in (None, AdaptiveTimeout(115200)):
+			fs = FakeSerial()
+			fs.timeouts = timeouts
+			g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "functions": {"none": {"id": 1}, "one": {"id": 2, "returns": "B"}, "two": {"id": 3, "returns": ">HB"}}}}})
+			fs.inp += b'\x00\x00\x00\x01\x41\x00\x03\x12\x34\x42'
+			self.assertIsNone(g.foo.none())
+			self.assertEqual(g.foo.one(), 0x41)
+			self.assertEqual(g.foo.two(), [0x1234, 0x42])
+			fs.inp += b'\x00\x02\x41\x42'
+			with self.assertRaises(FramingError):
+				g.foo.one()
+			self.assertEqual(fs.inp, b'', 'The response was not consumed after a framing error.')
+
+	def test_framing_error_retry(self):
+		fs = FakeSerial()
+		fs.retries = 2
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}}}})
+		#A truncated response followed by one of the wrong length
+		fs.responses = [b'\x00\x01', b'\x00\x02\x41\x42', b'\x00\x01\x41']
+		self.assertEqual(g.foo.prop, 0x41, 'The property read was not retried after a framing error.')
+		self.assertEqual(fs.writes, 3)
+		self.assertEqual(fs.resyncs, 2, 'The port was not resynchronized after a framing error.')
+		fs.responses = [b'\x00\x01']*3
+		with self.assertRaises(TimeoutException):
+			g.foo.prop
+		self.assertEqual(fs.writes, 6, 'The retry budget was not respected.')
+
+	def test_framing_error_no_function_retry(self):
+		fs = FakeSerial()
+		fs.retries = 2
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "functions": {"bar": {"id": 1, "args": "B", "returns": "B"}}}}})
+		fs.responses = [b'\x00\x00', b'\x00\x01\x41']
+		with self.assertRaises(FramingError):
+			g.foo.bar(1)
+		self.assertEqual(fs.writes, 1, 'A function call that is not known to be idempotent was resent.')
+		self.assertEqual(fs.resyncs, 1)
+
 class TestMux(unittest.TestCase):
 	def test_probe(self):
 		fs = FakeSerial()
 		m = SerialMux(ser=fs)
 		fs.inp += b'\xFF'
-		self.assertTrue(m._send_probe(0x2342, 5))
-		self.assertEqual(fs.out, b'\\#\xFF\xFF\x23\x42\x00\x05')
-		self.assertFalse(m._send_probe(0x2342, 5))
+		self.assertTrue(m._send_probe(0x2342, 5, 3))
+		self.assertEqual(fs.out, b'\\#\xFF\xFF\x00\x03\x00\x05\x00\x00\x00\x00\x00\x00\x23\x42')
+		self.assertFalse(m._send_probe(0x2342, 5, 3))
 
 	def test_discovery(self):
+		bus = FakeBus([0x2342])
+		m = SerialMux(ser=bus)
+		self.assertEqual(m.discover(), [(0x2342, 0)])
+		self.assertEqual(bus.addresses, {0x2342: 0})
+		#Every probe is a well-formed frame to the discovery address
+		probes = bus.out.split(b'\\#')[1:]
+		self.assertEqual(len(probes), bus.probes)
+		self.assertTrue(all(probe[:2] == b'\xFF\xFF' and len(probe) == 14 for probe in probes))
+
+	def assertDiscovered(self, bus, found, macs):
+		self.assertEqual(sorted(mac for mac, _ in found), sorted(macs), 'Discovery found the wrong nodes.')
+		self.assertEqual(len(set(a for _, a in found)), len(found), 'Discovery assigned a node address twice.')
+		for mac, address in found:
+			self.assertEqual(bus.addresses[mac], address, 'A node ended up with another address than reported.')
+
+	def test_discovery_search(self):
+		macs = [0x2342, 0x2343, 0x1234567890ABCDEF, 0xFFFFFFFFFFFFFFFE]
+		bus = FakeBus(macs)
+		m = SerialMux(ser=bus)
+		self.assertDiscovered(bus, m.discover(), macs)
+		self.assertEqual(m.discovery_stats['probes'], bus.probes)
+		self.assertEqual(m.discovery_stats['found'], 4)
+
+	def test_discovery_known(self):
+		macs = [0x2342, 0x2343, 0x1234567890ABCDEF, 0xFFFFFFFFFFFFFFFE]
+		bus = FakeBus(macs)
+		m = SerialMux(ser=bus)
+		m.discover()
+		full = m.discovery_stats['probes']
+		#0x4223 is not on the bus anymore, 0xFFFFFFFFFFFFFFFE was added since
+		bus.probes = 0
+		self.assertDiscovered(bus, m.discover(known=[0x2342, 0x4223, 0x2343, 0x1234567890ABCDEF]), macs)
+		self.assertEqual(m.discovery_stats['known'], 3)
+		self.assertEqual(m.discovery_stats['probes'], bus.probes)
+		self.assertLess(m.discovery_stats['probes'], full)
+		self.assertDiscovered(bus, m.discover(known=macs, search=False), macs)
+		self.assertEqual(m.discovery_stats['probes'], 4, 'Discovery of known nodes took more than one probe each.')
+
+	def test_sync_stable_addresses(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			path = os.path.join(tmp, 'busmap.json')
+			busmap = BusMap(path)
+			busmap.update(0x2342, 5, present=False)
+			bus = FakeBus([0x2342, 0x1111], fingerprints={0x2342: b'\x01'*8})
+			m = SerialMux(ser=bus)
+			self.assertEqual(m.sync(busmap), ([0x2342, 0x1111], []))
+			self.assertEqual(bus.addresses, {0x2342: 5, 0x1111: 0}, 'A known node did not keep its address.')
+			self.assertEqual(busmap.fingerprint(0x2342), '01'*8)
+			self.assertEqual(busmap.fingerprint(0x1111), None)
+			#A node vanishes, a new one appears
+			del bus.addresses[0x1111]
+			bus.addresses[0x4223] = None
+			self.assertEqual(m.sync(busmap), ([0x4223], [0x1111]))
+			self.assertEqual(bus.addresses[0x4223], 1, 'A new node got the address of a vanished one.')
+			self.assertEqual(BusMap(path).nodes, busmap.nodes, 'The bus map was not saved.')
+			#Without a search, new nodes are not found
+			bus.addresses[0x1234] = None
+			bus.probes = 0
+			self.assertEqual(m.sync(busmap, search=False), ([], []))
+			self.assertEqual(bus.probes, 3)
+
+	def test_watch(self):
+		bus = FakeBus([0x2342])
+		m = SerialMux(ser=bus)
+		busmap = BusMap()
+		m.sync(busmap)
+		detached, attached = threading.Event(), threading.Event()
+		watcher = m.watch(busmap, interval=0.01, search_every=0, on_attach=lambda mac, address, fp: attached.set(),
+				on_detach=lambda mac, address: detached.set())
+		try:
+			del bus.addresses[0x2342]
+			self.assertTrue(detached.wait(1), 'The watcher did not notice a node vanishing.')
+			bus.addresses[0x2342] = None
+			self.assertTrue(attached.wait(1), 'The watcher did not notice a node coming back.')
+		finally:
+			watcher.stop()
+		self.assertEqual(bus.addresses[0x2342], 0)
+
+	def test_upshift(self):
+		fs = FakeSerial()
+		fs.baudrate = 115200
+		m = SerialMux(ser=fs)
+		g = Ganglion(0, ser=fs, jsonconfig={'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'baudrates': [57600, 500000, 1000000], 'members': {}})
+		fingerprint = b'\x00\x09=' + bytes(8)
+		#The node does not answer at 1000000 baud, so the bus falls back to 115200 and then tries 500000
+		fs.responses = [b'', b'', b'', fingerprint, b'', fingerprint]
+		self.assertEqual(m.upshift([g]), 500000)
+		self.assertEqual(fs.baudrate, 500000, 'The port was not switched to the new baud rate.')
+		self.assertTrue(fs.out.startswith(b'\\#\xFF\xFC\x00\x00\x00\x04\x00\x0F\x42\x40'), 'Somehow pylibcerebrum sent a wrong baud rate switch.')
+		self.assertIn(b'\x00'*512 + b'\\#\xFF\xFC\x00\x00\x00\x04\x00\x01\xC2\x00', fs.out, 'The nodes were not switched back after the failed switch.')
+		#Nothing faster to try
+		fs.out = b''
+		self.assertEqual(m.upshift([g], rates=[57600, 500000]), 500000)
+		self.assertEqual(fs.out, b'')
+
+	def test_group(self):
 		fs = FakeSerial()
 		m = SerialMux(ser=fs)
-		fs.inp += b'\xFF'*16
-		self.assertEqual(m.discover(), [0])
-		probepacket0 = lambda x: b'\\#\xFF\xFF\x00\x00'+x.to_bytes(2, 'big')
-		probepacket1 = lambda x: b'\\#\xFF\xFF'+(1<<x).to_bytes(2, 'big')+x.to_bytes(2, 'big')
-		self.assertEqual(fs.out, b''.join([probepacket0(i) for i in range(16)] + [probepacket1(15-i) for i in range(16)]))
-		#FIXME test a more complicated example here (unfortunately, this needs a more complicated FakeSerial that I'm currently to lazy to code)
+		config = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'groups': {'id': 5}, 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}}}}
+		nodes = [Ganglion(address, ser=fs, jsonconfig=config) for address in (1, 2)]
+		fs.inp += b'\x00\x01\x01'*2
+		g = m.group(nodes)
+		self.assertEqual(fs.out, b'\\#\x00\x01\x00\x05\x00\x03\xFF\x00\x01\\#\x00\x02\x00\x05\x00\x03\xFF\x00\x01', 'The nodes were not told to join the group.')
+		#Nodes do not respond to group frames
+		fs.out = b''
+		g.foo.prop = 0x41
+		self.assertEqual(fs.out, b'\\#\xFF\x00\x00\x02\x00\x01\x41', 'Somehow pylibcerebrum sent a wrong command to the group.')
+		with self.assertRaises(TypeError):
+			g.foo.prop
+		#The next group gets the next address
+		fs.inp += b'\x00\x01\x01'
+		self.assertEqual(m.group(nodes[:1]).node_id, 0xFF01)
+		#Nodes running different firmware cannot be grouped
+		other = Ganglion(3, ser=fs, jsonconfig=dict(config, members={"foo": {"type": "test", "properties": {"prop": {"fmt": "<H", "id": 1, "size": 2}}}}))
+		with self.assertRaises(ValueError):
+			m.group(nodes + [other])
+		#If a node has no free group slot left, the others leave the group again
+		fs.out = b''
+		fs.inp += b'\x00\x01\x01\x00\x01\x00\x00\x01\x01'
+		with self.assertRaises(ValueError):
+			m.group(nodes)
+		self.assertEqual(fs.out[-11:], b'\\#\x00\x01\x00\x05\x00\x03\xFF\x02\x00', 'The group was not left after a failed join.')
+
+class TestBusManager(unittest.TestCase):
+	def setUp(self):
+		desc = lambda name: {'name': name, 'members': {'led': {'type': 'simple-io', 'properties': {'pwm': {'id': 1, 'fmt': 'B', 'size': 1}}}}}
+		self.mainhall = FakeBus([0x2342, 0x2343], descriptors={0x2342: desc('ampel'), 0x2343: desc('tuer')})
+		self.relays = FakeBus([0x4223], descriptors={0x4223: {'members': {}}})
+		self.m = BusManager({'mainhall': SerialMux(ser=self.mainhall), 'relays': SerialMux(ser=self.relays)})
+
+	def tearDown(self):
+		self.m.close()
+
+	def test_open(self):
+		self.assertEqual(self.m.discover(), {'mainhall': [(0x2342, 0), (0x2343, 1)], 'relays': [(0x4223, 0)]})
+		self.assertEqual(sorted(self.m.open()), ['mainhall/ampel', 'mainhall/tuer', 'relays/0'])
+		self.assertEqual(self.m['mainhall/ampel/led'].node_id, 0)
+		self.assertEqual(self.m['mainhall/tuer/led'].node_id, 1)
+		self.mainhall.inp += b'\x00\x01\x17'
+		self.assertEqual(self.m.call('mainhall/tuer/led', lambda g: g.pwm).result(1), 0x17)
+
+	def test_concurrency(self):
+		slow = self.m.submit('mainhall', time.sleep, 0.5)
+		fast = self.m.submit('relays', lambda: 23)
+		self.assertEqual(fast.result(0.25), 23, 'A slow bus stalled another one.')
+		self.assertFalse(slow.done())
+
+class TestBroker(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		desc = {'name': 'ampel', 'multiset': {'id': 5, 'size': 64}, 'members': {'led': {'type': 'simple-io', 'properties': {
+			'pwm': {'id': 1, 'fmt': 'B', 'size': 1}, 'state': {'id': 3, 'fmt': 'B', 'size': 1}}}}}
+		self.bus = FakeBus([0x2342], descriptors={0x2342: desc})
+		self.broker = Broker(BusManager({'mainhall': SerialMux(ser=self.bus)}), os.path.join(self.tmp.name, 'cerebrum.sock'))
+		self.broker.start()
+		self.client = BrokerClient(self.broker.path)
+
+	def tearDown(self):
+		self.client.close()
+		self.broker.close()
+		self.broker.manager.close()
+		self.tmp.cleanup()
+
+	def test_open_and_call(self):
+		self.assertEqual(self.client.nodes(), {'mainhall': [[0x2342, 0, 'ampel']]})
+		writes = self.bus.writes
+		g = self.client.open('mainhall', 0)
+		self.assertEqual(self.bus.writes, writes, 'Opening a ganglion through the broker touched the bus.')
+		self.bus.responses = [b'\x00\x01\x5C', b'\x00\x00']
+		self.assertEqual(g.led.pwm, 0x5C)
+		g.led.pwm = 0x5C
+		self.assertEqual(self.bus.out[-10:], b'\\#\x00\x00\x00\x02\x00\x01\\\\', 'The broker sent a wrong command to the device.')
+
+	def test_batch(self):
+		g = self.client.open('mainhall', 0)
+		self.bus.responses = [b'\x00\x01\x41', b'\x00\x01\x42']
+		with g.batch():
+			first, second = g.led.pwm, g.led.pwm
+		self.assertEqual((first.result(), second.result()), (0x41, 0x42))
+
+	def test_set_many(self):
+		g = self.client.open('mainhall', 0)
+		#One response per record of the multi-set call
+		self.bus.responses = [b'\x00\x00\x00\x00', b'\x00\x01\x41']
+		g.update({'led.pwm': 1, 'led.state': 0})
+		self.assertEqual(self.bus.out[-16:], b'\\#\x00\x00\x00\x05\x00\x08\x00\x02\x01\x01\x00\x04\x01\x00', 'The broker sent a wrong command to the device.')
+		self.assertEqual(g.led.pwm, 0x41, 'The responses to a multi-set call got mixed up with the next call.')
+
+	def test_group(self):
+		g = self.client.open('mainhall', 0)
+		group = GroupGanglion(0xFF00, g._jsonconfig, ser=g._ser)
+		#The group frame gets no response, the following call does
+		self.bus.responses = [b'', b'\x00\x01\x41']
+		start = time.monotonic()
+		group.led.pwm = 7
+		self.assertEqual(g.led.pwm, 0x41, 'A group frame messed up the following call.')
+		self.assertLess(time.monotonic()-start, 0.5, 'The broker waited for a response to a group frame.')
+		self.assertIn(b'\\#\xFF\x00\x00\x02\x00\x01\x07', self.bus.out, 'The broker did not send the group frame.')
+
+	def test_timeout(self):
+		g = self.client.open('mainhall', 0)
+		with self.assertRaises(TimeoutException):
+			g.led.pwm
+		#The bus is usable afterwards
+		self.bus.responses = [b'\x00\x01\x41']
+		self.assertEqual(g.led.pwm, 0x41)
+
+	def test_fairness(self):
+		sent = []
+		class Client:
+			def __init__(self, name):
+				self.name = name
+			def send(self, rid, status, payload):
+				sent.append((self.name, rid))
+		scheduler = BusScheduler(self.broker.manager.buses['mainhall'])
+		a, b = Client('a'), Client('b')
+		for i in range(3):
+			scheduler.put(a, i, b'\\#\x00\x00\x00\x01\x00\x00')
+		scheduler.put(b, 0, b'\\#\x00\x00\x00\x01\x00\x00')
+		scheduler.start()
+		scheduler.stop()
+		scheduler.join()
+		self.assertEqual(sent[:2], [('a', 0), ('b', 0)], 'A client with many pending calls starved another one.')
+
+	def test_invalid_frames(self):
+		self.client.nodes()
+		writes = self.bus.writes
+		for frame in (b'', b'\\#\x00', b'\\#\x00\x00\x00\x01\x00\x02\x41', b'\\#\xFF\xFF\x00\x00\x00\x00',
+				b'\\#\xFF\xFC\x00\x00\x00\x04\x00\x01\xC2\x00', b'\\#\x00\x00\x00\x01\x00\x00'*2):
+			status, payload = self.client.wait(self.client.request(MSG_CALL, b'\x00' + frame))
+			self.assertEqual(status, STATUS_ERROR, 'The broker accepted the frame {}.'.format(frame))
+		self.assertEqual(self.bus.writes, writes, 'The broker sent an invalid frame on the bus.')
+		#The broker still serves calls
+		g = self.client.open('mainhall', 0)
+		self.bus.responses = [b'\x00\x01\x41']
+		self.assertEqual(g.led.pwm, 0x41)
+
+	def test_scheduler_errors(self):
+		sent = []
+		class Client:
+			def send(self, rid, status, payload):
+				sent.append((rid, status))
+		scheduler = BusScheduler(self.broker.manager.buses['mainhall'])
+		scheduler.start()
+		self.bus.responses = [b'\x00\x01\x41']
+		#A short frame neither kills the worker thread nor keeps the next call from being answered
+		scheduler.put(Client(), 0, b'\\#\x00')
+		scheduler.put(Client(), 1, b'\\#\x00\x00\x00\x01\x00\x00')
+		deadline = time.monotonic() + 1
+		while len(sent) < 2 and time.monotonic() < deadline:
+			time.sleep(0.01)
+		scheduler.stop()
+		self.assertEqual(sent, [(0, STATUS_ERROR), (1, STATUS_OK)])
+
+	def test_request_ids(self):
+		#Ids still in flight are skipped when the counter wraps around
+		self.client.ids = itertools.count(0xFFFF)
+		first = self.client.request(MSG_LIST)
+		with self.client.lock:
+			self.client.pending[0] = [threading.Event(), None, None]
+		second = self.client.request(MSG_LIST)
+		self.assertEqual((first, second), (0xFFFF, 1))
+		self.assertEqual(self.client.wait(second)[0], STATUS_OK)
+		self.assertEqual(self.client.wait(first)[0], STATUS_OK)
+		#Discarded requests keep their id until the broker answered them
+		self.client.ids = itertools.count(2)
+		self.client.discard(0)
+		self.client.orphans.add(2)
+		self.assertEqual(self.client.request(MSG_LIST), 3)
+
+	def test_connection_lost(self):
+		g = self.client.open('mainhall', 0)
+		#A request still waiting for its response when the connection goes down
+		rid = 0x1234
+		with self.client.lock:
+			self.client.pending[rid] = [threading.Event(), None, None]
+		self.client.sock.shutdown(socket.SHUT_RDWR)
+		deadline = time.monotonic() + 1
+		while not self.client.lost and time.monotonic() < deadline:
+			time.sleep(0.01)
+		for call in (lambda: self.client.wait(rid), lambda: self.client.request(MSG_LIST), lambda: g.led.pwm):
+			with self.assertRaises(serial.SerialException):
+				call()
+
+class TestStateMirror(unittest.TestCase):
+	def test_mirror(self):
+		fs = FakeSerial()
+		g = Ganglion(0x2342, ser=fs, jsonconfig = {'members': {'foo': {'type': 'test', 'properties': {
+			'prop': {'fmt': 'B', 'id': 1, 'size': 1}, 'buf': {'fmt': '>3H', 'id': 3, 'size': 6}}}}})
+		with tempfile.TemporaryDirectory() as tmp:
+			mirror = StateMirror(g, os.path.join(tmp, 'mirror'))
+			reader = MirrorReader(os.path.join(tmp, 'mirror'))
+			try:
+				self.assertEqual(sorted(reader.layout), ['foo/buf', 'foo/prop'])
+				self.assertEqual(reader.get('foo/prop'), None)
+				#The second read fails and keeps its old value
+				fs.responses = [b'\x00\x06\x00\x01\x00\x02\x00\x03', b'\x00\x01\x17']
+				self.assertEqual(mirror.poll(), 2)
+				self.assertEqual(fs.out, b'\\#\x23\x42\x00\x03\x00\x00\\#\x23\x42\x00\x01\x00\x00')
+				self.assertEqual(reader.snapshot(), {'foo/buf': [1, 2, 3], 'foo/prop': 0x17})
+				self.assertEqual(reader.seq, 4)
+				fs.responses = [b'\x00\x06\x00\x04\x00\x05\x00\x06']
+				self.assertEqual(mirror.poll(), 1)
+				self.assertEqual(reader.get('foo/buf'), [4, 5, 6])
+				timestamp, value = reader.get_timestamped('foo/prop')
+				self.assertEqual(value, 0x17)
+				self.assertLess(time.time() - timestamp, 1)
+			finally:
+				reader.close()
+				mirror.close()
+
+class TestPollScheduler(unittest.TestCase):
+	def setUp(self):
+		self.fs = FakeSerial()
+		self.g = Ganglion(0x2342, ser=self.fs, jsonconfig = {'members': {'foo': {'type': 'test', 'properties': {
+			'a': {'fmt': 'B', 'id': 1, 'size': 1}, 'b': {'fmt': 'B', 'id': 3, 'size': 1}}}}})
+		self.changes = []
+		self.sched = PollScheduler()
+
+	def callback(self, g, name, value, old):
+		self.changes.append((name, value, old))
+
+	def test_change_callbacks(self):
+		a = self.sched.register(self.g.foo, 'a', 10, self.callback, adaptive=False)
+		b = self.sched.register(self.g.foo, 'b', 10, self.callback, adaptive=False)
+		#The first polls are spread over the interval
+		self.assertNotEqual(a.due, b.due)
+		now = max(a.due, b.due)
+		self.fs.inp = b'\x00\x01\x01\x00\x01\x02'
+		self.sched.poll(now)
+		self.assertEqual(self.fs.writes, 2, 'The reads due were not sent one at a time.')
+		self.assertEqual(self.changes, [('a', 1, None), ('b', 2, None)])
+		self.fs.inp = b'\x00\x01\x01\x00\x01\x03'
+		self.sched.poll(now + 0.1)
+		self.assertEqual(self.changes[2:], [('b', 3, 2)], 'A callback was called without a change.')
+
+	def test_adaptive_rate(self):
+		a = self.sched.register(self.g.foo, 'a', 10, self.callback)
+		now = a.due
+		for i in range(20):
+			self.fs.inp = b'\x00\x01\x01'
+			now = a.due
+			self.sched.poll(now)
+		self.assertAlmostEqual(a.interval, 0.1*MAX_SLOWDOWN, msg='An unchanging property is still polled at its full rate.')
+		self.fs.inp = b'\x00\x01\x02'
+		self.sched.poll(a.due)
+		self.assertAlmostEqual(a.interval, 0.1, msg='A changing property is not polled at its full rate.')
+
+	def test_read_error(self):
+		a = self.sched.register(self.g.foo, 'a', 10, self.callback)
+		due = a.due
+		self.sched.poll(due)
+		self.assertEqual(self.changes, [])
+		self.assertGreater(a.due, due, 'A property that could not be read was not rescheduled.')
+
+class TestAdaptiveTimeout(unittest.TestCase):
+	def test_convergence(self):
+		t = AdaptiveTimeout(115200, ceiling=1)
+		initial = t.timeout(0x2342, 10)
+		for i in range(50):
+			t.observe(0x2342, 0.002 + 10*t.bytetime, 10)
+		self.assertLess(t.timeout(0x2342, 10), initial)
+		self.assertLess(t.timeout(0x2342, 10), 0.02, 'The timeout did not converge towards the observed latency.')
+		#Nodes nothing is known about start out with the latency of the bus
+		self.assertLess(t.timeout(0x4223, 10), 0.02, 'A missing node would not fail fast.')
+		self.assertGreaterEqual(t.timeout(0x2342, 0), MIN_TIMEOUT)
+
+	def test_backoff(self):
+		t = AdaptiveTimeout(115200, ceiling=0.5)
+		before = t.timeout(0x2342, 10)
+		t.backoff(0x2342)
+		self.assertGreater(t.timeout(0x2342, 10), before)
+		for i in range(20):
+			t.backoff(0x2342)
+		self.assertEqual(t.timeout(0x2342, 10), 0.5, 'The timeout exceeds its ceiling.')
+
+	def test_line_speed(self):
+		slow, fast = AdaptiveTimeout(9600, ceiling=10), AdaptiveTimeout(115200, ceiling=10)
+		self.assertGreater(slow.timeout(0x2342, 100), fast.timeout(0x2342, 100))
+		#A 4kB descriptor takes about 0.7s at 57600 baud
+		self.assertGreater(AdaptiveTimeout(57600).payload(4096), 4096*10/57600)
+
+class TestLockableSerial(unittest.TestCase):
+	def setUp(self):
+		self.master, slave = pty.openpty()
+		self.ser = LockableSerial(port=os.ttyname(slave), timeout=0.05)
+		os.close(slave)
+
+	def tearDown(self):
+		self.ser.close()
+		os.close(self.master)
+
+	def test_read_ahead(self):
+		os.write(self.master, b'\x00\x01A\x00\x02BC')
+		self.assertEqual(bytes(self.ser.readview(2)), b'\x00\x01')
+		#Everything that was received so far is buffered
+		self.assertEqual(self.ser.rxend - self.ser.rxstart, 5)
+		self.assertEqual(bytes(self.ser.readview(1)), b'A')
+		self.assertEqual(self.ser.read(4), b'\x00\x02BC')
+
+	def test_large_read(self):
+		data = bytes(range(256))*20
+		os.write(self.master, data[:3000])
+		self.assertEqual(self.ser.read(1), data[:1])
+		os.write(self.master, data[3000:])
+		self.assertEqual(self.ser.read(len(data)-1), data[1:])
+
+	def test_timeout(self):
+		os.write(self.master, b'\x00')
+		with self.assertRaises(TimeoutException):
+			self.ser.read(2)
+		#The partial read is discarded
+		os.write(self.master, b'\x01\x02')
+		self.assertEqual(self.ser.read(2), b'\x01\x02')
+
+	def test_resync(self):
+		#A late response to a timed out request, partially read already
+		os.write(self.master, b'\x00\x04AB')
+		self.assertEqual(self.ser.read(3), b'\x00\x04A')
+		os.write(self.master, b'CD')
+		start = time.monotonic()
+		self.ser.resync()
+		self.assertLess(time.monotonic()-start, 0.1, 'Resynchronization took too long.')
+		os.write(self.master, b'\x00\x01E')
+		self.assertEqual(self.ser.read(3), b'\x00\x01E', 'Stale data was not discarded.')
+
+class TestAsyncMux(unittest.TestCase):
+	def run_with_device(self, coro, response):
+		"""Run coro(mux) against a fake device answering with response and return the result and the bytes it got."""
+		host, device = socket.socketpair()
+		device.sendall(response)
+		async def run():
+			m = AsyncSerialMux(ser=FakeSerial(host))
+			try:
+				return await coro(m)
+			finally:
+				m.close()
+		rv = asyncio.run(run())
+		device.setblocking(False)
+		try:
+			received = device.recv(4096)
+		except BlockingIOError:
+			received = b''
+		device.close()
+		return rv, received
+
+	def test_open_and_call(self):
+		async def coro(m):
+			g = await m.open(0x2342)
+			await g.foo.set('prop', 0x41)
+			return await asyncio.gather(g.foo.prop, g.foo.callback(0x44))
+		config = b'{"version":0.17,"builddate":"2012-05-23 23:42:17","members":{"foo":{"type":"test","properties":{"prop":{"fmt":"B","id":1,"size":1}},"functions":{"callback":{"id":3,"args":"B","returns":"2B"}}}}}'
+		rv, out = self.run_with_device(coro, len(config).to_bytes(2, 'big') + config + b'\x00\x00\x00\x01\x41\x00\x02\x42\x43')
+		self.assertEqual(rv, [0x41, [0x42, 0x43]], 'Somehow a device response was decoded wrong.')
+		self.assertEqual(out, b'\\#\x23\x42\x00\x00\x00\x00\\#\x23\x42\x00\x02\x00\x01\x41\\#\x23\x42\x00\x01\x00\x00\\#\x23\x42\x00\x03\x00\x01\x44', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_snapshot(self):
+		async def coro(m):
+			g = AsyncGanglion(0x2342, jsonconfig={'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'snapshot': {'id': 5, 'properties': [['foo', 'prop']]},
+				'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}}}}, ser=m)
+			return await g.snapshot()
+		rv, out = self.run_with_device(coro, b'\x00\x01\x41')
+		self.assertEqual(rv, {'foo': {'prop': 0x41}}, 'Somehow a snapshot was decoded wrong.')
+		self.assertEqual(out, b'\\#\x23\x42\x00\x05\x00\x00', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_events(self):
+		async def coro(m):
+			g = AsyncGanglion(0x2342, jsonconfig={'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'events': {'id': 5, 'sources': [['foo', 'state'], ['bar', 'state']]},
+				'members': {"foo": {"type": "simple-io"}, "bar": {"type": "matrix_input"}}}, ser=m)
+			return await g.events()
+		rv, out = self.run_with_device(coro, b'\x00\x07\x02\x01\x04\x01\x00\x00\x01')
+		self.assertEqual(rv, [('bar', 'state', 4, 1), ('foo', 'state', 0, 1)], 'Somehow the events were decoded wrong.')
+		self.assertEqual(rv.dropped, 2, 'Somehow the number of dropped events was decoded wrong.')
+		self.assertEqual(out, b'\\#\x23\x42\x00\x05\x00\x00', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_update(self):
+		config = {'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}, "arr": {"fmt": "3B", "id": 3, "size": 3}}},
+			"bar": {"type": "test", "properties": {"prop": {"fmt": "<H", "id": 5, "size": 2}}}}}
+		async def coro(m):
+			g = AsyncGanglion(0x2342, jsonconfig=dict(config, multiset={'id': 9, 'size': 12}), ser=m)
+			await g.update({'foo.prop': 0x41, 'foo.arr': [1, 2, 3], 'bar.prop': 0x1234})
+			#All three responses must have been read
+			return bytes(m.buf)
+		rv, out = self.run_with_device(coro, b'\x00\x00'*3)
+		self.assertEqual(out, b'\\#\x23\x42\x00\x09\x00\x0A\x00\x02\x01\x41\x00\x04\x03\x01\x02\x03'
+				+ b'\\#\x23\x42\x00\x09\x00\x05\x00\x06\x02\x34\x12', 'Somehow pylibcerebrum sent a wrong command to the device.')
+		self.assertEqual(rv, b'', 'The responses to the multi-set calls were not read.')
+		#Without multi-set support, each property is set on its own
+		async def coro(m):
+			g = AsyncGanglion(0x2342, jsonconfig=config, ser=m)
+			await g.set_many([('foo.prop', 0x41), ('bar.prop', 0x1234)])
+		rv, out = self.run_with_device(coro, b'\x00\x00'*2)
+		self.assertEqual(out, b'\\#\x23\x42\x00\x02\x00\x01\x41' + b'\\#\x23\x42\x00\x06\x00\x02\x34\x12', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_join_group(self):
+		async def coro(m):
+			g = AsyncGanglion(1, jsonconfig={'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'groups': {'id': 5}}, ser=m)
+			return await g.join_group(0xFF00), await g.leave_group(0xFF00)
+		rv, out = self.run_with_device(coro, b'\x00\x01\x00\x00\x01\x01')
+		self.assertEqual(rv, (False, True), 'Somehow the group call results were decoded wrong.')
+		self.assertEqual(out, b'\\#\x00\x01\x00\x05\x00\x03\xFF\x00\x01\\#\x00\x01\x00\x05\x00\x03\xFF\x00\x00', 'Somehow pylibcerebrum sent a wrong command to the device.')
+
+	def test_shadow(self):
+		shadow = ShadowCache(ttl=3600)
+		async def coro(m):
+			g = AsyncGanglion(0x2342, jsonconfig={'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {"foo": {"type": "test", "properties": {"prop": {"fmt": "B", "id": 1, "size": 1}}}}}, ser=m, shadow=shadow)
+			await g.foo.set('prop', 0x41)
+			await g.foo.set('prop', 0x41)
+			return await g.foo.prop
+		rv, out = self.run_with_device(coro, b'\x00\x00')
+		self.assertEqual(rv, 0x41, 'Somehow a shadowed value was decoded wrong.')
+		self.assertEqual(out, b'\\#\x23\x42\x00\x02\x00\x01\x41', 'A redundant write or a shadowed read was sent to the device.')
+		self.assertEqual(shadow.stats(), {'hits': 1, 'misses': 0, 'suppressed': 1, 'writes': 1})
+
+	def test_probe_timeout(self):
+		async def coro(m):
+			return await m._send_probe(0x2342, 5, 0), await m._send_probe(0x2342, 5, 0)
+		rv, out = self.run_with_device(coro, b'\xFF')
+		self.assertEqual(rv, (True, False))
+
+	def test_discovery_known(self):
+		async def coro(m):
+			return await m.discover(known={0x2342: 5, 0x4223: 6}, search=False), m.discovery_stats
+		(found, stats), out = self.run_with_device(coro, b'\xFF')
+		self.assertEqual(found, [(0x2342, 5)], 'Discovery found the wrong nodes.')
+		self.assertEqual((stats['probes'], stats['known']), (2, 1), 'Discovery stats are wrong.')
+		self.assertEqual(out, probe_request(0x2342, 0, 5) + probe_request(0x4223, 0, 6), 'Discovery sent the wrong probes.')
+
+	def test_no_batch(self):
+		g = AsyncGanglion(0x2342, jsonconfig={'version': 0.17, 'builddate': '2012-05-23 23:42:17', 'members': {}}, ser=FakeSerial())
+		self.assertFalse(hasattr(g, 'batch'), 'AsyncGanglion exposes batch although it cannot pipeline calls.')
 
 class FakeSerial:
 
-	def __init__(self):
+	def __init__(self, sock=None):
+		#Only used by the asyncio tests, which do their I/O on the file descriptor
+		self.sock = sock
 		self.out = b''
 		self.inp = b''
+		self.writes = 0
 		self.timeout=1
+		#Responses to be received after each of the next writes
+		self.responses = []
+		self.resyncs = 0
 
-	def read(self, n):
+	def read(self, n, timeout=None):
 		if len(self.inp) < n:
 			raise TimeoutException()
 		r = self.inp[0:n]
 		self.inp = self.inp[n:]
 		return r
 
+	def readview(self, n, timeout=None):
+		return memoryview(self.read(n))
+
 	def write(self, bs):
 		if not isinstance(bs, bytes):
 			raise ArgumentError('FakeSerial.write only accepts -bytes-')
 		self.out += bs
+		self.writes += 1
+		if self.responses:
+			self.inp += self.responses.pop(0)
+
+	def resync(self):
+		self.inp = b''
+		self.resyncs += 1
 	
 	def __enter__(self):
 		return self
@@ -137,6 +966,41 @@ class FakeSerial:
 	def setXonXoff(self, state):
 		pass
 
+	def fileno(self):
+		return self.sock.fileno()
+
 	def close(self):
-		pass
+		if self.sock:
+			self.sock.close()
+
+class FakeBus(FakeSerial):
+	"""FakeSerial answering discovery probes like a bus of nodes with the given MACs would"""
+
+	def __init__(self, macs, fingerprints={}, descriptors={}):
+		super(FakeBus, self).__init__()
+		self.addresses = dict.fromkeys(macs)
+		self.fingerprints = fingerprints
+		self.descriptors = descriptors
+		self.probes = 0
+
+	def write(self, bs):
+		super(FakeBus, self).write(bs)
+		bs = bs.replace(b'\\\\', b'\\')
+		if bs[2:4] != b'\xFF\xFF':
+			#Answer descriptor and descriptor fingerprint requests
+			address, fid, arglen = struct.unpack('>HHH', bs[2:8])
+			for mac, a in self.addresses.items():
+				if a == address and arglen and mac in self.fingerprints:
+					self.inp += b'\x00\x09=' + self.fingerprints[mac]
+				elif a == address and fid == 0 and mac in self.descriptors:
+					desc = json.dumps(self.descriptors[mac]).encode()
+					self.inp += struct.pack('>H', len(desc)) + desc
+			return
+		address, mask, mac = struct.unpack('>HHQ', bs[4:])
+		self.probes += 1
+		hits = [m for m in self.addresses if m & (0xFFFFFFFFFFFFFFFF >> (mask&0x3F)) == mac]
+		for m in hits:
+			self.addresses[m] = address
+		if hits:
+			self.inp += b'\xFF'
 
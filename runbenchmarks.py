@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+#Copyright (C) 2012 jaseg <s@jaseg.de>
+#
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#version 3 as published by the Free Software Foundation.
+
+import os
+import pty
+import time
+import tempfile
+import shutil
+import json
+import serial
+import argparse
+import subprocess
+import generator
+from pylibcerebrum.ganglion import Ganglion, CallPlan, LENGTH, decode_config
+from pylibcerebrum.serial_mux import LockableSerial, probe_request, baudrate_request
+from pylibcerebrum.state_mirror import StateMirror, MirrorReader
+"""Microbenchmarks for the host side of the Cerebrum protocol."""
+
+class LoopbackSerial:
+	"""Serial port stand-in answering every request with the same canned response
+
+	Like LockableSerial outside of a batch and without adaptive timeouts. As there, readview hands out views of the
+	received data and read copies them.
+
+	"""
+
+	def __init__(self, response):
+		self.response = response
+		self.pos = 0
+		self.timeout = 1
+		self.batch = None
+		self.timeouts = None
+
+	def write(self, data):
+		self.pos = 0
+		self.rxview = memoryview(self.response)
+
+	def read(self, n, timeout=None):
+		return bytes(self.readview(n))
+
+	def readview(self, n, timeout=None):
+		start = self.pos
+		self.pos += n
+		return self.rxview[start:self.pos]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+#Number of rounds each measurement is split into
+ROUNDS = 5
+
+def rate(func, n):
+	"""Call func n times and return the achieved calls per second."""
+	return compare([(None, func)], n)[0][1]
+
+def compare(candidates, n):
+	"""Call each of the (label, func) candidates n times and return (label, calls per second) pairs.
+
+	The calls are split into ROUNDS rounds taking turns between the candidates, so they all see the same load. Like
+	timeit, each candidate's fastest round counts since slower ones only measure interference by other processes.
+
+	"""
+	calls = max(n//ROUNDS, 1)
+	best = [0]*len(candidates)
+	for _ in range(ROUNDS):
+		for i, (label, func) in enumerate(candidates):
+			start = time.perf_counter()
+			for _ in range(calls):
+				func()
+			best[i] = max(best[i], calls/(time.perf_counter()-start))
+	return [(label, r) for (label, _), r in zip(candidates, best)]
+
+def report(name, results):
+	print(name)
+	base = results[0][1]
+	for label, r in results:
+		print('    {:<24} {:>12.0f} calls/s  {:>6.2f}x'.format(label, r, r/base))
+
+def bench_callplan(n):
+	"""Compare property reads and writes through precompiled call plans against the generic _callfunc path."""
+	config = {'members': {'led': {'type': 'simple-io', 'properties': {'pwm': {'id': 1, 'fmt': 'B', 'size': 1}}},
+				'strip': {'type': 'ws2801', 'properties': {'buffer': {'id': 3, 'fmt': '48B', 'size': 48}}}}}
+	ser = LoopbackSerial(b'')
+	g = Ganglion(0x2342, jsonconfig=config, ser=ser)
+	buf = list(range(0x50, 0x50+48)) #contains a backslash to be escaped
+	#The members are looked up once, the lookup costs the same on both paths
+	led, strip = g.led, g.strip
+	ser.response = b'\x00\x00'
+	pwm_set = led._callplans['pwm'][1]
+	buffer_set = strip._callplans['buffer'][1]
+	report('write B', compare([
+		('_callfunc', lambda: led._callfunc(2, 'B', 0x5C, '')),
+		('call plan', lambda: led._callplan(pwm_set, 0x5C))], n))
+	report('write 48B', compare([
+		('_callfunc', lambda: strip._callfunc(4, '48B', buf, '')),
+		('call plan', lambda: strip._callplan(buffer_set, buf))], n))
+	ser.response = b'\x00\x01\x5C'
+	pwm_get = led._callplans['pwm'][0]
+	report('read B', compare([
+		('_callfunc', lambda: led._callfunc(1, '', (), 'B')),
+		('call plan', lambda: led._callplan(pwm_get, ()))], n))
+
+def bench_construction(n):
+	"""Construct a Ganglion for a descriptor with many members, touching only a few of them or all of them."""
+	io = {'type': 'simple-io', 'properties': {name: {'id': i*2+1, 'fmt': 'B', 'size': 1} for i, name in enumerate(['state', 'direction', 'pwm', 'pwm_enabled', 'analog'])}}
+	config = {'members': {'digital{}'.format(i): io for i in range(64)}}
+	ser = LoopbackSerial(b'')
+	def touch_two():
+		g = Ganglion(0x2342, jsonconfig=config, ser=ser)
+		g.digital3, g.digital5
+	report('construct 64 members', compare([
+		('all members', lambda: list(Ganglion(0x2342, jsonconfig=config, ser=ser))),
+		('two members', touch_two)], n//100))
+
+def bench_receive(n):
+	"""Read responses from a pty, once through pyserial's read and once through LockableSerial's read-ahead buffer."""
+	master, slave = pty.openpty()
+	plain = serial.Serial(port=os.ttyname(slave), timeout=1)
+	buffered = LockableSerial(port=os.ttyname(slave), timeout=1)
+	plan = CallPlan(0x2342, 1, retfmt='B')
+	def plain_read():
+		os.write(master, b'\x00\x01\x5C')
+		(clen,) = LENGTH.unpack(plain.read(2))
+		plan.response(plain.read(clen))
+	def buffered_read():
+		os.write(master, b'\x00\x01\x5C')
+		plan.read(buffered)
+	try:
+		report('receive B', compare([
+			('pyserial read', plain_read),
+			('read-ahead buffer', buffered_read)], n))
+	finally:
+		plain.close()
+		buffered.close()
+		os.close(slave)
+		os.close(master)
+
+def bench_mirror(n):
+	"""Read a property through the serial port (here a loopback) and from a shared-memory state mirror."""
+	config = {'members': {'led': {'type': 'simple-io', 'properties': {'pwm': {'id': 1, 'fmt': 'B', 'size': 1}}}}}
+	ser = LoopbackSerial(b'\x00\x01\x5C')
+	g = Ganglion(0x2342, jsonconfig=config, ser=ser)
+	with tempfile.TemporaryDirectory() as tmp:
+		mirror = StateMirror(g, os.path.join(tmp, 'mirror'))
+		mirror.poll()
+		reader = MirrorReader(os.path.join(tmp, 'mirror'))
+		report('read B', compare([
+			('serial port', lambda: g.led.pwm),
+			('state mirror', lambda: reader.get('led/pwm'))], n))
+		reader.close()
+		mirror.close()
+
+def bench_baudrate(n):
+	"""Read the 257 byte test buffer through the host-side test build after upshifting it.
+
+	The test build talks through pipes, which have no baud rate. Only the throughput over the pipe is measured. The
+	rows for each standard baud rate are computed estimates: the measured time plus the time the bytes sent and
+	received would take on the line at that rate (10 bits per byte).
+
+	"""
+	build_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
+	generator.generate({'members': {'test': {'type': 'test'}}, 'version': 0.17}, {'mcu': 'test'}, build_path, 'benchmark', node_id=0x2342)
+	getter = CallPlan(0, 2, retfmt='257B')
+	data = probe_request(0x2342, 0, 0) + baudrate_request(max(generator.BAUDRATES)) + getter.request(())*n
+	start = time.perf_counter()
+	out = subprocess.run([os.path.join(build_path, 'main')], input=data, stdout=subprocess.PIPE, check=True).stdout
+	elapsed = time.perf_counter() - start
+	if len(out) != 1 + n*(LENGTH.size + getter.retlen):
+		raise RuntimeError('The test build sent {} bytes, expected {}'.format(len(out), 1 + n*(LENGTH.size + getter.retlen)))
+	linebytes = len(data) + len(out)
+	report('read 257B through the test build (measured)', [('pipe', n/elapsed)])
+	report('read 257B through the test build (estimated from the line time, not measured)',
+			[('{} baud'.format(rate), n/(elapsed + linebytes*10/rate)) for rate in generator.BAUDRATES])
+
+def bench_descriptor(n):
+	"""Decode the descriptors of some of the shipped configs in each descriptor format."""
+	base = os.path.dirname(os.path.abspath(__file__))
+	with open(os.path.join(base, 'devices', 'arduino-mega.json')) as f:
+		device = json.load(f)
+	for name in ['mainhall', 'relays', 'nerdarea', 'empty']:
+		with open(os.path.join(base, 'configs', name+'.json')) as f:
+			desc = json.load(f)
+		with tempfile.TemporaryDirectory() as d:
+			build_path = os.path.join(d, desc['type'])
+			shutil.copytree(os.path.join(base, desc['type']), build_path)
+			shutil.copytree(os.path.join(base, 'common'), os.path.join(d, 'common'))
+			desc = generator.generate(desc, device, build_path, 'benchmark', target=None)
+		#The firmware's descriptor is encoded before generate adds these
+		desc.pop('node_id')
+		desc.pop('fingerprint')
+		encoded = [(fmt, generator.encode_config(desc, fmt)) for fmt in ['lzma', 'json', 'binary']]
+		report('decode {} descriptor ({})'.format(name, ', '.join('{} {}B'.format(fmt, len(cbytes)) for fmt, cbytes in encoded)),
+				compare([(fmt, lambda cbytes=cbytes: decode_config(cbytes)) for fmt, cbytes in encoded], n//10))
+
+BENCHMARKS = {
+		'callplan': bench_callplan,
+		'construction': bench_construction,
+		'receive': bench_receive,
+		'mirror': bench_mirror,
+		'baudrate': bench_baudrate,
+		'descriptor': bench_descriptor,
+		}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run host-side Cerebrum microbenchmarks.')
+	parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS), help='Benchmarks to run (default: all). Available: {}'.format(', '.join(sorted(BENCHMARKS))))
+	parser.add_argument('-n', '--iterations', type=int, default=20000, help='Number of calls per measurement')
+	args = parser.parse_args()
+	for name in args.benchmarks:
+		BENCHMARKS[name](args.iterations)
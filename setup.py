@@ -32,6 +32,7 @@ setup(name = "pylibcerebrum",
                 ],
     package_data = {'pylibcerebrum': ['pylibcerebrum']},
     scripts = ['runtests.py',
+               'runbenchmarks.py',
                'build.py',
                'generator.py'],
     entry_points="""
@@ -0,0 +1,147 @@
+		/* AUTOGENERATED CODE FOLLOWS!
+ * This file contains the code generated from the module templates as well as
+ * some glue logic. It is generated following the device config by "generate.py"
+ * in this very folder. Please refrain from modifying it, modify the templates
+ * and generation logic instead.
+ * 
+ * Build version: 0.17, build date: 2012-05-23 23:42:17
+ */
+
+#include <string.h>
+#include "autocode.h"
+#include "comm.h"
+#include "uart.h"
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <stdio.h>
+#define debug_print(...) //fprintf(stderr, __VA_ARGS__)
+
+void callback_test_23_test_callback (const comm_callback_descriptor* cb, void* argbuf_end){
+	uint8_t* args = (uint8_t*) cb->argbuf;
+    for(uint8_t* i = args; i<(uint8_t*)argbuf_end; i++){
+        if(*i != 'A'){
+            debug_print("Wrong byte in argument buffer at position 0x%x. Expected 0x41, got 0x%x\n", i, *i);
+            exit(1);
+        }
+    }
+}
+
+uint8_t modvar_test_23_test_buffer[257];
+
+void callback_test_23_check_test_buffer (const comm_callback_descriptor* cb, void* argbuf_end){
+    for(unsigned int i=0; i<sizeof(modvar_test_23_test_buffer); i++){
+        uint8_t expected = 'A' + (i/32);
+        if(modvar_test_23_test_buffer[i] != expected){
+            debug_print("Wrong byte in the test buffer at position %d. Expected 0x%x, got 0x%x\n", i, expected, modvar_test_23_test_buffer[i]);
+            exit(1);
+        }
+    }
+}
+
+void callback_test_23_test_callback_long_args (const comm_callback_descriptor* cb, void* argbuf_end){
+	uint8_t* args = (uint8_t*)cb->argbuf;
+    for(uint8_t* i = args; i < (uint8_t*)argbuf_end; i++){
+        if(*i != 'A'){
+            debug_print("Wrong byte in argument buffer. Expected 0x41, got 0x%x\n", *i);
+            exit(1);
+        }
+    }
+	uint16_t argsize = (uint8_t*)argbuf_end - args;
+    if(argsize != 257){
+        debug_print("Wrong argument size. Expected 257, got %d\n", argsize);
+        exit(1);
+    }
+}
+
+
+#include "config.h"
+#if defined(__AVR__)
+#include <avr/pgmspace.h>
+#endif
+
+void generic_getter_callback(const comm_callback_descriptor* cb, void* argbuf_end);
+
+//Generic ranged setter used for writable array module variables. Its argument is a big-endian byte offset into the
+//variable followed by the data to be written there.
+static void ranged_setter(uint8_t* var, uint16_t size, void* argbuf, void* argbuf_end){
+	uint8_t* data = ((uint8_t*)argbuf)+2;
+	if((uint8_t*)argbuf_end > data){
+		uint16_t offset = (((uint8_t*)argbuf)[0]<<8) | ((uint8_t*)argbuf)[1];
+		uint16_t len = (uint8_t*)argbuf_end - data;
+		if(offset < size){
+			if(len > size-offset)
+				len = size-offset;
+			memcpy(var+offset, data, len);
+		}
+	}
+	uart_putc(0x00);
+	uart_putc(0x00);
+}
+
+void callback_setrange_modvar_test_23_test_buffer(const comm_callback_descriptor* cb, void* argbuf_end){
+	ranged_setter((uint8_t*)modvar_test_23_test_buffer, sizeof(modvar_test_23_test_buffer), cb->argbuf, argbuf_end);
+}
+
+
+
+
+const comm_callback_descriptor comm_callbacks[] = {
+	{&callback_get_descriptor_auto, (void*)global_argbuf, ARGBUF_SIZE}, //0
+	{&callback_test_23_test_callback, (void*)global_argbuf, ARGBUF_SIZE}, //1
+	{&generic_getter_callback, (void*)modvar_test_23_test_buffer, sizeof(modvar_test_23_test_buffer)}, //2
+	{0, (void*)modvar_test_23_test_buffer, sizeof(modvar_test_23_test_buffer)}, //3
+	{&callback_test_23_check_test_buffer, (void*)global_argbuf, ARGBUF_SIZE}, //4
+	{&callback_test_23_test_callback_long_args, (void*)global_argbuf, ARGBUF_SIZE}, //5
+	{&callback_setrange_modvar_test_23_test_buffer, (void*)global_argbuf, ARGBUF_SIZE}, //6
+};
+
+const uint16_t callback_count = (sizeof(comm_callbacks)/sizeof(comm_callback_descriptor)); //7;
+
+void init_auto(){
+}
+
+void loop_auto(){
+	comm_loop();
+}
+
+void callback_get_descriptor_auto(const comm_callback_descriptor* cb, void* argbuf_end){
+	if(argbuf_end != cb->argbuf){
+		//When called with any argument, only return the descriptor's fingerprint so hosts can check their cache.
+		uart_putc(0x00);
+		uart_putc(AUTO_CONFIG_FINGERPRINT_LENGTH);
+		for(const char* i=auto_config_fingerprint; i < auto_config_fingerprint+AUTO_CONFIG_FINGERPRINT_LENGTH; i++){
+#if defined(__AVR__)
+			uart_putc(pgm_read_byte(i));
+#else
+			uart_putc(*i);
+#endif
+		}
+		return;
+	}
+	//FIXME
+	uart_putc(auto_config_descriptor_length >> 8);
+	uart_putc(auto_config_descriptor_length & 0xFF);
+	for(const char* i=auto_config_descriptor; i < auto_config_descriptor+auto_config_descriptor_length; i++){
+#if defined(__AVR__)
+		uart_putc(pgm_read_byte(i));
+#else
+		uart_putc(*i);
+#endif
+	}
+}
+
+//Generic getter used for any readable parameters.
+//Please note one curious thing: This callback can not only be used to read, but also to write a variable. The only
+//difference between the setter and the getter of a variable is that the setter does not read the entire variable's
+//contents aloud.
+void generic_getter_callback(const comm_callback_descriptor* cb, void* argbuf_end){
+	//response length
+	uart_putc(cb->argbuf_len>>8);
+	uart_putc(cb->argbuf_len&0xFF);
+	//response
+	for(char* i=((char*)cb->argbuf); i<((char*)cb->argbuf)+cb->argbuf_len; i++){
+		uart_putc(*i);
+	}
+}
+
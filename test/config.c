@@ -0,0 +1,14 @@
+/* AUTOGENERATED CODE AHEAD!
+ * This file contains the device configuration encoded as selected by the build
+ * config's "descriptor_format" (the smaller of the compact table and lzma-ed
+ * json by default). It is
+ * autogenerated by "generate.py" (which should be found in this folder).
+ */
+#include "config.h"
+#ifndef PROGMEM
+#define PROGMEM
+#endif
+
+unsigned int auto_config_descriptor_length = 210;
+char const auto_config_descriptor[] PROGMEM = {33,2,0,134,6,118,101,114,115,105,111,110,0,98,117,105,108,100,100,97,116,101,0,98,97,117,100,114,97,116,101,115,0,48,46,49,55,0,50,48,49,50,45,48,53,45,50,51,32,50,51,58,52,50,58,49,55,0,116,101,115,116,0,116,101,115,116,95,98,117,102,102,101,114,0,50,53,55,66,0,116,101,115,116,95,99,97,108,108,98,97,99,107,0,54,53,66,0,99,104,101,99,107,95,116,101,115,116,95,98,117,102,102,101,114,0,116,101,115,116,95,99,97,108,108,98,97,99,107,95,108,111,110,103,95,97,114,103,115,0,0,225,0,0,1,194,0,0,3,132,0,0,3,208,144,0,7,161,32,0,15,66,64,0,2,3,0,7,1,1,2,5,0,0,3,4,6,0,255,255,255,255,255,255,1,10,1,13,5,0,1,6,7,2,1,3,8,1,9,0,10,0,3,11,1,7,4,1,6,30};
+char const auto_config_fingerprint[AUTO_CONFIG_FINGERPRINT_LENGTH] PROGMEM = {61,157,164,171,198,134,190,60,149};
@@ -7,6 +7,7 @@
  */
 
 #include "uart.h"
+#include "comm.h"
 #include <stdio.h>
 #include <stdlib.h>
 #include <stdint.h>
@@ -16,9 +17,16 @@ void uart_init(){
 }
 
 void uart_putc(uint8_t c){
+    if(comm_discard())
+        return;
     printf("%c", c);
 }
 
+//There is no line, so any baud rate works
+uint8_t uart_set_baudrate(uint32_t baudrate){
+    return 1;
+}
+
 void uart_putc_nonblocking(uint8_t c){
 	printf("%c", c);
 }
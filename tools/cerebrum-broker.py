@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+""" Serve Cerebrum buses to local programs (see pylibcerebrum/broker.py). """
+
+from pylibcerebrum.broker import main
+
+main()
@@ -10,9 +10,11 @@ from contextlib import contextmanager
 import requests
 import socket
 from pylibcerebrum.serial_mux import SerialMux
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, abort
 from flask_swagger import ApiParameter, SwaggerApiRegistry
 from serial.serialutil import SerialException
+from pylibcerebrum.ganglion import FramingError
+from pylibcerebrum.timeout_exception import TimeoutException
 
 # === Config ===
 # Interval to wait after a failed HTTP/JSONRPC request
@@ -35,6 +37,10 @@ def exitOnSerialException():
 	except SerialException:
 		print('Serial exception. Exiting.')
 		request.environ.get('werkzeug.server.shutdown')()
+	except (TimeoutException, FramingError) as e:
+		#The port has already been resynchronized, so only this request failed
+		print('Device did not answer properly:', e)
+		abort(503)
 
 ARGTYPES = {
 		'c': ('integer', int),
@@ -8,6 +8,7 @@ import json
 import requests
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from pylibcerebrum.serial_mux import SerialMux
+from pylibcerebrum.shadow import ShadowCache
 
 CBEAM			= 'http://c-beam.cbrp3.c-base.org:4254/rpc/'
 HYPERBLAST		= 'http://10.0.1.23:1337/'
@@ -24,7 +25,8 @@ while not results:
 	results = s.discover()
 print(results)
 print('opening first device')
-g = s.open(0)
+#The shadow cache suppresses writes of unchanged values
+g = s.open(0, shadow=ShadowCache())
 print('initializing device')
 print(dir(g))
 #bar status outputs
@@ -33,19 +35,13 @@ for io in [g.digital3, g.digital5, g.digital6, g.digital9, g.digital10, g.digita
 	io.pwm_enabled = 1
 print('starting event loop')
 
-oldre, oldge, oldgn = None,None,None
 def ampel(re,ge,gn):
-	global oldre, oldge, oldgn
 	if re and ge and gn:
 		gn = False
 	# Ensure no more than two lights are on at the same time, even for very short periods of time
-	if oldre != re:
-		g.ampelrot.state  = re
-	if oldge != ge:
-		g.ampelgelb.state = ge
-	if oldgn != gn:
-		g.ampelgrün.state = gn
-	oldre,oldge,oldgn = re,ge,gn
+	return [('ampelrot.state', re), ('ampelgelb.state', ge), ('ampelgrün.state', gn)]
+
+BAR_PWMS = ['digital3.pwm', 'digital5.pwm', 'digital6.pwm', 'digital9.pwm', 'digital10.pwm', 'digital11.pwm']
 
 #HACK ctrl-c ctrl-p -ed from barstatus.py
 barstatus = 'closed'
@@ -68,11 +64,10 @@ def animate():
 			'opened': ((10, 255, 10), (128, 128, 128)),
 			'closed': ((128, 128, 128), (255, 4, 4)),
 		      'lastcall': ((10, 255, 10), (255, 255, 10))}.get(lookup)
-		(g.digital3.pwm, g.digital5.pwm, g.digital6.pwm), (g.digital9.pwm, g.digital10.pwm, g.digital11.pwm) = l1, r1
-		ampel(*ampelstate[0])
+		#One frame per animation step
+		g.set_many(list(zip(BAR_PWMS, l1+r1)) + ampel(*ampelstate[0]))
 		time.sleep(0.33)
-		(g.digital3.pwm, g.digital5.pwm, g.digital6.pwm), (g.digital9.pwm, g.digital10.pwm, g.digital11.pwm) = l2, r2
-		ampel(*ampelstate[1])
+		g.set_many(list(zip(BAR_PWMS, l2+r2)) + ampel(*ampelstate[1]))
 		time.sleep(0.66)
 
 animator = Thread(target=animate)
@@ -125,7 +120,11 @@ oldval = -2*SEND_THRESHOLD
 oldbarstate = None
 newbarstate = None
 while True:
-	val = sum([ g.analog5.analog for i in range(AVG_SAMPLES)])/AVG_SAMPLES
+	if 'oversample' in g.analog5.config:
+		#Firmware averaging on the device
+		val = g.analog5.analog_sum/g.analog5.config['oversample']
+	else:
+		val = sum([ g.analog5.analog for i in range(AVG_SAMPLES)])/AVG_SAMPLES
 	if abs(val-oldval) > SEND_THRESHOLD:
 		oldval = val
 		sendstate(int(val))